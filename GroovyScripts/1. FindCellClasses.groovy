@@ -32,6 +32,7 @@ def categories = [ [ name: "TVA", parameters: {runPlugin('qupath.imagej.detect.c
 def dapiThresholdName = "DAPI"
 
 // Whether or not you want to remove RABIES+ cells
+// (set to false to filter them in Python instead, see PythonScripts/classifier_helpers.py)
 def removeRabies = true
 def rabiesClassifier = "RabiesClassifier"
 
@@ -1,5 +1,28 @@
+// Class names of the markers. Cells positive for several markers have a combined class
+// (class names sorted and joined by ": "), e.g. "CTB: Rabies". A column is exported for every combination.
+// Keep this list in line with MARKERS in PythonScripts/readCSV_helpers.py.
+def markers = ["CTB", "Rabies", "TVA"].sort()
 
-def measurements = ["Name", "Class", "Num Detections", "Num CTB", "Num Rabies", "Num TVA", "Num CTB: Rabies", "Num CTB: TVA", "Num CTB: Rabies: TVA", "Num Rabies: TVA", "DAPI: DAPI area "+GeneralTools.micrometerSymbol()+"^2"]
+def measurements = ["Name", "Class", "Num Detections"]
+for (int mask = 1; mask < (1 << markers.size()); mask++) {
+    def combination = (0..<markers.size()).findAll { (mask >> it) & 1 }.collect { markers[it] }
+    measurements << "Num " + combination.join(": ")
+}
+measurements << "DAPI: DAPI area "+GeneralTools.micrometerSymbol()+"^2"
+
+// Set to true to also export every detection (centroid, atlas region, marker flags and measurements), such that
+// the cells can be recounted with other class rules in Python without running QuPath again
+// (see count_detections in PythonScripts/readCSV_helpers.py, and from_detections in PythonScripts/readCSV.py).
+// The detections are written in chunks of detectionChunkSize rows (imageName_detections_000.tsv, ...).
+// This is off by default, because the exports are large and slow to write for big projects.
+def exportDetections = false
+def detectionChunkSize = 200000
+def detectionMeasurements = null // Names of the measurements to export (null exports all measurements)
+// Set to true to also export the coordinates of every detection in the atlas (Allen CCFv3, in mm), as the columns
+// Atlas_X (left-right), Atlas_Y (dorsal-ventral) and Atlas_Z (anterior-posterior), see PythonScripts/density_helpers.py.
+// This needs exportDetections
+// and the ABBA registration of the image.
+def exportAtlasCoordinates = false
 
 def annotations = getAnnotationObjects()
 
@@ -13,6 +36,50 @@ def resultsfile = new File(resultsfolder, imageName+"_regions.txt")
 
 Utils.sendResultsToFile( measurements, annotations, resultsfile)
 
+if( exportDetections ) {
+    def detections = getDetectionObjects()
+    def cal = getCurrentServer().getPixelCalibration()
+    if( detectionMeasurements == null )
+        detectionMeasurements = detections.collectMany{ it.getMeasurementList().getMeasurementNames() }.unique().sort()
+    def atlasColumns = exportAtlasCoordinates ? ["Atlas_X", "Atlas_Y", "Atlas_Z"] : []
+    detectionMeasurements = detectionMeasurements - atlasColumns
+    def pixelToAtlas = exportAtlasCoordinates ? AtlasTools.getAtlasToPixelTransform( getCurrentImageData() ).inverse() : null
+    def header = ["Centroid X um", "Centroid Y um", "Region"] + atlasColumns + markers + detectionMeasurements
+    
+    // Remove the chunks of a previous export of this image
+    new File(resultsfolder).listFiles().findAll{ it.getName().startsWith(imageName+"_detections_") }.each{ it.delete() }
+    
+    detections.collate( detectionChunkSize ).eachWithIndex{ chunk, k ->
+        def detectionsfile = new File(resultsfolder, imageName+"_detections_"+String.format("%03d", k)+".tsv")
+        detectionsfile.withPrintWriter{ writer ->
+            writer.println( header.join("\t") )
+            chunk.each{ d ->
+                // The atlas region is the class of the annotation that contains the detection, e.g. "Left: ACA".
+                // Detections outside the atlas regions get an empty region.
+                def parent = d.getParent()
+                def region = (parent == null || parent.getPathClass() == null) ? "" : parent.getPathClass().toString()
+                def classes = d.getPathClass() == null ? [] : d.getPathClass().toString().split(":").collect{ it.trim() }
+                def ml = d.getMeasurementList()
+                
+                def row = [d.getROI().getCentroidX() * cal.getPixelWidthMicrons(), 
+                           d.getROI().getCentroidY() * cal.getPixelHeightMicrons(), 
+                           region]
+                if( exportAtlasCoordinates ) {
+                    def atlasPoint = new RealPoint( d.getROI().getCentroidX(), d.getROI().getCentroidY(), 0 )
+                    pixelToAtlas.apply( atlasPoint, atlasPoint )
+                    row += (0..2).collect{ atlasPoint.getDoublePosition(it) }
+                }
+                row += markers.collect{ classes.contains(it) ? 1 : 0 }
+                row += detectionMeasurements.collect{ ml.containsNamedMeasurement(it) ? ml.getMeasurementValue(it) : Double.NaN }
+                writer.println( row.join("\t") )
+            }
+        }
+    }
+    println("Exported "+detections.size()+" detections")
+}
+
 println("Completed")
 
-import ch.epfl.biop.qupath.utils.*
\ No newline at end of file
+import ch.epfl.biop.qupath.utils.*
+import ch.epfl.biop.qupath.atlas.allen.api.*
+import net.imglib2.RealPoint
\ No newline at end of file
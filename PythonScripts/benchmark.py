@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 14:02:11 2026
+
+Benchmark of the analysis pipeline on synthetic QuPath exports.
+Synthetic _regions.txt files are generated with the columns written by
+'2. ExportABBACellCountResults.groovy', for cohorts of different sizes.
+Every stage of the pipeline is timed, and the timings are saved as JSON,
+such that the speed of different commits can be compared (see compare_benchmarks).
+readCSV_helpers.py of another commit (e.g. the baseline) can be timed on the same 
+synthetic cohorts, by setting baseline_commit.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import importlib.util
+import subprocess
+import contextlib
+import numpy as np
+import pandas as pd
+import matplotlib
+
+from ontology_helpers import get_ontology, roll_up_counts
+from readCSV_helpers import *
+
+#%% ------------------------------ SET PARAMETERS ----------------------------
+# ============================================================================
+
+path_to_onotlogy_pickle = '../AllenMouseBrainOntology.pk'
+profile = 'quick'               # 'quick' for a fast check, 'full' for realistic cohort sizes.
+output_folder = 'benchmark_results'
+seed = 0
+baseline_commit = None          # e.g. '6654b73' to compare with readCSV_helpers.py of that commit.
+
+# Scenarios: number of animals and slices per animal,
+# the file layout ('both': one file per slice, 'split': LEFT and RIGHT files, 'mixed': both)
+# and the fraction of slices with excluded regions.
+SCENARIOS = {
+    'quick': [{'animals': 1, 'slices': 50, 'layout': 'both', 'exclusion_density': 0.0},
+              {'animals': 3, 'slices': 50, 'layout': 'split', 'exclusion_density': 0.2},
+              {'animals': 5, 'slices': 80, 'layout': 'mixed', 'exclusion_density': 0.5}],
+    'full':  [{'animals': 1, 'slices': 50, 'layout': 'both', 'exclusion_density': 0.0},
+              {'animals': 10, 'slices': 150, 'layout': 'split', 'exclusion_density': 0.2},
+              {'animals': 50, 'slices': 300, 'layout': 'mixed', 'exclusion_density': 0.5},
+              {'animals': 500, 'slices': 50, 'layout': 'mixed', 'exclusion_density': 0.1},
+              {'animals': 500, 'slices': 300, 'layout': 'both', 'exclusion_density': 1.0}]}
+
+# Stages of the pipeline, in the order they are run
+STAGES = ['import_txt_file_as_dataframe', 'find_regions_and_classes_in_slice', 'sum_cell_counts', 'exclude_regions',
+          'sum_slices', 'normalization', 'averaging']
+
+#%%
+def make_synthetic_slice(ontology, hemispheres, rng, marker_panel=None, fraction_of_leaves=0.3):
+    '''
+    Generate the table of one synthetic slice, as exported by QuPath.
+    A random fraction of the leaf regions is present in every hemisphere, together with
+    all their parent regions. The counts of a parent region include its subregions.
+    '''
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    index = ontology.index
+    num_regions = len(index['acronyms'])
+    is_leaf = index['end'] == np.arange(num_regions) + 1
+    class_columns = marker_panel['class_columns']
+
+    tables = []
+    for hemi in hemispheres:
+        # Present regions: random leaves and all their ancestors
+        leaves = np.flatnonzero(is_leaf & (rng.random(num_regions) < fraction_of_leaves))
+        ancestors = index['ancestors'][leaves]
+        present = np.zeros(num_regions, dtype=bool)
+        present[ancestors[ancestors >= 0]] = True
+
+        # Counts of the leaves, summed up to their parents
+        counts = np.zeros((num_regions, len(class_columns) + 1))
+        counts[leaves, :-1] = rng.poisson(rng.gamma(0.3, 2.0, size=(len(leaves), 1)),
+                                          size=(len(leaves), len(class_columns)))
+        counts[leaves, -1] = rng.gamma(2.0, 5e4, size=len(leaves))
+        ids = np.flatnonzero(present)
+        counts = roll_up_counts(counts, is_leaf & present, ids, index, counts_include_subregions=False)
+
+        table = pd.DataFrame(counts[:, :-1].astype(np.int64), columns=class_columns)
+        table.insert(0, 'Num Detections', table.sum(axis=1) + rng.poisson(50, size=len(ids)))
+        table.insert(0, 'Class', [hemi + ': ' + index['acronyms'][i] for i in ids])
+        table.insert(0, 'Name', [ontology.names[i] for i in ids])
+        table['DAPI: DAPI area um^2'] = counts[:, -1]
+        tables.append(table)
+
+    # The full slice is one region called 'Root', without class
+    table = pd.concat(tables, ignore_index=True)
+    whole_slice = table[table['Class'].str.endswith(': root')].sum(numeric_only=True).to_frame().T
+    whole_slice = whole_slice.astype(table[whole_slice.columns].dtypes.to_dict())
+    whole_slice.insert(0, 'Class', np.nan)
+    whole_slice.insert(0, 'Name', 'Root')
+    
+    return pd.concat([whole_slice, table], ignore_index=True)[table.columns]
+
+#%%
+def make_synthetic_animal(root, animal, ontology, num_slices, layout, exclusion_density, rng, marker_panel=None):
+    '''
+    Write the _regions.txt files and RegionsToExclude.csv of a synthetic animal in root.
+    '''
+    input_path = os.path.join(root, animal, 'results')
+    os.makedirs(input_path, exist_ok=True)
+    index = ontology.index
+
+    exclusions = []
+    for s in range(num_slices):
+        img_name = 'Image_%03d.vsi - 10x_01' % s
+        split = layout == 'split' or (layout == 'mixed' and rng.random() < 0.5)
+        files = {img_name + '_LEFT': ['Left'], img_name + '_RIGHT': ['Right']} if split \
+                else {img_name: ['Left', 'Right']}
+
+        for fname, hemispheres in files.items():
+            table = make_synthetic_slice(ontology, hemispheres, rng, marker_panel)
+            table.insert(0, 'Image Name', img_name)
+            table.to_csv(os.path.join(input_path, fname + '_regions.txt'), sep='\t', index=False)
+
+            # Exclude up to 3 regions that do not overlap, from the regions present in the slice
+            to_exclude = []
+            if rng.random() < exclusion_density:
+                candidates = [label for label in table['Class'].dropna()
+                              if index['depth'][index['ids'][find_region_abbreviation(label)]] >= 3]
+                for label in rng.permutation(candidates)[:20]:
+                    region_id = index['ids'][find_region_abbreviation(label)]
+                    other_ids = [index['ids'][find_region_abbreviation(other)] for other in to_exclude]
+                    if all(not(o <= region_id < index['end'][o]) and not(region_id <= o < index['end'][region_id])
+                           for o in other_ids):
+                        to_exclude.append(label)
+                    if len(to_exclude) == 3:
+                        break
+            exclusions.append({'Image Name': fname + '_regions.txt',
+                               'Regions to Exclude (Regions may not overlap!)': '/ '.join(to_exclude) or None})
+
+    pd.DataFrame(exclusions).to_csv(os.path.join(root, animal, 'RegionsToExclude.csv'), index=False)
+
+#%%
+@contextlib.contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def run_pipeline(root, animal_list, tracers, ontology, marker_panel=None):
+    '''
+    Run the analysis pipeline on the animals in root (like collect_and_analyze_cell_counts,
+    without caching and plotting), and time every stage (see STAGES). The row names of
+    every file are parsed once, and reused to exclude regions (like load_slice).
+    '''
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    index = ontology.index
+    timings = {}
+    counters = {'loaded_slices': 0, 'rows': 0}
+    hemispheres = HEMISPHERES + ['Sum']
+    results = pd.DataFrame(np.nan, index=ontology.regions.keys(),
+                           columns=pd.MultiIndex.from_product([tracers, animal_list, hemispheres]))
+
+    for animal in animal_list:
+        input_path = os.path.join(root, animal, 'results')
+        exclude_dict = list_regions_to_exclude(os.path.join(root, animal, 'RegionsToExclude.csv'))
+        file_names = os.listdir(input_path)
+
+        df_list = []
+        for f in get_image_names_in_folder(input_path):
+            hemi_files = [(f + '_LEFT_regions.txt', 'Left'), (f + '_RIGHT_regions.txt', 'Right'),
+                          (f + '_regions.txt', 'Both')]
+            dfs = []
+            labels = []
+            regs_to_exclude = []
+            for fname, hemi in hemi_files:
+                if fname not in file_names:
+                    continue
+                with timed(timings, 'import_txt_file_as_dataframe'):
+                    data,img_name,data_labels = import_txt_file_as_dataframe(os.path.join(input_path, fname), hemi,
+                                                                             return_labels=True)
+                with timed(timings, 'find_regions_and_classes_in_slice'):
+                    find_regions_and_classes_in_slice(data, data_labels)
+                with timed(timings, 'sum_cell_counts'):
+                    dfs.append(sum_cell_counts(data, marker_panel))
+                    labels.append(select_region_labels(data_labels, data['DAPI: DAPI area um^2'].to_numpy() > 0))
+                regs_to_exclude = regs_to_exclude + exclude_dict[fname]
+                counters['rows'] += len(data)
+            df = pd.concat(dfs) if len(dfs) > 1 else dfs[0]
+            with timed(timings, 'exclude_regions'):
+                df_list.append(exclude_regions(df, regs_to_exclude, ontology.edges, ontology.tree, index,
+                                               concat_region_labels(labels)))
+            counters['loaded_slices'] += 1
+
+        with timed(timings, 'sum_slices'):
+            brain_df = sum_slices(df_list, index)
+        with timed(timings, 'normalization'):
+            norm_cell_counts = normalize_all_cell_counts(brain_df, tracers)
+            store_animal_results(results, animal, {t: norm_cell_counts[t] for t in tracers}, tracers, hemispheres)
+
+    with timed(timings, 'averaging'):
+        average_cell_counts_over_animals(results.swaplevel(axis=1), tracers)
+
+    return timings,counters
+
+def run_baseline_pipeline(root, animal_list, tracers, ontology, helpers):
+    '''
+    Time the pipeline of the original readCSV_helpers.py (helpers, see load_helpers_at_commit), 
+    like its collect_and_analyze_cell_counts without plotting and saving. 
+    The same stages are timed as in run_pipeline (only reading the exclusion files is not timed,
+    on both sides).
+    '''
+    timings = {}
+    counters = {'loaded_slices': 0, 'rows': 0}
+    hemispheres = ['Left', 'Right', 'Sum']
+    results = pd.DataFrame(np.nan, index=ontology.regions.keys(),
+                           columns=pd.MultiIndex.from_product([tracers, animal_list, hemispheres]))
+
+    for animal in animal_list:
+        input_path = os.path.join(root, animal, 'results')
+        # The exclusion files are read by the current parser (not timed), which also reads quoted fields
+        exclude_dict = list_regions_to_exclude(os.path.join(root, animal, 'RegionsToExclude.csv'))
+        file_names = os.listdir(input_path)
+
+        df_list = []
+        for f in helpers.get_image_names_in_folder(input_path):
+            hemi_files = [(f + '_LEFT_regions.txt', 'Left'), (f + '_RIGHT_regions.txt', 'Right'),
+                          (f + '_regions.txt', 'Both')]
+            datas = []
+            regs_to_exclude = []
+            for fname, hemi in hemi_files:
+                if fname not in file_names:
+                    continue
+                with timed(timings, 'import_txt_file_as_dataframe'):
+                    data,img_name = helpers.import_txt_file_as_dataframe(os.path.join(input_path, fname), hemi)
+                datas.append(data)
+                regs_to_exclude = regs_to_exclude + exclude_dict[fname]
+                counters['rows'] += len(data)
+            data = pd.concat(datas) if len(datas) > 1 else datas[0]
+            with timed(timings, 'find_regions_and_classes_in_slice'):
+                helpers.find_regions_and_classes_in_slice(data)
+            with timed(timings, 'sum_cell_counts'):
+                df = helpers.sum_cell_counts(data)
+            with timed(timings, 'exclude_regions'):
+                df_list.append(helpers.exclude_regions(df, regs_to_exclude, ontology.edges, ontology.tree))
+            counters['loaded_slices'] += 1
+
+        with timed(timings, 'sum_slices'):
+            brain_df = pd.concat(df_list)
+            brain_df = brain_df.groupby(brain_df.index, axis=0).sum()
+        with timed(timings, 'normalization'):
+            for t in tracers:
+                normalized_cell_counts = helpers.normalize_cell_counts(brain_df, t)
+                for region in normalized_cell_counts.index.to_list():
+                    results.loc[region, (t,animal)].update(normalized_cell_counts.loc[region])
+
+    with timed(timings, 'averaging'):
+        helpers.average_cell_counts_over_animals(results.swaplevel(axis=1), tracers)
+
+    return timings,counters
+
+#%%
+def load_helpers_at_commit(commit):
+    '''
+    Import readCSV_helpers.py as it was at another commit (e.g. the baseline), 
+    to time it on the same synthetic cohorts (see run_benchmark).
+    '''
+    folder = os.path.dirname(os.path.abspath(__file__))
+    source = subprocess.run(['git', 'show', commit + ':PythonScripts/readCSV_helpers.py'],
+                            capture_output=True, text=True, check=True, cwd=folder).stdout
+    path = os.path.join(tempfile.mkdtemp(prefix='abba_benchmark_'), 'readCSV_helpers_%s.py' % commit)
+    with open(path, 'w') as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location('readCSV_helpers_' + commit, path)
+    helpers = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(helpers)
+    helpers.commit = commit
+    return helpers
+
+#%%
+def get_environment():
+    '''
+    Describe the commit and versions the benchmark ran on.
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'matplotlib': matplotlib.__version__,
+            'machine': platform.platform()}
+
+def run_benchmark(scenarios, path_to_onotlogy_pickle, seed=0, marker_panel=None, helpers=None):
+    '''
+    Generate a synthetic cohort for every scenario (in a temporary folder),
+    and time the pipeline on it. Generating the cohorts is not timed.
+    If helpers (see load_helpers_at_commit) is given, the pipeline of that 
+    readCSV_helpers.py is timed instead (with the default marker panel).
+    '''
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    ontology = get_ontology(path_to_onotlogy_pickle)
+    rng = np.random.default_rng(seed)
+
+    environment = get_environment()
+    if helpers is not None:
+        environment['commit'] = subprocess.run(['git', 'rev-parse', helpers.commit], capture_output=True, text=True,
+                                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    benchmark = {'environment': environment, 'seed': seed, 'scenarios': []}
+    for scenario in scenarios:
+        root = tempfile.mkdtemp(prefix='abba_benchmark_')
+        try:
+            animal_list = ['animal_%03d' % a for a in range(scenario['animals'])]
+            for animal in animal_list:
+                make_synthetic_animal(root, animal, ontology, scenario['slices'], scenario['layout'],
+                                      scenario['exclusion_density'], rng, marker_panel)
+            start = time.perf_counter()
+            if helpers is None:
+                timings,counters = run_pipeline(root, animal_list, marker_panel['tracers'], ontology, marker_panel)
+            else:
+                timings,counters = run_baseline_pipeline(root, animal_list, marker_panel['tracers'], ontology, helpers)
+            total = time.perf_counter() - start
+        finally:
+            shutil.rmtree(root)
+
+        benchmark['scenarios'].append({**scenario, **counters, 'total': total,
+                                       'stages': {stage: timings.get(stage, 0.0) for stage in STAGES}})
+        print('%(animals)d animals x %(slices)d slices (%(layout)s, exclusions %(exclusion_density).1f): ' % scenario
+              + '%.2f s' % total)
+
+    return benchmark
+
+#%%
+def compare_benchmarks(path_to_old_json, path_to_new_json):
+    '''
+    Print the ratio of the stage timings (new / old) of two benchmarks, per scenario.
+    Ratios above 1 mean the new commit is slower.
+    '''
+    with open(path_to_old_json, 'r') as f:
+        old = json.load(f)
+    with open(path_to_new_json, 'r') as f:
+        new = json.load(f)
+
+    key = lambda s: (s['animals'], s['slices'], s['layout'], s['exclusion_density'])
+    old_scenarios = {key(s): s for s in old['scenarios']}
+    rows = {}
+    for scenario in new['scenarios']:
+        if key(scenario) not in old_scenarios:
+            continue
+        previous = old_scenarios[key(scenario)]
+        ratios = {stage: scenario['stages'][stage] / previous['stages'][stage] 
+                  if previous['stages'][stage] > 0 else np.nan for stage in STAGES}
+        ratios['total'] = scenario['total'] / previous['total']
+        rows['%d x %d %s %.1f' % key(scenario)] = ratios
+
+    comparison = pd.DataFrame(rows).T
+    print('New (%s) / old (%s):' % (new['environment']['commit'], old['environment']['commit']))
+    for label, benchmark in [('New', new), ('Old', old)]:
+        environment = benchmark['environment']
+        print('%s: python %s, numpy %s, pandas %s, matplotlib %s (%s)' % 
+              (label, environment['python'], environment['numpy'], environment['pandas'], 
+               environment.get('matplotlib'), environment['machine']))
+    print(comparison.round(2).to_string())
+
+    return comparison
+
+#%%
+def save_benchmark(benchmark, output_folder, profile):
+    '''
+    Save the timings of a benchmark as JSON, named after the profile and the commit.
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    commit = benchmark['environment']['commit'] or 'unknown'
+    output_file = os.path.join(output_folder, 'benchmark_%s_%s_%s.json' %
+                               (profile, commit[:8], time.strftime('%Y%m%d-%H%M%S')))
+    with open(output_file, 'w') as f:
+        json.dump(benchmark, f, indent=2)
+    print('Timings are saved to ' + output_file)
+    return output_file
+
+#%% -------------------------------- START SCRIPT ----------------------------
+# ============================================================================
+
+if __name__ == '__main__':
+    if baseline_commit is not None:
+        print('Baseline (' + baseline_commit + '):')
+        baseline = run_benchmark(SCENARIOS[profile], path_to_onotlogy_pickle, seed=seed, 
+                                 helpers=load_helpers_at_commit(baseline_commit))
+        baseline_file = save_benchmark(baseline, output_folder, profile)
+    
+    benchmark = run_benchmark(SCENARIOS[profile], path_to_onotlogy_pickle, seed=seed)
+    output_file = save_benchmark(benchmark, output_folder, profile)
+
+    # Compare with the baseline, or with another benchmark, e.g.:
+    # compare_benchmarks('benchmark_results/benchmark_quick_<old commit>_<date>.json', output_file)
+    if baseline_commit is not None:
+        compare_benchmarks(baseline_file, output_file)
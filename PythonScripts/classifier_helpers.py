@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 19:40:12 2026
+
+Evaluate the QuPath object classifiers (OpenCV RTrees, e.g. RabiesClassifier.json)
+in Python, on the measurements of the per-detection exports
+(see 2. ExportABBACellCountResults.groovy). This allows to try other classifiers
+or thresholds on a whole cohort, without running QuPath again.
+
+The trees of a classifier are compiled into flat arrays, and all trees are
+evaluated at once for a chunk of cells: every step moves all (cell, tree) pairs
+one level down.
+
+Usage (in 1. FindCellClasses.groovy, set removeRabies = false, such that
+all Rabies+ cells are exported):
+    classifier = load_rtrees_classifier('../RabiesClassifier.json')
+    marker_panel = make_marker_panel(MARKERS, make_detection_filter(classifier))
+    results = collect_and_analyze_cell_counts(..., marker_panel=marker_panel)
+
+@author: lukasvandenheuvel
+"""
+
+import json
+import functools
+import numpy as np
+
+from readCSV_helpers import detection_class_masks
+
+#%%
+def load_rtrees_classifier(path_to_classifier):
+    '''
+    Load a QuPath object classifier (OpenCVMLClassifier with RTrees) from its json file,
+    and compile its trees into flat arrays.
+
+    Output
+    ------
+        classifier (dict)
+        Dictionary with the following keys:
+        'measurements'  (list)     names of the measurements the classifier uses, in the order of the features.
+        'class_names'   (list)     QuPath class names, in the order of the class indices (e.g. ['Keep', 'Remove']).
+        'missing_subst' (np array) value of every feature that is used for missing (NaN) measurements.
+        'feature'       (np array) feature of the split of every node.
+        'threshold'     (np array) threshold of the split of every node (float32, like OpenCV).
+        'inversed'      (np array) True if values above the threshold go to the left child.
+        'left'          (np array) left child of every node (-1 for leaves).
+        'right'         (np array) right child of every node (-1 for leaves).
+        'class_idx'     (np array) class index of every node in class_names (the vote of a leaf).
+        'roots'         (np array) root node of every tree.
+        'max_depth'     (int)      depth of the deepest leaf.
+    '''
+    with open(path_to_classifier, 'r') as f:
+        classifier_json = json.load(f)
+    if classifier_json['classifier']['class'] != 'RTrees':
+        raise ValueError('Only RTrees classifiers are supported, not ' + classifier_json['classifier']['class'] + '!')
+    statmodel = classifier_json['classifier']['statmodel']
+    var_idx = statmodel.get('var_idx', list(range(statmodel['var_count'])))
+    # The leaves store the index of their class in class_labels, and class_labels
+    # the index of the class in pathClasses (the response of the training data)
+    class_labels = statmodel['class_labels']
+
+    feature, threshold, inversed, left, right, parents, class_idx, depth, roots = [], [], [], [], [], [], [], [], []
+    for tree in statmodel['trees']:
+        # The nodes are stored depth-first: the left child of an internal node
+        # follows it directly, the right child follows the subtree of the left child
+        # (as in cv::ml::DTrees::readTree).
+        parent = -1
+        for node in tree['nodes']:
+            node_id = len(feature)
+            left.append(-1)
+            right.append(-1)
+            parents.append(parent)
+            class_idx.append(class_labels[node['norm_class_idx']])
+            depth.append(node['depth'])
+            if parent < 0:
+                roots.append(node_id)
+            elif left[parent] < 0:
+                left[parent] = node_id
+            else:
+                right[parent] = node_id
+
+            splits = node.get('splits', [])
+            if len(splits) > 0:
+                split = splits[0] # the other splits are surrogates
+                if not('le' in split or 'ge' in split):
+                    raise ValueError('Categorical splits are not supported!')
+                feature.append(var_idx[split['var']])
+                threshold.append(split['le'] if 'le' in split else split['ge'])
+                inversed.append('ge' in split)
+                parent = node_id
+            else:
+                feature.append(0)
+                threshold.append(0.0)
+                inversed.append(False)
+                # Go up to the first parent without right child
+                while parent >= 0 and right[parent] >= 0:
+                    parent = parents[parent]
+
+    classifier = {'measurements': classifier_json['featureExtractor']['measurements'],
+                  'class_names': [path_class['name'] for path_class in classifier_json['pathClasses']],
+                  'missing_subst': np.array(statmodel['missing_subst'][:len(var_idx)], dtype=np.float32),
+                  'feature': np.array(feature, dtype=np.int64),
+                  'threshold': np.array(threshold, dtype=np.float32),
+                  'inversed': np.array(inversed, dtype=bool),
+                  'left': np.array(left, dtype=np.int64),
+                  'right': np.array(right, dtype=np.int64),
+                  'class_idx': np.array(class_idx, dtype=np.int64),
+                  'roots': np.array(roots, dtype=np.int64),
+                  'max_depth': int(max(depth))}
+
+    return classifier
+
+#%%
+def predict_rtrees_votes(classifier, features, chunk_size=100000):
+    '''
+    Evaluate all trees of a classifier (see load_rtrees_classifier) on a set of cells.
+
+    Inputs
+    ------
+        classifier (dict)
+        Classifier from load_rtrees_classifier.
+        features (np array)
+        Measurements with shape (cells, features), in the order of classifier['measurements'].
+        chunk_size (int)
+        Number of cells that are evaluated at once (limits the memory use).
+
+    Output
+    ------
+        votes (np array)
+        Number of trees that vote for every class, with shape (cells, classes).
+    '''
+    features = np.asarray(features, dtype=np.float32)
+    features = np.where(np.isnan(features), classifier['missing_subst'], features)
+    is_leaf = classifier['left'] < 0
+    num_classes = max(len(classifier['class_names']), classifier['class_idx'].max() + 1)
+    votes = np.zeros((len(features), num_classes), dtype=np.int64)
+
+    for start in range(0, len(features), chunk_size):
+        chunk = features[start:start+chunk_size]
+        nodes = np.broadcast_to(classifier['roots'], (len(chunk), len(classifier['roots']))).copy()
+        for step in range(classifier['max_depth']):
+            values = np.take_along_axis(chunk, classifier['feature'][nodes], axis=1)
+            go_left = (values <= classifier['threshold'][nodes]) != classifier['inversed'][nodes]
+            next_nodes = np.where(go_left, classifier['left'][nodes], classifier['right'][nodes])
+            nodes = np.where(is_leaf[nodes], nodes, next_nodes)
+
+        # Count the votes of the leaves per class
+        leaf_classes = classifier['class_idx'][nodes]
+        for c in range(num_classes):
+            votes[start:start+chunk_size, c] = (leaf_classes == c).sum(axis=1)
+
+    return votes
+
+def predict_rtrees(classifier, features, threshold=None, positive_class=None, chunk_size=100000):
+    '''
+    Predict the class index of every cell (see predict_rtrees_votes).
+    By default, the class with most votes wins (ties go to the lowest class index, like OpenCV).
+    To re-threshold the classifier, give a positive_class (e.g. 'Remove') and a threshold:
+    cells get the positive class if the fraction of trees that vote for it is above
+    the threshold, and the class with most other votes otherwise.
+    '''
+    votes = predict_rtrees_votes(classifier, features, chunk_size)
+    if threshold is None:
+        return np.argmax(votes, axis=1)
+
+    positive = classifier['class_names'].index(positive_class)
+    other_votes = votes.copy()
+    other_votes[:, positive] = -1
+    fraction = votes[:, positive] / votes.sum(axis=1)
+    return np.where(fraction > threshold, positive, np.argmax(other_votes, axis=1))
+
+def detection_features(detections, classifier):
+    '''
+    Collect the measurements of a classifier from a table of detections
+    (see readCSV_helpers.iter_detections) into a (cells, features) array.
+    '''
+    missing = [m for m in classifier['measurements'] if m not in detections.columns]
+    if len(missing) > 0:
+        raise ValueError('The detections do not have the measurements ' + str(missing) +
+                         ' (export them with 2. ExportABBACellCountResults.groovy)!')
+    return detections[classifier['measurements']].to_numpy(dtype=np.float32)
+
+#%%
+def filter_detections_with_classifier(detections, marker_panel, classifier, marker='Rabies', remove_class='Remove',
+                                      threshold=None):
+    '''
+    Detection classifier (see readCSV_helpers.make_marker_panel) that removes a marker
+    from the cells that an object classifier assigns to remove_class, like
+    filterDetectionsBasedOnClassfier in 1. FindCellClasses.groovy.
+    Only cells positive for the marker are classified. See predict_rtrees for the threshold.
+    Returns the class bitmask of every detection.
+
+    Note that this only approximates 1. FindCellClasses.groovy: QuPath classifies the raw
+    Rabies detections before they are merged into cells, while the exported measurements
+    of a merged cell are those of its first detection.
+    '''
+    masks = detection_class_masks(detections, marker_panel)
+    marker_bit = 1 << marker_panel['markers'].index(marker)
+    positive = np.flatnonzero(masks & marker_bit)
+    if len(positive) == 0:
+        return masks
+
+    features = detection_features(detections.iloc[positive], classifier)
+    predicted = predict_rtrees(classifier, features, threshold=threshold, positive_class=remove_class)
+    remove = positive[predicted == classifier['class_names'].index(remove_class)]
+    masks[remove] &= ~marker_bit
+
+    return masks
+
+def make_detection_filter(classifier, marker='Rabies', remove_class='Remove', threshold=None):
+    '''
+    Make a detection classifier for make_marker_panel, that filters the cells
+    positive for marker with the classifier (see filter_detections_with_classifier).
+    The result can be sent to worker processes, to analyze animals in parallel.
+    '''
+    return functools.partial(filter_detections_with_classifier, classifier=classifier, marker=marker,
+                             remove_class=remove_class, threshold=threshold)
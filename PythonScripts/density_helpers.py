@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 20:31:55 2026
+
+Voxel-wise cell densities in the atlas (Allen CCFv3), from the atlas coordinates
+of the detections (columns Atlas_X, Atlas_Y, Atlas_Z in mm, exported by
+2. ExportABBACellCountResults.groovy).
+
+The cells of every tracer are binned into a 3D grid at atlas resolution,
+stored as a memory-mapped .npy volume per animal and tracer. The detections
+are read chunk by chunk, and the volumes are updated in place, so memory use
+does not depend on the number of cells or the size of the grid.
+
+Usage:
+    grid = make_atlas_grid(voxel_size_um=25)
+    paths = map_animal_density(root, animal, grid, normalization='dapi')
+    volume = load_density_volume(paths['RAB'])
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import json
+import numpy as np
+
+from readCSV_helpers import MARKER_PANEL, list_detection_files, iter_detections, detection_class_masks
+from profiling_helpers import stage, count
+
+#%%
+# Columns with the atlas coordinates of the detections (in mm)
+ATLAS_COLUMNS = ['Atlas_X', 'Atlas_Y', 'Atlas_Z']
+
+# Size of the Allen CCFv3 along Atlas_X, Atlas_Y and Atlas_Z in mm. In ABBA, the atlas is
+# sliced coronally along Z: X is left-right (ML), Y is dorsal-ventral (DV) and Z is
+# anterior-posterior (AP). Note that this differs from the Allen SDK order (AP, DV, ML).
+ATLAS_SIZE_MM = (11.4, 8.0, 13.2)
+
+def make_atlas_grid(voxel_size_um=25, atlas_size_mm=ATLAS_SIZE_MM):
+    '''
+    Define a voxel grid over the atlas. With the default voxel size of 25 um,
+    the grid has the resolution of the Allen CCFv3 (456 x 320 x 528 voxels, ML x DV x AP).
+
+    Output
+    ------
+        grid (dict)
+        Dictionary with the keys 'shape' (number of voxels along every axis),
+        'voxel_size_um' and 'voxel_volume_mm3'.
+    '''
+    shape = tuple(int(round(size * 1000 / voxel_size_um)) for size in atlas_size_mm)
+    grid = {'shape': shape,
+            'voxel_size_um': voxel_size_um,
+            'voxel_volume_mm3': (voxel_size_um / 1000)**3}
+    return grid
+
+def coordinates_to_voxels(coordinates, grid):
+    '''
+    Bin atlas coordinates (in mm, shape (cells, 3)) into the voxels of the grid,
+    like np.histogramdd with uniform bins, but without making a histogram of the whole grid.
+    Returns the flat voxel index of every cell, and a mask of the cells inside the grid.
+    '''
+    voxels = np.floor(np.asarray(coordinates, dtype=float) * 1000 / grid['voxel_size_um'])
+    inside = np.all((voxels >= 0) & (voxels < grid['shape']), axis=1)
+    flat = np.ravel_multi_index(voxels[inside].astype(np.int64).T, grid['shape'])
+    return flat,inside
+
+#%%
+def count_cells_in_volumes(detection_chunks, grid, volumes, marker_panel=None):
+    '''
+    Add the cells of every tracer to its volume, while streaming over the detections.
+
+    Inputs
+    ------
+        detection_chunks (iterable)
+        Dataframes with the atlas coordinates (ATLAS_COLUMNS) and the columns used by the
+        detection classifier (see readCSV_helpers.iter_detections).
+        grid (dict)
+        Voxel grid (see make_atlas_grid).
+        volumes (dict)
+        Tracers as keys, and their volume (e.g. a memory-mapped array with the shape of the grid) as value.
+        The cell counts are added to the volumes in place.
+        marker_panel (dict)
+        See readCSV_helpers.make_marker_panel. The classes of the detections are found
+        by its 'detection_classifier' (detection_class_masks by default).
+
+    Output
+    ------
+        totals (dict)
+        Tracers as keys, and the number of cells of the tracer as value
+        (including the cells outside the grid).
+        outside (dict)
+        Tracers as keys, and the number of cells of the tracer outside the grid as value
+        (these are not added to the volumes).
+    '''
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    classifier = marker_panel.get('detection_classifier') or detection_class_masks
+    tracer_masks = dict(zip(marker_panel['tracers'], marker_panel['tracer_masks']))
+    flat_volumes = {tracer: volume.reshape(-1) for tracer, volume in volumes.items()}
+    totals = {tracer: 0 for tracer in volumes}
+    outside = {tracer: 0 for tracer in volumes}
+
+    for detections in detection_chunks:
+        masks = np.asarray(classifier(detections, marker_panel), dtype=np.int64)
+        flat,inside = coordinates_to_voxels(detections[ATLAS_COLUMNS].to_numpy(dtype=float), grid)
+        masks_inside = masks[inside]
+        for tracer, flat_volume in flat_volumes.items():
+            is_tracer = (masks_inside & tracer_masks[tracer]) == tracer_masks[tracer]
+            num_cells = int(((masks & tracer_masks[tracer]) == tracer_masks[tracer]).sum())
+            totals[tracer] += num_cells
+            outside[tracer] += num_cells - int(is_tracer.sum())
+            # Only the voxels with cells are updated (a bincount over the full grid would
+            # allocate the whole volume for every chunk). The counts are cast to the
+            # type of the volume (e.g. uint32), which += with fancy indexing does not do.
+            voxels,cells = np.unique(flat[is_tracer], return_counts=True)
+            np.add.at(flat_volume, voxels, cells.astype(flat_volume.dtype))
+        count('detections', len(detections))
+
+    return totals,outside
+
+#%%
+def normalize_density_volume(counts, density, factor, chunk_size=32):
+    '''
+    Write counts * factor into density, in chunks of chunk_size planes
+    along the first axis, such that memory-mapped volumes are not loaded at once.
+    '''
+    for start in range(0, counts.shape[0], chunk_size):
+        density[start:start+chunk_size] = counts[start:start+chunk_size] * factor
+
+def density_factor(normalization, grid, total_cells, brainwide_area=None):
+    '''
+    Factor to convert the cell counts of a voxel into a density:
+    'volume'    cells per mm^3 of the voxel.
+    'dapi'      cells per voxel, per mm^2 of DAPI area in the whole brain (brainwide_area in um^2,
+                like the 'area' of the root in normalize_cell_counts). This corrects for the
+                amount of tissue that was imaged in every animal.
+    'brainwide' fraction of all cells of the tracer in every voxel
+                (like the brainwide cell counts in normalize_cell_counts).
+    'counts'    no normalization.
+    '''
+    if normalization == 'volume':
+        return 1 / grid['voxel_volume_mm3']
+    elif normalization == 'dapi':
+        if brainwide_area is None or not(brainwide_area > 0):
+            raise ValueError('The brainwide DAPI area is needed to normalize by DAPI area!')
+        return 1e6 / brainwide_area
+    elif normalization == 'brainwide':
+        return 1 / total_cells if total_cells > 0 else np.nan
+    elif normalization == 'counts':
+        return 1
+    else:
+        raise ValueError('Normalization should be "volume", "dapi", "brainwide" or "counts", not "' +
+                         str(normalization) + '"!')
+
+#%%
+def map_animal_density(root, animal, grid=None, tracers=None, marker_panel=None, normalization='volume',
+                       brainwide_area=None, chunksize=None):
+    '''
+    Make the voxel-wise cell counts and densities of one animal, from the
+    per-detection exports in its results folder. The volumes are saved in
+    the folder results_python/density of the animal:
+    <animal>_<tracer>_counts.npy (uint32) and <animal>_<tracer>_density.npy (float32),
+    and <animal>_density.json with the grid, the normalization, the number of cells and the
+    number of cells outside the grid (which are not mapped).
+    Note that the regions to exclude (RegionsToExclude.csv) are not applied.
+
+    Inputs
+    ------
+        root, animal (str)
+        The detections are read from root/animal/results.
+        grid (dict)
+        Voxel grid (see make_atlas_grid). Defaults to the Allen CCFv3 at 25 um.
+        tracers (list)
+        Tracers to map (all tracers of the marker panel if None).
+        marker_panel (dict)
+        See readCSV_helpers.make_marker_panel.
+        normalization (str)
+        See density_factor. For 'dapi', give the brainwide DAPI area of the
+        animal in um^2 (e.g. split_hemispheres(brain_df['area']).loc['root', 'Sum'],
+        with brain_df from analyze_animal).
+        chunksize (int)
+        Number of detections to read at once (by default one exported chunk at a time).
+
+    Output
+    ------
+        paths (dict)
+        Tracers as keys, and the path to their density volume as value (see load_density_volume).
+    '''
+    if grid is None:
+        grid = make_atlas_grid()
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    if tracers is None:
+        tracers = marker_panel['tracers']
+
+    input_path = os.path.join(root, animal, 'results')
+    output_path = os.path.join(root, animal, 'results_python', 'density')
+    os.makedirs(output_path, exist_ok=True)
+
+    paths = []
+    for fname in sorted(os.listdir(input_path)):
+        if '_regions.txt' in fname:
+            paths += list_detection_files(os.path.join(input_path, fname))
+    if len(paths) == 0:
+        raise ValueError('Cannot find the detection exports of animal ' + animal + '!')
+
+    # Only read the columns we need (all columns if the detection classifier uses measurements)
+    columns = None
+    if marker_panel.get('detection_classifier') is None:
+        columns = ATLAS_COLUMNS + marker_panel['markers']
+
+    counts = {}
+    for tracer in tracers:
+        counts[tracer] = np.lib.format.open_memmap(os.path.join(output_path, animal + '_' + tracer + '_counts.npy'),
+                                                   mode='w+', dtype=np.uint32, shape=grid['shape'])
+    with stage('count_cells_in_volumes'):
+        totals,outside = count_cells_in_volumes(iter_detections(paths, columns, chunksize), grid, counts, marker_panel)
+    for tracer in tracers:
+        if outside[tracer] > 0:
+            print('WARNING: ' + str(outside[tracer]) + ' of ' + str(totals[tracer]) + ' ' + tracer +
+                  ' cells of ' + animal + ' are outside the atlas grid and were not mapped!')
+
+    density_paths = {}
+    with stage('normalize_density_volume'):
+        for tracer in tracers:
+            density_paths[tracer] = os.path.join(output_path, animal + '_' + tracer + '_density.npy')
+            density = np.lib.format.open_memmap(density_paths[tracer], mode='w+', dtype=np.float32, shape=grid['shape'])
+            factor = density_factor(normalization, grid, totals[tracer], brainwide_area)
+            normalize_density_volume(counts[tracer], density, factor)
+            counts[tracer].flush()
+            density.flush()
+            del density
+    del counts
+
+    with open(os.path.join(output_path, animal + '_density.json'), 'w') as f:
+        json.dump({'grid': {key: list(value) if isinstance(value, tuple) else value for key, value in grid.items()},
+                   'normalization': normalization,
+                   'brainwide_area': brainwide_area,
+                   'total_cells': totals,
+                   'cells_outside_grid': outside}, f)
+
+    return density_paths
+
+def load_density_volume(path, mmap=True):
+    '''
+    Load a volume saved by map_animal_density. By default the volume is
+    memory-mapped (read-only), such that only the voxels that are used are read.
+    '''
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+#%%
+def average_density_volumes(paths, output_file, chunk_size=32):
+    '''
+    Average the density volumes of several animals (e.g. of one tracer in a cohort) voxel by voxel,
+    in chunks of chunk_size planes, and save the mean as a memory-mapped .npy volume in output_file.
+    '''
+    volumes = [load_density_volume(path) for path in paths]
+    if len(volumes) == 0:
+        raise ValueError('No volumes to average!')
+    if any(volume.shape != volumes[0].shape for volume in volumes):
+        raise ValueError('The volumes have different shapes (were they made with the same grid?)')
+
+    mean = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float32, shape=volumes[0].shape)
+    for start in range(0, mean.shape[0], chunk_size):
+        mean[start:start+chunk_size] = np.mean([volume[start:start+chunk_size] for volume in volumes], axis=0)
+    mean.flush()
+
+    return mean
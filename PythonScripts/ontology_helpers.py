@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 10:12:41 2026
+
+Compiled index of the Allen brain ontology.
+The index numbers all regions in preorder (depth-first), such that
+the subregions of a region are a contiguous slice of the index,
+and "is region X a subregion of Y" is a constant-time check.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+import zipfile
+import functools
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+#%%
+def compile_ontology_index(edges):
+    '''
+    Compile the brain ontology into a set of arrays.
+    The regions get an integer id, which is their position in a preorder
+    (depth-first) walk through the tree, starting at the root.
+    Because of this numbering, all subregions of region i have the
+    ids i, i+1, ..., end[i]-1.
+
+    Inputs
+    ------
+        edges (dict)
+        Dictionary with all child regions as keys, and their parent as value.
+
+    Output
+    ------
+        ontology_index (dict)
+        Dictionary with the following keys:
+        'acronyms'  (list)     region acronyms, ordered by id.
+        'ids'       (dict)     region acronym -> id.
+        'acronym_index' (pandas index) 
+                               the acronyms as index, to look up the ids of many acronyms at once.
+        'parent'    (np array) id of the parent of each region (-1 for the root).
+        'depth'     (np array) depth of each region in the tree (0 for the root).
+        'end'       (np array) the subregions of region i have ids i until end[i] (exclusive).
+        'post'      (np array) postorder number of each region.
+        'ancestors' (np array) ancestors[i,d] is the ancestor of region i at depth d
+                               (-1 if d > depth[i]). ancestors[i,depth[i]] = i.
+        'ancestor_matrix' (scipy sparse matrix)
+                               Region x ancestor incidence matrix: entry (i,j) is 1
+                               if region j is a parent region of i (on any level).
+    '''
+
+    # Convert the edges into lists of children.
+    # The root has no parent: the pickled ontology contains an edge
+    # from the root to one of its descendants, which we skip.
+    children = {}
+    for child, parent in edges.items():
+        if child == 'root':
+            continue
+        if parent in children:
+            children[parent].append(child)
+        else:
+            children[parent] = [child]
+
+    # Walk through the tree depth-first. We use a stack instead of
+    # recursion; children are pushed in reverse to keep their original order.
+    acronyms = []
+    parent_list = []
+    depth_list = []
+    stack = [('root', -1, 0)]
+    while len(stack) > 0:
+        region, parent_id, depth = stack.pop()
+        region_id = len(acronyms)
+        acronyms.append(region)
+        parent_list.append(parent_id)
+        depth_list.append(depth)
+        for child in reversed(children.get(region, [])):
+            stack.append((child, region_id, depth+1))
+
+    num_regions = len(acronyms)
+    parent = np.array(parent_list, dtype=np.int64)
+    depth = np.array(depth_list, dtype=np.int64)
+
+    # Subtree sizes: walk the regions in reverse preorder, such that
+    # every child is visited before its parent.
+    size = np.ones(num_regions, dtype=np.int64)
+    for region_id in range(num_regions-1, 0, -1):
+        size[parent[region_id]] += size[region_id]
+    end = np.arange(num_regions) + size
+
+    # Postorder number: the number of regions that are finished
+    # before region i is finished.
+    post = end - 1 - depth
+
+    # Ancestor table. Row i contains the path from the root to region i.
+    ancestors = np.full((num_regions, depth.max()+1), -1, dtype=np.int64)
+    for region_id in range(num_regions):
+        if parent[region_id] >= 0:
+            ancestors[region_id] = ancestors[parent[region_id]]
+        ancestors[region_id, depth[region_id]] = region_id
+
+    # Sparse region x ancestor incidence matrix (a region is not its own ancestor).
+    region_ids, levels = np.nonzero(ancestors >= 0)
+    is_parent = levels < depth[region_ids]
+    ancestor_matrix = scipy.sparse.csr_matrix(
+        (np.ones(is_parent.sum(), dtype=np.int8),
+         (region_ids[is_parent], ancestors[region_ids[is_parent], levels[is_parent]])),
+        shape=(num_regions, num_regions))
+
+    ontology_index = {'acronyms': acronyms,
+                      'ids': {acronym: i for i, acronym in enumerate(acronyms)},
+                      'acronym_index': pd.Index(acronyms),
+                      'parent': parent,
+                      'depth': depth,
+                      'end': end,
+                      'post': post,
+                      'ancestors': ancestors,
+                      'ancestor_matrix': ancestor_matrix}
+
+    return ontology_index
+
+#%%
+def list_subregion_ids(region, ontology_index):
+    '''
+    Returns the ids of region and all its subregions (on all hierarchical levels).
+    '''
+    region_id = ontology_index['ids'][region]
+    return np.arange(region_id, ontology_index['end'][region_id])
+
+#%%
+def list_ancestor_ids(region, ontology_index):
+    '''
+    Returns the ids of all parent regions of region,
+    ordered from the direct parent up to the root.
+    '''
+    region_id = ontology_index['ids'][region]
+    depth = ontology_index['depth'][region_id]
+    return ontology_index['ancestors'][region_id, :depth][::-1]
+
+#%%
+def is_subregion(region, parent_region, ontology_index):
+    '''
+    Returns True if region lies within parent_region (on any hierarchical level).
+    A region is considered to be a subregion of itself.
+    '''
+    region_id = ontology_index['ids'][region]
+    parent_id = ontology_index['ids'][parent_region]
+    return bool(parent_id <= region_id < ontology_index['end'][parent_id])
+
+#%%
+def regions_at_level(level, ontology_index):
+    '''
+    Returns the ids of the regions at a depth of the ontology (0 for the root), 
+    and of the regions without subregions above that depth. Together they 
+    cover the whole brain, without overlap.
+    '''
+    depth = ontology_index['depth']
+    is_leaf = ontology_index['end'] == np.arange(len(depth)) + 1
+    return np.flatnonzero((depth == level) | (is_leaf & (depth < level)))
+
+#%%
+def roll_up_counts(counts, present, target_ids, ontology_index, counts_include_subregions=True):
+    '''
+    Aggregate region counts to the target regions, for all columns at once.
+    The counts are summed bottom-up over the parent array: regions are visited
+    from the deepest level to the root, and every level is added to its parents 
+    with one scatter-add.
+    
+    Inputs
+    ------
+        counts (np array)
+        Counts with shape (regions, columns), with a row for every ontology id.
+        
+        present (np array)
+        Boolean array, True for the regions that have counts.
+        
+        target_ids (np array)
+        Ids of the regions to aggregate to (e.g. from regions_at_level).
+        
+        counts_include_subregions (bool)
+        If True (like in the QuPath exports), the counts of a region already include
+        its subregions: a region only receives the counts of its subregions if 
+        it has no counts itself. If False, the counts of all subregions are added.
+        
+    Output
+    ------
+        rolled_up (np array)
+        Counts with shape (targets, columns). NaN for targets without counts in their subtree.
+    '''
+    parent = ontology_index['parent']
+    depth = ontology_index['depth']
+    present = np.asarray(present, dtype=bool)
+    summed = np.where(present[:, np.newaxis], counts, 0.0)
+    has_counts = present.copy()
+    
+    # Regions grouped by depth (parents have a smaller depth than their children)
+    by_depth = np.argsort(depth, kind='stable')
+    level_starts = np.searchsorted(depth[by_depth], np.arange(depth.max()+2))
+    for d in range(depth.max(), 0, -1):
+        regions = by_depth[level_starts[d]:level_starts[d+1]]
+        regions = regions[has_counts[regions]]
+        if counts_include_subregions:
+            regions = regions[~present[parent[regions]]]
+        np.add.at(summed, parent[regions], summed[regions])
+        has_counts[parent[regions]] = True
+    
+    rolled_up = summed[target_ids]
+    rolled_up[~has_counts[target_ids]] = np.nan
+    
+    return rolled_up
+
+#%%
+# Version of the compact ontology format (see Ontology.save)
+ONTOLOGY_FORMAT_VERSION = 1
+
+# Arrays stored in the compact ontology format, in the order of the checksum
+ONTOLOGY_ARRAYS = ['parent', 'acronyms', 'names', 'colors', 'structure_ids', 'st_levels']
+
+class Ontology:
+    '''
+    The Allen brain ontology, stored as arrays in preorder (depth-first) order:
+    'parent' holds the id of the parent of each region (-1 for the root), and 
+    'acronyms', 'names', 'colors', 'structure_ids' and 'st_levels' hold the
+    properties of each region. The dictionaries of the pickled ontology 
+    (edges, tree, regions) and the compiled index (see compile_ontology_index)
+    are made when they are first used.
+    Use get_ontology to load an ontology once per process.
+    '''
+    
+    def __init__(self, arrays, source_sha1=None):
+        self.parent = np.asarray(arrays['parent'], dtype=np.int64)
+        self.acronyms = [str(a) for a in arrays['acronyms']]
+        self.names = [str(n) for n in arrays['names']]
+        self.colors = [str(c) for c in arrays['colors']]
+        self.structure_ids = np.asarray(arrays['structure_ids'], dtype=np.int64)
+        self.st_levels = np.asarray(arrays['st_levels'], dtype=np.int64)
+        self.source_sha1 = source_sha1
+    
+    @classmethod
+    def from_json(cls, path_to_ontology_json):
+        '''
+        Build the ontology from AllenMouseBrainOntology.json, 
+        in one recursive pass through the hierarchy.
+        '''
+        with open(path_to_ontology_json, 'rb') as f:
+            content = f.read()
+        brain_atlas = json.loads(content)['msg'][0]
+        
+        arrays = {key: [] for key in ONTOLOGY_ARRAYS}
+        def walk(region, parent_id):
+            region_id = len(arrays['parent'])
+            arrays['parent'].append(parent_id)
+            arrays['acronyms'].append(region['acronym'])
+            arrays['names'].append(region['name'])
+            arrays['colors'].append(region['color_hex_triplet'])
+            arrays['structure_ids'].append(region['id'])
+            arrays['st_levels'].append(-1 if region['st_level'] is None else region['st_level'])
+            for child in region['children']:
+                walk(child, region_id)
+        walk(brain_atlas, -1)
+        
+        return cls(arrays, hashlib.sha1(content).hexdigest())
+    
+    @classmethod
+    def from_pickle_dict(cls, ontology_dict):
+        '''
+        Build the ontology from a pickled ontology dictionary 
+        (see saveAllenBrainAsPickle.ipynb). Colors, structure ids and levels are unknown.
+        '''
+        index = compile_ontology_index(ontology_dict['BrainOntologyEdges'])
+        regions = ontology_dict['BrainOntologyRegions']
+        num_regions = len(index['acronyms'])
+        arrays = {'parent': index['parent'],
+                  'acronyms': index['acronyms'],
+                  'names': [regions.get(acronym, acronym) for acronym in index['acronyms']],
+                  'colors': ['FFFFFF']*num_regions,
+                  'structure_ids': np.full(num_regions, -1),
+                  'st_levels': np.full(num_regions, -1)}
+        
+        return cls(arrays)
+    
+    def arrays(self):
+        return {'parent': self.parent,
+                'acronyms': np.array(self.acronyms, dtype=str),
+                'names': np.array(self.names, dtype=str),
+                'colors': np.array(self.colors, dtype=str),
+                'structure_ids': self.structure_ids,
+                'st_levels': self.st_levels}
+    
+    def checksum(self):
+        arrays = self.arrays()
+        sha1 = hashlib.sha1()
+        for key in ONTOLOGY_ARRAYS:
+            sha1.update(np.ascontiguousarray(arrays[key]).tobytes())
+        return sha1.hexdigest()
+    
+    def save(self, path):
+        '''
+        Save the ontology in a compact format (a .npz file with the arrays,
+        the format version, a checksum and the checksum of the source json).
+        '''
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, version=ONTOLOGY_FORMAT_VERSION, checksum=self.checksum(),
+                     source_sha1=self.source_sha1 or '', **self.arrays())
+        os.replace(path + '.tmp', path)
+    
+    @classmethod
+    def load(cls, path, source_sha1=None):
+        '''
+        Load an ontology saved with save. Returns None if the file has another 
+        format version, does not match its checksum, or was made from another
+        json file than source_sha1.
+        '''
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data['version']) != ONTOLOGY_FORMAT_VERSION:
+                    return None
+                ontology = cls({key: data[key] for key in ONTOLOGY_ARRAYS}, str(data['source_sha1']) or None)
+                checksum = str(data['checksum'])
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        if checksum != ontology.checksum():
+            return None
+        if source_sha1 is not None and ontology.source_sha1 != source_sha1:
+            return None
+        
+        return ontology
+    
+    @functools.cached_property
+    def ids(self):
+        return {acronym: i for i, acronym in enumerate(self.acronyms)}
+    
+    @functools.cached_property
+    def edges(self):
+        '''Dictionary with all child regions as keys, and their parent as value.'''
+        return {self.acronyms[i]: self.acronyms[p] for i, p in enumerate(self.parent) if p >= 0}
+    
+    @functools.cached_property
+    def tree(self):
+        '''Dictionary with parent regions as keys, and the list of their children as value.'''
+        tree = {}
+        for child, parent in self.edges.items():
+            if parent in tree:
+                tree[parent].append(child)
+            else:
+                tree[parent] = [child]
+        return tree
+    
+    @functools.cached_property
+    def regions(self):
+        '''Dictionary with the region acronyms as keys, and the full region names as value.'''
+        return dict(zip(self.acronyms, self.names))
+    
+    @functools.cached_property
+    def index(self):
+        '''Compiled ontology index (see compile_ontology_index).'''
+        return compile_ontology_index(self.edges)
+    
+    def to_pickle_dict(self):
+        return {'BrainOntologyEdges': self.edges,
+                'BrainOntologyTree': self.tree,
+                'BrainOntologyRegions': self.regions}
+
+#%%
+# Ontologies loaded in this process, with the size and modification time of their source file
+_ontology_cache = {}
+
+def user_cache_dir():
+    '''
+    Folder for files that can be rebuilt at any time (e.g. the compact ontology), outside the repository:
+    %LOCALAPPDATA% on Windows, ~/Library/Caches on macOS and $XDG_CACHE_HOME (~/.cache) otherwise.
+    '''
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    elif sys.platform == 'darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'abba_cell_count_analysis')
+
+def get_ontology(path, cache_dir=None):
+    '''
+    Load the ontology once per process. The path can point to AllenMouseBrainOntology.json
+    or to the pickle AllenMouseBrainOntology.pk.
+    
+    The ontology is built from the json file (next to the pickle), and saved 
+    in the compact format in cache_dir (user_cache_dir() by default) for a fast start 
+    next time. The compact file is named after the checksum of the json file, and 
+    it is rebuilt if it is corrupt or of an older version.
+    Without json file, the ontology is read from the pickle.
+    The pickle is never changed: run sync_ontology_pickle to rebuild it from the json file.
+    '''
+    base,ext = os.path.splitext(os.path.abspath(path))
+    path_to_json = base + '.json'
+    source = path_to_json if os.path.exists(path_to_json) else os.path.abspath(path)
+    
+    stat = os.stat(source)
+    key = (source, stat.st_size, stat.st_mtime_ns)
+    if key in _ontology_cache:
+        return _ontology_cache[key]
+    
+    if source == path_to_json:
+        with open(path_to_json, 'rb') as f:
+            source_sha1 = hashlib.sha1(f.read()).hexdigest()
+        if cache_dir is None:
+            cache_dir = user_cache_dir()
+        compact_file = os.path.join(cache_dir, os.path.basename(base) + '_' + source_sha1[:12] + '.ontology.npz')
+        ontology = Ontology.load(compact_file, source_sha1)
+        if ontology is None:
+            ontology = Ontology.from_json(path_to_json)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                ontology.save(compact_file)
+            except OSError as error:
+                print('Cannot save the ontology in ' + cache_dir + ' (' + str(error) + ')')
+    else:
+        with open(source, 'rb') as f:
+            ontology = Ontology.from_pickle_dict(pickle.load(f))
+    
+    _ontology_cache[key] = ontology
+    return ontology
+
+#%%
+def sync_ontology_pickle(path_to_pickle, path_to_json):
+    '''
+    Rebuild the pickled ontology from the json file, if it is missing or if its 
+    regions or edges do not match the json file. This is never done implicitly,
+    because the pickle is part of the repository. Run it from the command line:
+        python ontology_helpers.py AllenMouseBrainOntology.pk AllenMouseBrainOntology.json
+    Returns True if the pickle was rebuilt.
+    '''
+    ontology = Ontology.from_json(path_to_json)
+    if os.path.exists(path_to_pickle):
+        with open(path_to_pickle, 'rb') as f:
+            ontology_dict = pickle.load(f)
+        # Old pickles contain an edge from the root to one of its descendants.
+        edges = {child: parent for child, parent in ontology_dict['BrainOntologyEdges'].items() if child != 'root'}
+        if edges == ontology.edges and ontology_dict['BrainOntologyRegions'] == ontology.regions:
+            print('The ontology pickle ' + path_to_pickle + ' is up to date.')
+            return False
+    
+    print('Rebuilding the ontology pickle ' + path_to_pickle)
+    with open(path_to_pickle + '.tmp', 'wb') as f:
+        pickle.dump(ontology.to_pickle_dict(), f)
+    os.replace(path_to_pickle + '.tmp', path_to_pickle)
+    return True
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('Usage: python ontology_helpers.py <ontology pickle> <ontology json>')
+    sync_ontology_pickle(sys.argv[1], sys.argv[2])
@@ -7,10 +7,13 @@ Created on Fri Jan 28 17:15:20 2022
 """
 
 import matplotlib.pyplot as plt
+import matplotlib.colors as colors
 import plotly.graph_objects as go
 import networkx as nx
 import numpy as np
+import copy
 import os
+import zipfile
 
 from readCSV_helpers import sort_hemispheres
 
@@ -81,6 +84,150 @@ def plot_plotly_graph(G,pos):
                 )
     return fig
 
+#%%
+# Version of the cached hierarchy layout (see load_hierarchy_layout)
+LAYOUT_FORMAT_VERSION = 1
+
+def compute_hierarchy_layout(ontology, prog='dot'):
+    '''
+    Compute the positions of all regions of the brain hierarchy with graphviz 
+    (this may take some time). Use load_hierarchy_layout to compute them only once.
+
+    Inputs
+    ------
+        ontology (Ontology)
+        Brain ontology (see ontology_helpers.get_ontology).
+        prog (str)
+        Graphviz program that computes the layout.
+
+    Output
+    ------
+        coordinates (np array)
+        Array of shape (number of regions, 2) with the x and y position of each region,
+        in the order of the ontology (preorder).
+    '''
+    from networkx.drawing.nx_pydot import graphviz_layout
+
+    # The regions are numbered in preorder, so the nodes get simple integer names.
+    G = nx.DiGraph()
+    G.add_nodes_from(range(len(ontology.parent)))
+    children = np.flatnonzero(ontology.parent >= 0)
+    G.add_edges_from(zip(ontology.parent[children].tolist(), children.tolist()))
+    pos = graphviz_layout(G, prog=prog)
+
+    coordinates = np.array([pos[i] for i in range(len(ontology.parent))], dtype=np.float64)
+    return coordinates
+
+def load_hierarchy_layout(ontology, path, prog='dot'):
+    '''
+    Load the positions of all regions of the brain hierarchy from path (.npz).
+    They are computed with compute_hierarchy_layout and saved to path
+    if the file does not exist, or if it was made for another version 
+    of the ontology or with another graphviz program.
+    '''
+    checksum = ontology.checksum()
+    if os.path.exists(path):
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if (int(data['version']) == LAYOUT_FORMAT_VERSION and str(data['checksum']) == checksum 
+                    and str(data['prog']) == prog):
+                    return data['coordinates']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass
+    
+    print('Computing the layout of the brain hierarchy (this may take some time) ...')
+    coordinates = compute_hierarchy_layout(ontology, prog)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, version=LAYOUT_FORMAT_VERSION, checksum=checksum, prog=prog, coordinates=coordinates)
+    os.replace(path + '.tmp', path)
+    
+    return coordinates
+
+#%%
+def _edge_coordinates(coordinates, parent, children):
+    '''
+    Line coordinates of the edges from the parents to children, as x and y arrays 
+    with a NaN after every edge (such that the edges are not connected).
+    '''
+    x = np.full((len(children), 3), np.nan)
+    y = np.full((len(children), 3), np.nan)
+    x[:,0] = coordinates[parent[children], 0]
+    x[:,1] = coordinates[children, 0]
+    y[:,0] = coordinates[parent[children], 1]
+    y[:,1] = coordinates[children, 1]
+    return x.ravel(), y.ravel()
+
+def plot_hierarchy(ontology, coordinates, max_depth=None, title='Hierarchy of brain regions'):
+    '''
+    Plot the brain hierarchy with plotly, using WebGL (Scattergl), which stays 
+    fast for the full Allen ontology. The figure has a slider to set the level of detail:
+    the subtrees below the selected depth are collapsed into their parent region
+    (the number of subregions is shown when hovering over a region).
+
+    Inputs
+    ------
+        ontology (Ontology)
+        Brain ontology (see ontology_helpers.get_ontology).
+        coordinates (np array)
+        Positions of the regions (see load_hierarchy_layout).
+        max_depth (int)
+        Depth that is shown when the figure opens (default: all regions).
+        title (str)
+        Title of the figure.
+
+    Output
+    ------
+        fig (plotly figure)
+    '''
+    index = ontology.index
+    parent = index['parent']
+    depth = index['depth']
+    num_subregions = index['end'] - np.arange(len(depth)) - 1
+    num_levels = int(depth.max()) + 1
+    max_depth = num_levels - 1 if max_depth is None else min(max_depth, num_levels - 1)
+
+    node_colors = np.array(['#' + color for color in ontology.colors], dtype=object)
+    text = np.array(['%s (%s)<br>%d subregions'%(name, acronym, n) 
+                     for name, acronym, n in zip(ontology.names, ontology.acronyms, num_subregions)], dtype=object)
+
+    # One edge trace and one node trace per depth. 
+    # Showing depth d means showing the traces of all depths <= d.
+    traces = []
+    for d in range(num_levels):
+        regions = np.flatnonzero(depth == d)
+        edge_x, edge_y = _edge_coordinates(coordinates, parent, regions[parent[regions] >= 0])
+        traces.append(go.Scattergl(
+            x=edge_x, y=edge_y,
+            line=dict(width=0.5, color='#888'),
+            hoverinfo='none',
+            mode='lines',
+            visible=d <= max_depth))
+        traces.append(go.Scattergl(
+            x=coordinates[regions, 0], y=coordinates[regions, 1],
+            mode='markers',
+            hoverinfo='text',
+            text=text[regions],
+            marker=dict(color=node_colors[regions], size=5, line_width=.1),
+            visible=d <= max_depth))
+
+    steps = []
+    for d in range(num_levels):
+        visible = np.repeat(np.arange(num_levels) <= d, 2).tolist()
+        steps.append(dict(method='restyle', args=[{'visible': visible}], label=str(d)))
+
+    fig = go.Figure(data=traces,
+             layout=go.Layout(
+                title=title,
+                titlefont_size=16,
+                showlegend=False,
+                hovermode='closest',
+                margin=dict(b=20,l=5,r=5,t=40),
+                xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+                yaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+                sliders=[dict(active=max_depth, currentvalue=dict(prefix='Depth: '), steps=steps)])
+                )
+    return fig
+
 #%%
 def plot_bidirectional_bar_chart(data, x_label, brain_region_dict, errorbars=None):
     '''
@@ -173,3 +320,163 @@ def plot_horizontal_bar_chart(data, brain_region_dict):
     plt.xlim([0, 1.2 * max_value])
     
     return fig
+
+#%%
+def order_regions_by_ontology(data, ontology_index, subtree=None, drop_empty=True):
+    '''
+    Sort the rows (region acronyms) of data in ontology preorder, such that 
+    subregions are directly below their parent region. Rows that are not in the 
+    ontology are dropped.
+
+    Inputs
+    ------
+        data (pandas dataframe)
+        Dataframe with region acronyms as index.
+        ontology_index (dict)
+        Compiled ontology (see ontology_helpers.compile_ontology_index).
+        subtree (str)
+        If given, only keep this region and its subregions.
+        drop_empty (bool)
+        If True, drop the rows without any nonzero value.
+
+    Output
+    ------
+        data (pandas dataframe)
+        The sorted rows of data.
+        region_ids (np array)
+        Ontology id of every row.
+    '''
+    region_ids = ontology_index['acronym_index'].get_indexer(data.index)
+    keep = region_ids >= 0
+    if subtree is not None:
+        subtree_id = ontology_index['ids'][subtree]
+        keep &= (region_ids >= subtree_id) & (region_ids < ontology_index['end'][subtree_id])
+    if drop_empty:
+        values = data.to_numpy(dtype=float)
+        keep &= (np.nan_to_num(values) != 0).any(axis=1)
+    
+    rows = np.flatnonzero(keep)
+    rows = rows[np.argsort(region_ids[rows], kind='stable')]
+    return data.iloc[rows], region_ids[rows]
+
+def _label_rows(region_ids, ontology_index, max_labels):
+    '''
+    Choose the rows that get a label: all rows if there are at most max_labels, 
+    otherwise only the rows up to the deepest level that fits in max_labels.
+    '''
+    depth = ontology_index['depth'][region_ids]
+    if len(region_ids) <= max_labels:
+        return np.arange(len(region_ids))
+    label_depth = depth.min()
+    for d in np.unique(depth):
+        if (depth <= d).sum() > max_labels:
+            break
+        label_depth = d
+    return np.flatnonzero(depth <= label_depth)
+
+#%%
+def plot_heatmap(data, brain_region_dict, ontology_index, subtree=None, log_scale=True, 
+                 max_labels=150, colormap='magma', x_label=None):
+    '''
+    Plot cell counts as a heatmap with one row per region, in ontology preorder, 
+    and one column per column of data (e.g. per animal or per tracer).
+    The heatmap is drawn as one (rasterized) image, so the figure stays small 
+    and fast to save, also for the full ontology and for large cohorts.
+    Zero and NaN values are grey.
+
+    Inputs
+    ------
+        data (pandas dataframe)
+        Dataframe with region acronyms as index, for example the normalized
+        counts of all animals for one tracer and hemisphere (results[tracer]['Sum']),
+        or the means of all tracers (mean_results.xs(('SummedHemi','Mean'), axis=1, level=[1,2])).
+        brain_region_dict (dict)
+        Region acronyms -> full region names.
+        ontology_index (dict)
+        Compiled ontology (see ontology_helpers.compile_ontology_index).
+        subtree (str)
+        If given, only plot this region and its subregions.
+        log_scale (bool)
+        Use a logarithmic color scale (normalized counts are around 1).
+        max_labels (int)
+        Maximal number of region labels. With more regions, only the
+        regions on the highest levels of the ontology get a label.
+        colormap (str)
+        Matplotlib colormap.
+        x_label (str)
+        Label of the colorbar.
+
+    Output
+    ------
+        fig (matplotlib figure)
+    '''
+    data, region_ids = order_regions_by_ontology(data, ontology_index, subtree=subtree)
+    values = data.to_numpy(dtype=float)
+    values[~(values > 0)] = np.nan
+    
+    cmap = copy.copy(plt.get_cmap(colormap))
+    cmap.set_bad('#d9d9d9')
+    norm = None
+    if log_scale and np.isfinite(values).any():
+        norm = colors.LogNorm(vmin=np.nanmin(values), vmax=np.nanmax(values))
+    
+    fig, ax = plt.subplots(figsize=(4 + 0.6*values.shape[1], 12))
+    image = ax.imshow(values, aspect='auto', interpolation='nearest', cmap=cmap, norm=norm, rasterized=True)
+    
+    label_rows = _label_rows(region_ids, ontology_index, max_labels)
+    depth = ontology_index['depth'][region_ids]
+    ax.set_yticks(label_rows)
+    ax.set_yticklabels(['  '*(depth[row] - depth.min()) + '%s (%s)'%(brain_region_dict[data.index[row]], data.index[row])
+                        for row in label_rows], fontsize=6 if len(label_rows) > 60 else 9)
+    ax.set_xticks(np.arange(values.shape[1]))
+    ax.set_xticklabels([str(c) for c in data.columns], rotation=90)
+    
+    colorbar = fig.colorbar(image, ax=ax)
+    if x_label is not None:
+        colorbar.set_label(x_label)
+    plt.sca(ax)
+    
+    return fig
+
+#%%
+def plot_interactive_heatmap(data, brain_region_dict, ontology_index, output_file=None, title=None, 
+                             subtree_depth=2, log_scale=True):
+    '''
+    Plot cell counts as an interactive (plotly) heatmap, with rows in ontology 
+    preorder (see plot_heatmap). Hovering shows the full region name and value.
+    A menu zooms into the subtree of every region at subtree_depth of the ontology.
+    If output_file is given, the figure is saved as html.
+    '''
+    data, region_ids = order_regions_by_ontology(data, ontology_index)
+    values = data.to_numpy(dtype=float)
+    values[~(values > 0)] = np.nan
+    depth = ontology_index['depth'][region_ids]
+    
+    names = np.array(['%s (%s)'%(brain_region_dict[acronym], acronym) for acronym in data.index], dtype=object)
+    heatmap = go.Heatmap(z=np.log10(values) if log_scale else values,
+                         x=[str(c) for c in data.columns], y=np.arange(len(data)),
+                         customdata=values,
+                         text=np.repeat(names[:, None], values.shape[1], axis=1),
+                         hovertemplate='%{text}<br>%{x}: %{customdata:.3g}<extra></extra>',
+                         colorscale='Magma', 
+                         colorbar=dict(title='log10' if log_scale else None))
+    
+    # Zoom buttons: one per region at subtree_depth (the rows of its subtree are contiguous)
+    buttons = [dict(label='All regions', method='relayout', args=[{'yaxis.range': [len(data) - 0.5, -0.5]}])]
+    for row in np.flatnonzero(depth == subtree_depth):
+        subtree_rows = np.flatnonzero((region_ids >= region_ids[row]) & 
+                                      (region_ids < ontology_index['end'][region_ids[row]]))
+        buttons.append(dict(label=names[row], method='relayout',
+                            args=[{'yaxis.range': [subtree_rows.max() + 0.5, subtree_rows.min() - 0.5]}]))
+    
+    label_rows = _label_rows(region_ids, ontology_index, 150)
+    fig = go.Figure(data=[heatmap],
+                    layout=go.Layout(
+                        title=title,
+                        height=900,
+                        yaxis=dict(autorange='reversed', tickvals=label_rows, ticktext=data.index[label_rows].tolist()),
+                        updatemenus=[dict(buttons=buttons, direction='down', x=1, xanchor='right', y=1.1)]))
+    if output_file is not None:
+        fig.write_html(output_file)
+    
+    return fig
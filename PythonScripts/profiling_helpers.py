@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 15:20:37 2026
+
+Optional instrumentation of the analysis pipeline: timers per stage,
+counters (rows, slices, ...) and peak memory, collected per animal.
+Instrumentation is off by default. Turn it on with enable_profiling, or with the
+environment variable ABBA_PROFILE, a comma seperated list of:
+    'time'      time the stages and count rows and slices ('1' also works).
+    'memory'    also sample the peak memory of every stage (with tracemalloc, slower).
+    'cprofile'  also dump a cProfile of every animal in its results_python folder.
+When it is off, stage and count return immediately.
+The worker processes of collect_and_analyze_cell_counts send their records
+to the main process. Stages in the worker processes of load_cell_counts are not collected.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import time
+import cProfile
+import contextlib
+import tracemalloc
+import pandas as pd
+
+#%%
+# Profiling state of this process
+_state = {'enabled': False,   # time stages and count
+          'memory': False,    # sample peak memory
+          'cprofile': False,  # dump a cProfile per animal
+          'animal': None,     # animal that is being analyzed
+          'records': {},      # (animal, stage) -> {'seconds', 'calls', 'peak_mb'}
+          'counters': {},     # (animal, counter) -> count
+          'peaks': []}        # peak memory of the stages that are running (innermost last)
+
+_disabled = contextlib.nullcontext()
+
+def enable_profiling(enabled=True, memory=False, cprofile=False):
+    '''
+    Turn the instrumentation on or off. See the module docstring for the options.
+    '''
+    _state['enabled'] = enabled
+    _state['memory'] = enabled and memory
+    _state['cprofile'] = enabled and cprofile
+    if _state['memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not(_state['memory']) and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def enable_profiling_from_environment():
+    '''
+    Turn the instrumentation on as specified by the ABBA_PROFILE environment variable.
+    '''
+    options = [o.strip() for o in os.environ.get('ABBA_PROFILE', '').lower().split(',') if o.strip() not in ('', '0')]
+    if len(options) > 0:
+        enable_profiling(True, memory='memory' in options, cprofile='cprofile' in options)
+
+def profiling_enabled():
+    return _state['enabled']
+
+def profiling_settings():
+    '''
+    Return the profiling options of this process, to enable them in worker processes
+    with enable_profiling(**settings).
+    '''
+    return {'enabled': _state['enabled'], 'memory': _state['memory'], 'cprofile': _state['cprofile']}
+
+#%%
+def stage(name):
+    '''
+    Context manager that times a stage of the pipeline, e.g.:
+        with stage('exclude_regions'):
+            df = exclude_regions(...)
+    The time (and peak memory) is added to the current animal (see profile_animal).
+    '''
+    if not _state['enabled']:
+        return _disabled
+    return _timed_stage(name)
+
+@contextlib.contextmanager
+def _timed_stage(name):
+    memory = _state['memory'] and tracemalloc.is_tracing()
+    if memory:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        _state['peaks'].append(0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        record = _state['records'].setdefault((_state['animal'], name), {'seconds': 0.0, 'calls': 0, 'peak_mb': 0.0})
+        record['seconds'] += seconds
+        record['calls'] += 1
+        if memory:
+            # Stages inside this stage reset the peak, so we also take their peaks into account.
+            peak = max(tracemalloc.get_traced_memory()[1], _state['peaks'].pop())
+            record['peak_mb'] = max(record['peak_mb'], (peak - start_memory) / 1e6)
+            if len(_state['peaks']) > 0:
+                _state['peaks'][-1] = max(_state['peaks'][-1], peak)
+
+def count(name, n=1):
+    '''
+    Add n to a counter (e.g. 'rows' or 'slices') of the current animal.
+    '''
+    if not _state['enabled']:
+        return
+    key = (_state['animal'], name)
+    _state['counters'][key] = _state['counters'].get(key, 0) + n
+
+#%%
+@contextlib.contextmanager
+def profile_animal(animal, output_path=None):
+    '''
+    Context manager that assigns all stages and counters inside it to animal.
+    The whole animal is timed as the stage 'total'. With the cprofile option,
+    a cProfile of the animal is saved as <animal>_profile.prof in output_path.
+    '''
+    if not _state['enabled']:
+        yield
+        return
+    previous_animal = _state['animal']
+    _state['animal'] = animal
+    profiler = cProfile.Profile() if _state['cprofile'] and output_path is not None else None
+    try:
+        with stage('total'):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    profiler.dump_stats(os.path.join(output_path, animal + '_profile.prof'))
+    finally:
+        _state['animal'] = previous_animal
+
+#%%
+def take_profiling_records():
+    '''
+    Return the records collected in this process, and clear them.
+    Used to send the records of a worker process to the main process (see merge_profiling_records).
+    '''
+    records = {'records': _state['records'], 'counters': _state['counters']}
+    _state['records'] = {}
+    _state['counters'] = {}
+    return records
+
+def merge_profiling_records(records):
+    '''
+    Add records from take_profiling_records (e.g. of a worker process) to this process.
+    '''
+    for key, record in records['records'].items():
+        own = _state['records'].setdefault(key, {'seconds': 0.0, 'calls': 0, 'peak_mb': 0.0})
+        own['seconds'] += record['seconds']
+        own['calls'] += record['calls']
+        own['peak_mb'] = max(own['peak_mb'], record['peak_mb'])
+    for key, n in records['counters'].items():
+        _state['counters'][key] = _state['counters'].get(key, 0) + n
+
+#%%
+def profiling_report(animal=None):
+    '''
+    Return the collected timings as a table with one row per (animal, stage),
+    and the columns 'seconds', 'calls' and 'peak_mb' (peak memory, if sampled).
+    The counters are added as rows with stage 'count: <counter>' (their count in 'calls').
+    If animal is given, only the rows of that animal are returned.
+    '''
+    rows = []
+    for (a, name), record in _state['records'].items():
+        rows.append({'animal': a, 'stage': name, **record})
+    for (a, name), n in _state['counters'].items():
+        rows.append({'animal': a, 'stage': 'count: ' + name, 'seconds': float('nan'), 'calls': n,
+                     'peak_mb': float('nan')})
+
+    report = pd.DataFrame(rows, columns=['animal', 'stage', 'seconds', 'calls', 'peak_mb'])
+    if animal is not None:
+        report = report[report['animal'] == animal]
+    if not _state['memory']:
+        report = report.drop(columns='peak_mb')
+
+    return report.sort_values(['animal', 'stage']).set_index(['animal', 'stage'])
+
+def save_profiling_report(path, animal=None):
+    '''
+    Save the profiling report (see profiling_report) as csv.
+    '''
+    report = profiling_report(animal)
+    report.to_csv(path)
+    return report
+
+#%%
+enable_profiling_from_environment()
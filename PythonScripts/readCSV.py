@@ -17,6 +17,9 @@ import copy
 import pickle
 
 from readCSV_helpers import *
+from plot_helpers import plot_horizontal_bar_chart, plot_heatmap, plot_interactive_heatmap
+from render_helpers import start_render_queue, submit_plot, wait_for_plots
+from classifier_helpers import load_rtrees_classifier, make_detection_filter
 
 #%% ------------------------------ SET PARAMETERS ----------------------------
 # ============================================================================
@@ -26,98 +29,55 @@ root = '/Users/lukasvandenheuvel/Documents/GRAFF Lab/2021_RabiesTracing/TRIO/'
 path_to_onotlogy_pickle = '../AllenMouseBrainOntology.pk'
 
 tracers = ['RAB', 'CTB', 'TVA']         # Tracers we are interested in.
+incremental = False                     # Only re-analyze animals whose input files changed since the previous run.
+from_detections = False                 # Recount the cells from the per-detection exports (see count_detections), instead of the region exports.
+rabies_classifier = None                # With from_detections: filter the Rabies+ cells with this object classifier in Python,
+                                        # e.g. '../RabiesClassifier.json' (see classifier_helpers).
+low_memory = False                      # For very large cohorts: average the animals on the fly, without keeping their results.
+save_csv = True                         # Also export the results as csv (they are always saved in binary format, see load_results).
+profile = False                         # Time every stage of the analysis (see profiling_helpers; or set ABBA_PROFILE=time).
+make_plots = True                       # Set to False to skip all plots (e.g. for headless batch runs).
+plot_type = 'heatmap'                   # 'heatmap': compact heatmaps (regions x animals/tracers), 'bar': a bar chart per region (very large figures).
+interactive_plots = False               # Also save the heatmaps as interactive html, to zoom into subtrees of the ontology.
+plot_workers = 0                        # Number of processes that render the plots in the background (0: plot in this process).
+                                        # Note that background processes need a script protected by "if __name__ == '__main__':"
+                                        # on systems that start new processes by spawning (Windows, macOS).
 
 #%% -------------------------------- START SCRIPT ----------------------------
 # ============================================================================
 
-hemispheres = ['Left', 'Right', 'Sum']  # Store the seperate hemispheres, and the sum of the hemispheres.
+if profile:
+    enable_profiling()
+render_queue = start_render_queue(plot_workers) if make_plots else None
+detection_classifier = None
+if from_detections:
+    detection_classifier = detection_class_masks
+    if rabies_classifier is not None:
+        detection_classifier = make_detection_filter(load_rtrees_classifier(rabies_classifier))
+marker_panel = make_marker_panel(MARKERS, detection_classifier)
 
 # Load brain ontology (brain hierarchy) --------------------------------------
-with open(path_to_onotlogy_pickle,"rb") as f:
-    ontology_dict = pickle.load(f)
-edges = ontology_dict['BrainOntologyEdges']
-tree = ontology_dict['BrainOntologyTree']
-brain_region_dict = ontology_dict['BrainOntologyRegions']
-
-# Initialize a results dataframe. --------------------------------------------
-# This is a dataframe with hierarchical columns. 
-# Hierarchy: tracer -> animal -> hemisphere.
-iterables = [tracers, animal_list, hemispheres]
-multi_index = pd.MultiIndex.from_product(iterables)
-results = pd.DataFrame(np.nan, index=brain_region_dict.keys(), columns=multi_index)
+# It is built from AllenMouseBrainOntology.json, and cached in a compact format in the user cache folder.
+ontology = get_ontology(path_to_onotlogy_pickle)
+brain_region_dict = ontology.regions
 
 #%% Loop over animals, load the data and normalize counts --------------------
-for animal in animal_list:
-
-    print('Importing slices in '+animal+'...')
-    input_path = os.path.join(root, animal, 'results')
-
-    # Load regions to exclude for this animal
-    path_to_exclusion_file = os.path.join(root, animal, 'RegionsToExclude.csv')
-    if not(os.path.exists(path_to_exclusion_file)):
-        raise ValueError('Cannot find exclusion file for animal ' + animal + '!')
-    exclude_dict = list_regions_to_exclude(path_to_exclusion_file)
-    
-    # Load cell counts, excluding the regions we want to exclude
-    df_list,slice_regions,slice_data = load_cell_counts(input_path, exclude_dict, edges, tree)
-    print('Imported ' + str(len(df_list)) + ' slices.\n')
-    
-    # Now comes the tricky part. We'll first concatenate the dataframes
-    # of all slices into one big dataframe (brain_df).
-    # Then, we combine the rows with the same index (=region name), and sum them.
-    # That is, we sum the results (area, cell counts) per region across slices.
-    brain_df = pd.concat(df_list)
-    brain_df = brain_df.groupby(brain_df.index, axis=0).sum()
-    
-    # Plot starter cells
-    starter_cells = brain_df['RAB_TVA']
-    starter_cells = starter_cells[starter_cells > 0]
-    starter_cells_sorted = sort_hemispheres(starter_cells)
-    
-    # Plot starter cells and save brain_df
-    index = ['%s (%s)'%(brain_region_dict[key],key) for key in starter_cells_sorted.index]
-    plt.figure(figsize=(20,5))
-    plt.tight_layout()
-    b = plt.bar(index, starter_cells_sorted['Sum'])
-    t = plt.xticks(rotation=90)
-    t = plt.title('Starter cells')
-    lbl = plt.ylabel('Starter cells (Rabies+ TVA+)')
-    output_path = os.path.join(root, animal, 'results_python')
-    if not(os.path.isdir(output_path)):
-        os.mkdir(output_path)
-    output_file = os.path.join(output_path, animal+'_starter_cells.pdf')
-    plt.savefig(output_file, bbox_inches='tight')
-    brain_df.to_csv( os.path.join(output_path, animal+'_cell_counts.csv') )
-
-    # Normalize the results
-    for t in tracers: # loop over tracers ('RAB', 'CTB', ...)
-
-        # Normalize
-        normalized_cell_counts = normalize_cell_counts(brain_df, t)
-        
-        # Save results per animal
-        present_regions = normalized_cell_counts.index.to_list()
-        for region in present_regions: # loop over all regions present
-            results.loc[region, (t,animal)].update( normalized_cell_counts.loc[region] )
-
-# Swap hierarchy of columns, to make averaging over animals easier.
-# The new hierarchy will be Tracer -> Hemisphere -> Animal
-results = results.swaplevel(axis=1)
+# The results dataframe has hierarchical columns: Tracer -> Hemisphere -> Animal.
+# Hemispheres are 'Left', 'Right', and 'Sum' (the sum of the hemispheres).
+# The raw cell counts and starter cells of each animal are saved in its results_python folder.
+if low_memory:
+    results = None
+    mean_results = collect_and_average_cell_counts(root, animal_list, tracers, path_to_onotlogy_pickle,
+                                                   incremental=incremental, marker_panel=marker_panel, 
+                                                   render_queue=render_queue)
+else:
+    results = collect_and_analyze_cell_counts(root, animal_list, tracers, path_to_onotlogy_pickle,
+                                              incremental=incremental, marker_panel=marker_panel, 
+                                              render_queue=render_queue)
 
 #%% Calculate means and sems -------------------------------------------------
-iterables = [tracers, ['PerHemi', 'SummedHemi'], ['Mean', 'Sem']]
-multi_index = pd.MultiIndex.from_product(iterables)
-mean_results = pd.DataFrame(np.nan, index=results.index, columns=multi_index)
-
-for t in tracers:
-    
-    # Normalization per hemisphere: Treat 'Left' and 'Right' as seperate animals to calculate average
-    mean_results.loc[:, (t,'PerHemi','Mean')] = results[t][['Left','Right']].mean(axis=1)
-    mean_results.loc[:, (t,'PerHemi','Sem')] = results[t][['Left','Right']].sem(axis=1)
-    
-    # Normalization with summed hemispheres: Sum left and right, and average over animals.
-    mean_results.loc[:, (t,'SummedHemi','Mean')] = results[t]['Sum'].mean(axis=1)
-    mean_results.loc[:, (t,'SummedHemi','Sem')] = results[t]['Sum'].sem(axis=1)
+if not(low_memory):
+    mean_results = average_cell_counts_over_animals(results, tracers)
 
 #%% Save and plot results -----------------------------------------------------
 output_path = os.path.join(root, 'results_python')
@@ -127,68 +87,48 @@ if not(os.path.exists(output_path)):
 else:
     print('\n! A results_python folder already existed in root. I am overwriting previous results!\n')
 
-results.to_csv( os.path.join(output_path, 'results_cell_counts.csv') )
-mean_results.to_csv( os.path.join(output_path, 'results_mean_cell_counts.csv') )
+if results is not None:
+    save_results(results, output_path, 'results_cell_counts', save_csv=save_csv)
+save_results(mean_results, output_path, 'results_mean_cell_counts', save_csv=save_csv)
+if profiling_enabled():
+    save_profiling_report(os.path.join(output_path, 'profile.csv'))
 print('\nGenerating plots ...')
 
-#%% Plot Rabies+ normalized per hemisphere
-
-
-x_label = '(Rabies+ / Dapi area) / (total Rabies+ / total Dapi area)'
-
-rabies = mean_results['RAB']['PerHemi']
-fig = plot_horizontal_bar_chart(rabies, brain_region_dict)
-
-plt.title('Rabies+ normalized per hemisphere',fontsize=35)
-output_file = os.path.join(output_path, 'rabies_normalized_per_hemi.pdf')
-plt.savefig(output_file, bbox_inches='tight')
-plt.show()
-
-#%% Plot Rabies+ normalized with summed hemispheres
-rabies = mean_results['RAB']['SummedHemi']
-fig = plot_horizontal_bar_chart(rabies, brain_region_dict)
-
-plt.title('Rabies+ normalized as summed hemispheres',fontsize=35)
-output_file = os.path.join(output_path, 'rabies_normalized_sum.pdf')
-plt.savefig(output_file, bbox_inches='tight')
-plt.show()
-
-#%% Plot TVA+ normalized per hemisphere
-x_label = '(TVA+ / Dapi area) / (total TVA+ / total Dapi area)'
-
-tva = mean_results['TVA']['PerHemi']
-fig = plot_horizontal_bar_chart(tva, brain_region_dict)
-
-plt.title('TVA+ normalized per hemisphere',fontsize=35)
-output_file = os.path.join(output_path, 'tva_normalized_per_hemi.pdf')
-plt.savefig(output_file, bbox_inches='tight')
-plt.show()
-
-#%% Plot TVA+ normalized with summed hemispheres
-tva = mean_results['TVA']['SummedHemi']
-fig = plot_horizontal_bar_chart(tva, brain_region_dict)
-
-plt.title('TVA+ normalized as summed hemispheres',fontsize=35)
-output_file = os.path.join(output_path, 'tva_normalized_sum.pdf')
-plt.savefig(output_file, bbox_inches='tight')
-plt.show()
-
-#%% Plot CTB+ normalized per hemisphere
-ctb = mean_results['CTB']['PerHemi']
-fig = plot_horizontal_bar_chart(ctb, brain_region_dict)
-
-plt.title('CTB+ normalized per hemisphere',fontsize=35)
-output_file = os.path.join(output_path, 'ctb_normalized_per_hemi.pdf')
-plt.savefig(output_file, bbox_inches='tight')
-plt.show()
-
-#%% Plot CTB+ normalized with summed hemispheres
-ctb = mean_results['CTB']['SummedHemi']
-fig = plot_horizontal_bar_chart(ctb, brain_region_dict)
-
-plt.title('CTB+ normalized as summed hemispheres',fontsize=35)
-output_file = os.path.join(output_path, 'ctb_normalized_sum.pdf')
-plt.savefig(output_file, bbox_inches='tight')
-plt.show()
-
+#%% Plot heatmaps, with one row per region (in ontology order)
+x_label = '(Tracer+ / Dapi area) / (total Tracer+ / total Dapi area)'
+
+if plot_type == 'heatmap':
+    for normalization,name in [('PerHemi', 'per_hemi'), ('SummedHemi', 'sum')]:
+        means = mean_results.xs((normalization, 'Mean'), axis=1, level=[1,2])
+        output_file = os.path.join(output_path, 'mean_normalized_' + name + '_heatmap.pdf')
+        submit_plot(render_queue, plot_heatmap, output_file, means, brain_region_dict, ontology.index, 
+                    x_label=x_label, title='Mean normalized ' + name.replace('_', ' '))
+        if make_plots and interactive_plots:
+            plot_interactive_heatmap(means, brain_region_dict, ontology.index, output_file.replace('.pdf', '.html'),
+                                     title='Mean normalized ' + name.replace('_', ' '))
+    
+    # Per animal (with summed hemispheres)
+    if results is not None:
+        for tracer in tracers:
+            output_file = os.path.join(output_path, tracer.lower() + '_normalized_sum_per_animal_heatmap.pdf')
+            submit_plot(render_queue, plot_heatmap, output_file, results[tracer]['Sum'], brain_region_dict, 
+                        ontology.index, x_label=x_label, title=tracer + '+ normalized as summed hemispheres')
+            if make_plots and interactive_plots:
+                plot_interactive_heatmap(results[tracer]['Sum'], brain_region_dict, ontology.index, 
+                                         output_file.replace('.pdf', '.html'),
+                                         title=tracer + '+ normalized as summed hemispheres')
+
+#%% Plot bar charts of the mean per tracer (one bar per region)
+bar_chart_names = {'RAB': ('Rabies+', 'rabies'), 'TVA': ('TVA+', 'tva'), 'CTB': ('CTB+', 'ctb')}
+
+if plot_type == 'bar':
+    for tracer in tracers:
+        label,name = bar_chart_names.get(tracer, (tracer + '+', tracer.lower()))
+        submit_plot(render_queue, plot_horizontal_bar_chart, os.path.join(output_path, name + '_normalized_per_hemi.pdf'),
+                    mean_results[tracer]['PerHemi'], brain_region_dict, title=label + ' normalized per hemisphere')
+        submit_plot(render_queue, plot_horizontal_bar_chart, os.path.join(output_path, name + '_normalized_sum.pdf'),
+                    mean_results[tracer]['SummedHemi'], brain_region_dict, title=label + ' normalized as summed hemispheres')
+
+#%% Wait until all plots are saved
+wait_for_plots(render_queue)
 print('Script finished!')
@@ -14,6 +14,16 @@ import pickle
 
 import copy
 import json
+import time
+import hashlib
+import itertools
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from ontology_helpers import compile_ontology_index, get_ontology, regions_at_level, roll_up_counts
+from render_helpers import submit_plot
+from profiling_helpers import stage, count, profile_animal, profiling_enabled, profiling_settings, enable_profiling, \
+                              take_profiling_records, merge_profiling_records, profiling_report, save_profiling_report
 
 #%%
 def get_image_names_in_folder(path):
@@ -41,7 +51,7 @@ def get_image_names_in_folder(path):
     return files
 
 #%%
-def remove_hemisphere(data, hemisphere):
+def remove_hemisphere(data, hemisphere, labels=None):
     '''
     This function removes all regions specific to
     a certain hemisphere (either 'Left' or 'Right')
@@ -54,20 +64,22 @@ def remove_hemisphere(data, hemisphere):
     
     hemisphere (string)
     Choose 'Left' or 'Right'.
+    
+    labels (tuple)
+    The parsed row names of data (see parse_region_labels), if they are known.
     '''
     
     if not(hemisphere=='Left' or hemisphere=='Right'):
         raise ValueError('Hemisphere should be either "Left" or "Right"!')
     
-    curr_regs = data.index.tolist()
-    for region in curr_regs:
-        if hemisphere in region:
-            data = data.drop(region, axis=0)
-    
-    return data
+    # Drop all regions of the hemisphere with a single mask
+    if labels is None:
+        return data[~data.index.astype(str).str.startswith(hemisphere + ': ')]
+    hemis,acronyms = labels
+    return data[hemis != hemisphere]
 
 #%% 
-def import_txt_file_as_dataframe(path_to_txt, hemisphere):
+def import_txt_file_as_dataframe(path_to_txt, hemisphere, return_labels=False):
     '''
     This function reads a txt file into a pandas dataframe.
     It does some additional processing steps to make the handling
@@ -75,6 +87,9 @@ def import_txt_file_as_dataframe(path_to_txt, hemisphere):
     - Create a class name for the Root region called ROOT.
     - Replace NaN values with 0.
     - Convert the Class column to the index of the dataframe.
+    If return_labels is True, the row names parsed by parse_region_labels
+    are returned as well (one row per row of data), such that they are 
+    parsed only once per file. Otherwise they are not parsed.
     '''
     data = pd.read_table(path_to_txt)
     img_name = data.loc[0,'Image Name']
@@ -88,28 +103,209 @@ def import_txt_file_as_dataframe(path_to_txt, hemisphere):
     
     # Now remove the 'wholeroot'. We'll use the seperate hemispheres.
     data = data.drop('wholeroot', axis=0)
+    labels = parse_region_labels(data.index) if return_labels else None
     
     # If a hemisphere is specified, remove the other hemisphere from the dataframe
-    if (hemisphere == 'Left'):
-        data = remove_hemisphere(data, 'Right')
-    elif (hemisphere == 'Right'):
-        data = remove_hemisphere(data, 'Left')
+    other_hemisphere = {'Left': 'Right', 'Right': 'Left'}.get(hemisphere)
+    if other_hemisphere is not None:
+        data = remove_hemisphere(data, other_hemisphere, labels)
+        if return_labels:
+            labels = select_region_labels(labels, labels[0] != other_hemisphere)
     
+    if return_labels:
+        return data,img_name,labels
     return data,img_name
 
+#%%
+def fingerprint_file(path, hash_content=True):
+    '''
+    Returns a dictionary with the size, modification time and 
+    (if hash_content is True) the SHA-1 hash of the contents of a file.
+    '''
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if hash_content:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        fingerprint['sha1'] = sha1.hexdigest()
+    
+    return fingerprint
+
+#%%
+def import_summed_cell_counts(path_to_txt, hemisphere, cache_dir=None, marker_panel=None, ontology_index=None,
+                              return_labels=False):
+    '''
+    Import a txt file (see import_txt_file_as_dataframe), and return 
+    the regions in it (see find_regions_and_classes_in_slice) and
+    the combined cell counts (see sum_cell_counts).
+    
+    If cache_dir is given, the results are cached in that directory:
+    the cell counts as a .npy file, and the row names, region names and 
+    a fingerprint of the txt file in a .json file. The next time the file 
+    is imported, the cache is used if the txt file has the same size and 
+    modification time, or the same contents, as the cached version.
+    Cached cell counts are memory-mapped (copy-on-write) instead of read.
+    The cache is not used if it was made with another marker panel (see sum_cell_counts).
+    
+    If the marker panel has a detection classifier (see make_marker_panel), the
+    cells are recounted from the per-detection exports of the txt file 
+    (see recount_from_detections), with the ontology_index. These counts are not cached.
+    
+    If return_labels is True, the parsed row names of the cell counts 
+    (see parse_region_labels) are returned as third output.
+    '''
+    
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    recount = marker_panel.get('detection_classifier') is not None
+    if recount:
+        if ontology_index is None:
+            raise ValueError('An ontology index is needed to recount the cells from the detections.')
+        cache_dir = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, os.path.basename(path_to_txt) + '.' + hemisphere)
+        with stage('load_cached_cell_counts'):
+            cached = load_cached_cell_counts(path_to_txt, cache_file)
+        if cached is not None and cached[1].columns.tolist() == ['area'] + marker_panel['tracers']:
+            count('cached files')
+            if return_labels:
+                return cached + (parse_region_labels(cached[1].index),)
+            return cached
+    
+    with stage('import_txt_file_as_dataframe'):
+        data,img_name,labels = import_txt_file_as_dataframe(path_to_txt, hemisphere, return_labels=True)
+    if recount:
+        with stage('recount_from_detections'):
+            data = recount_from_detections(data, path_to_txt, ontology_index, marker_panel, labels)
+    with stage('find_regions_and_classes_in_slice'):
+        region_dict = find_regions_and_classes_in_slice(data, labels)
+    with stage('sum_cell_counts'):
+        df = sum_cell_counts(data, marker_panel)
+        labels = select_region_labels(labels, data['DAPI: DAPI area um^2'].to_numpy() > 0) # see sum_cell_counts
+    count('files')
+    count('rows', len(data))
+    
+    if cache_dir is not None:
+        with stage('save_cached_cell_counts'):
+            save_cached_cell_counts(path_to_txt, cache_file, region_dict, df)
+    
+    if return_labels:
+        return region_dict,df,labels
+    return region_dict,df
+
+#%%
+def load_cached_cell_counts(path_to_txt, cache_file):
+    '''
+    Load cell counts that were cached by save_cached_cell_counts.
+    Returns None if there is no cache, or if the txt file changed.
+    '''
+    if not(os.path.exists(cache_file + '.json')) or not(os.path.exists(cache_file + '.npy')):
+        return None
+    with open(cache_file + '.json', 'r') as f:
+        meta = json.load(f)
+    
+    # Compare the txt file with the cached version.
+    # Only hash the contents if the modification time changed.
+    cached = meta['fingerprint']
+    current = fingerprint_file(path_to_txt, hash_content=False)
+    if current['size'] != cached['size']:
+        return None
+    if current['mtime_ns'] != cached['mtime_ns']:
+        current = fingerprint_file(path_to_txt)
+        if current['sha1'] != cached['sha1']:
+            return None
+        # Same contents: remember the new modification time
+        meta['fingerprint'] = current
+        _write_json_atomic(cache_file + '.json', meta)
+    
+    values = np.load(cache_file + '.npy', mmap_mode='c')
+    index = pd.Index(meta['index'], name=meta['index_name'], dtype=object)
+    df = pd.DataFrame(values, index=index, columns=meta['columns'], copy=False)
+    for column, dtype in meta['dtypes'].items():
+        if dtype != str(values.dtype):
+            df[column] = df[column].astype(dtype)
+    
+    return meta['regions'],df
+
+#%%
+def save_cached_cell_counts(path_to_txt, cache_file, region_dict, df):
+    '''
+    Cache the regions and cell counts of a txt file (see load_cached_cell_counts).
+    '''
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    meta = {'fingerprint': fingerprint_file(path_to_txt),
+            'index': df.index.tolist(),
+            'index_name': df.index.name,
+            'columns': df.columns.tolist(),
+            'dtypes': {column: str(dtype) for column, dtype in df.dtypes.items()},
+            'regions': region_dict}
+    
+    # Write to a temporary file first, such that an interrupted run
+    # never leaves a half-written cache behind.
+    with open(cache_file + '.tmp.npy', 'wb') as f:
+        np.save(f, df.to_numpy(dtype=float))
+    os.replace(cache_file + '.tmp.npy', cache_file + '.npy')
+    _write_json_atomic(cache_file + '.json', meta)
+
+def _write_json_atomic(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
 #%%
 def find_region_abbreviation(region_class):
     '''
     This function finds the region abbreviation
     by splitting the class value in the table.
     Example: 'Left: AVA' becomes 'AVA'.
+    Classes without hemisphere are not split.
+    See parse_region_labels to split many classes at once.
     '''
-    try: # try to split the class
-        region_abb = region_class.split(': ')[1]
-    except: # if splitting gives an error, don't split
-        region_abb = str(region_class)
+    parts = str(region_class).split(': ')
+    return parts[1] if len(parts) > 1 else parts[0]
+
+#%%
+def parse_region_labels(labels):
+    '''
+    Split region labels (e.g. 'Left: ACA') into their hemisphere and region acronym,
+    for all labels at once (like find_region_abbreviation). A single str.partition
+    per label is faster than the pandas string methods, which each take a pass over the labels.
+    
+    Output
+    ------
+        hemis (pandas categorical)
+        Hemisphere of each label ('' if the label has no hemisphere).
         
-    return region_abb
+        acronyms (np array)
+        Region acronym of each label (the full label if it has no hemisphere).
+    '''
+    parts = [str(label).partition(': ') for label in labels]
+    if len(parts) == 0:
+        return pd.Categorical([]),np.array([], dtype=object)
+    hemis = pd.Categorical([hemi if sep else '' for hemi, sep, rest in parts])
+    acronyms = np.array([rest.partition(': ')[0] if sep else hemi for hemi, sep, rest in parts], dtype=object)
+    
+    return hemis,acronyms
+
+def select_region_labels(labels, rows):
+    '''
+    Select rows (boolean mask or positions) of labels parsed by parse_region_labels.
+    '''
+    hemis,acronyms = labels
+    return hemis[rows],acronyms[rows]
+
+def concat_region_labels(labels_list):
+    '''
+    Concatenate labels parsed by parse_region_labels, in the same order as the
+    dataframes they belong to (e.g. the left and right hemisphere of a slice).
+    '''
+    if len(labels_list) == 1:
+        return labels_list[0]
+    hemis = pd.Categorical(np.concatenate([np.asarray(hemis, dtype=object) for hemis,acronyms in labels_list]))
+    acronyms = np.concatenate([acronyms for hemis,acronyms in labels_list])
+    return hemis,acronyms
 
 #%%
 def filter_uppercase_characters(string):
@@ -121,30 +317,26 @@ def filter_uppercase_characters(string):
     return ''.join(uppercase)
 
 #%%
-def find_regions_and_classes_in_slice(data):
+def find_regions_and_classes_in_slice(data, labels=None):
     '''
     This function reads a dataframe that corresponds to a brain slice,
     and returns a dictionary with the names of the classes appearing
     in the slice as keys, and the full region names as the corresponding value.
     Example: 
     region_dict['ACAd'] = 'Anterior cingulate area, dorsal part' 
+    The row names are parsed if their parsed labels (see parse_region_labels) are not given.
     '''
-    # Get the number of rows, columns in dataframe
-    num_regions, num_measurements = data.shape
-    # Initialize region_dict
-    region_dict = {}
-    # Loop through all regions
-    for region_class in data.index.tolist():
-        # Put the region class name (abbreviation)
-        # as key in the dictionary, and the full region name as corresponding value.
-        region_name = data.loc[region_class,'Name']
-        region_class = find_region_abbreviation(region_class)
-        region_dict[region_class] = region_name
+    # Put the region class name (abbreviation) of every row
+    # as key in the dictionary, and the full region name as corresponding value.
+    if labels is None:
+        labels = parse_region_labels(data.index)
+    hemis,acronyms = labels
+    region_dict = dict(zip(acronyms, data['Name']))
         
     return region_dict
 
 #%%
-def list_all_subregions(region_to_list, tree):
+def list_all_subregions(region_to_list, tree, ontology_index=None):
     '''
     This function lists all subregions belonging to region_to_list.
     It includes subregions on all hierarchical levels.
@@ -157,12 +349,22 @@ def list_all_subregions(region_to_list, tree):
         tree (dict)
         Dictionary with brain regions as keys and their children as value.
         
+        ontology_index (dict, optional)
+        Compiled ontology (see ontology_helpers.compile_ontology_index).
+        If given, the subregions are looked up in the index
+        instead of walking through the tree.
+        
     Output
     ------
         subregions (list)
         List of all subregions.
     '''
     
+    # With a compiled index, the subregions are a slice of the acronym list.
+    if ontology_index is not None and region_to_list in ontology_index['ids']:
+        region_id = ontology_index['ids'][region_to_list]
+        return ontology_index['acronyms'][region_id:ontology_index['end'][region_id]]
+    
     d = copy.deepcopy(tree) 
     subregions = [region_to_list]
 
@@ -190,6 +392,32 @@ def list_all_subregions(region_to_list, tree):
     
     return subregions
 
+#%%
+def split_region_labels(labels, ontology_index, parsed_labels=None):
+    '''
+    Split region labels (e.g. 'Left: ACA') into their hemisphere and region id.
+    If the labels were already parsed (see parse_region_labels), pass them as parsed_labels.
+    
+    Output
+    ------
+        hemis (np array)
+        Hemisphere of each label ('' if the label has no hemisphere).
+        
+        region_ids (np array)
+        Ontology id of each region (-1 if the region is not in the ontology,
+        or if the label has no hemisphere).
+    '''
+    if parsed_labels is None:
+        parsed_labels = parse_region_labels(labels)
+    hemis,acronyms = parsed_labels
+    hemis = np.asarray(hemis, dtype=object)
+    
+    # Intern the acronyms against the ontology: one hash lookup for all labels
+    region_ids = ontology_index['acronym_index'].get_indexer(acronyms).astype(np.int64)
+    region_ids[hemis == ''] = -1
+    
+    return hemis,region_ids
+
 #%%
 def list_regions_to_exclude(path_to_exclusion_file):
     '''
@@ -197,28 +425,97 @@ def list_regions_to_exclude(path_to_exclusion_file):
     and summarize the information in a dictionary.
     The exclusions_file is to be initialized with initExclusionFile
     '''
-    exclude_df = pd.read_csv(path_to_exclusion_file, sep=r'[;,]', index_col='Image Name', engine='python')
-    exclude_dict = {}
-
-    for img in exclude_df.index:
-        
-        exclude_dict[img] = []
-        to_exclude = exclude_df['Regions to Exclude (Regions may not overlap!)'].loc[img]
-        if type(to_exclude) == str: # if there are regions to exclude
-            for region in to_exclude.split('/ '):
-                
-                # If no hemisphere was specified, add both hemispheres:
-                if not 'Right' in region and not 'Left' in region:
-                    exclude_dict[img].append('Right: '+region)
-                    exclude_dict[img].append('Left: '+region)
-                # If left or right hemisphere was specified:
-                else:
-                    exclude_dict[img].append(region)
+    # The file is seperated by commas, or by semicolons if it was saved by a spreadsheet 
+    # program that uses them. We look at the header, such that the fast C parser can be used.
+    with open(path_to_exclusion_file, 'r') as f:
+        header = f.readline()
+    sep = ';' if header.count(';') > header.count(',') else ','
+    exclude_df = pd.read_csv(path_to_exclusion_file, sep=sep, index_col='Image Name')
+    exclude_dict = {img: [] for img in exclude_df.index}
+    
+    # Split the regions to exclude of all images at once (one row per region)
+    to_exclude = exclude_df['Regions to Exclude (Regions may not overlap!)']
+    to_exclude = to_exclude[to_exclude.map(type) == str] # images with regions to exclude
+    if len(to_exclude) == 0:
+        return exclude_dict
+    regions = to_exclude.str.split('/ ').explode()
+    regions = pd.DataFrame({'img': regions.index, 'region': regions.to_numpy(dtype=str)})
+    
+    # If no hemisphere was specified, add both hemispheres (right first).
+    # If left or right hemisphere was specified, keep the region.
+    has_hemi = regions['region'].str.contains('Right') | regions['region'].str.contains('Left')
+    right = regions.assign(label=np.where(has_hemi, regions['region'], 'Right: ' + regions['region']), side=0)
+    left = regions[~has_hemi].assign(label='Left: ' + regions['region'][~has_hemi], side=1)
+    labels = pd.concat([right, left]).rename_axis('position').sort_values(['position', 'side'])
+    for img, img_labels in labels.groupby('img', sort=False)['label']:
+        exclude_dict[img] = img_labels.tolist()
                 
     return exclude_dict
+
+#%%
+def compile_exclusions(regs_to_exclude, ontology_index):
+    '''
+    Compile a list of regions to exclude (e.g. ['Left: ACA', 'Right: MO']) into an
+    exclusion plan, that exclude_regions can apply directly.
+    
+    Output
+    ------
+        plan (dict)
+        Dictionary with the following keys:
+        'labels'     (list)     the regions to exclude.
+        'hemis'      (np array) hemisphere of every region to exclude, in listed order.
+        'region_ids' (np array) ontology id of every region to exclude, in listed order.
+        'overlaps'   (list)     (region, enclosing region) pairs of excluded regions 
+                                that lie within another excluded region.
+    '''
+    hemis,acronyms = parse_region_labels(regs_to_exclude)
+    hemis = np.asarray(hemis, dtype=object)
+    region_ids = ontology_index['acronym_index'].get_indexer(acronyms)
+    unknown = (region_ids < 0) | (hemis == '')
+    if np.any(unknown):
+        raise ValueError('Cannot exclude regions that are not in the ontology: ' + 
+                         str(np.array(regs_to_exclude, dtype=object)[unknown].tolist()))
+    end = ontology_index['end']
     
+    plan = {'labels': list(regs_to_exclude), 'hemis': hemis, 'region_ids': region_ids.astype(np.int64), 
+            'overlaps': []}
+    for hemi in pd.unique(hemis):
+        excluded_ids = pd.unique(region_ids[hemis == hemi])
+        
+        # Overlapping regions: sweep over the sorted intervals, keeping the enclosing ones on a stack
+        enclosing = []
+        for region_id in np.sort(excluded_ids):
+            while len(enclosing) > 0 and region_id >= end[enclosing[-1]]:
+                enclosing.pop()
+            if len(enclosing) > 0:
+                plan['overlaps'].append((hemi + ': ' + ontology_index['acronyms'][region_id],
+                                         hemi + ': ' + ontology_index['acronyms'][enclosing[-1]]))
+            enclosing.append(region_id)
+    
+    return plan
+
 #%%
-def exclude_regions(df, regs_to_exclude, edges, tree):
+def compile_exclusion_plans(exclude_dict, ontology_index):
+    '''
+    Compile the regions to exclude of all images (see list_regions_to_exclude) 
+    into exclusion plans (see compile_exclusions), and report overlapping exclusions.
+    Excluded regions that lie within another excluded region should not be listed:
+    if they are listed after the enclosing region, they were already removed, 
+    and exclude_regions raises a KeyError (unless skip_missing is True).
+    '''
+    plans = {}
+    for img, regs_to_exclude in exclude_dict.items():
+        try:
+            plans[img] = compile_exclusions(regs_to_exclude, ontology_index)
+        except ValueError as error:
+            raise ValueError(img + ': ' + str(error))
+        for region, enclosing_region in plans[img]['overlaps']:
+            print('! Overlapping exclusions in ' + img + ': ' + region + ' lies within ' + enclosing_region)
+    
+    return plans
+    
+#%%
+def exclude_regions(df, regs_to_exclude, edges, tree, ontology_index=None, labels=None, skip_missing=False):
     '''
     Take care of regions to be excluded from the analysis.
     If a region is to be excluded, 2 things must happen:
@@ -226,43 +523,209 @@ def exclude_regions(df, regs_to_exclude, edges, tree):
         its parent regions.
     (2) The region must disappear from the data, together with all 
          its daughter regions.
+    The ontology_index is compiled from edges if it is not given.
+    
+    The regions are excluded one by one, in the order they are listed, on a numpy 
+    array instead of the rows of the dataframe:
+    (1) The parent regions come from the region x ancestor incidence matrix of the ontology, 
+        and the counts are subtracted from all of them at once. NaN values are treated 
+        as 0 (to prevent "3-NaN=NaN"), unless both values are NaN.
+    (2) The excluded subtrees are removed with a single boolean mask at the end.
+    The results are the same as when the rows are changed and dropped one by one. 
+    In particular, a region that lies within a region excluded before it was already 
+    removed, and raises a KeyError. As in the original implementation with the pandas
+    version of environment.yml, all columns become floats if a region is excluded.
+    
+    regs_to_exclude is a list of regions ('Left: ACA', ...), or an exclusion
+    plan made by compile_exclusions.
+    labels are the parsed row names of df (see parse_region_labels), if they are known.
+    
+    If a region to exclude, or one of its parent regions, is not in the data, a KeyError
+    is raised. With skip_missing=True, the missing parent regions are skipped, and a 
+    missing region to exclude is replaced by its outermost subregions in the data 
+    (e.g. 'Left: MOp' and 'Left: MOs' if 'Left: MO' is excluded but was not in the slice), 
+    such that their cells are still subtracted from the parent regions.
     '''
+    
+    if len(regs_to_exclude) == 0:
+        return df
+    if ontology_index is None:
+        ontology_index = compile_ontology_index(edges)
+    plan = regs_to_exclude if isinstance(regs_to_exclude, dict) else compile_exclusions(regs_to_exclude, ontology_index)
+    if len(plan['labels']) == 0:
+        return df
+    acronyms = ontology_index['acronyms']
+    end = ontology_index['end']
+    
+    # Split the row names of the dataframe ('Left: ACA') into hemisphere and region id,
+    # and find the row of every region id per hemisphere (-1 if the region is not in the data).
+    row_hemis, row_ids = split_region_labels(df.index, ontology_index, labels)
+    row_of_id = {}
+    for hemi in pd.unique(plan['hemis']):
+        hemi_rows = np.flatnonzero((row_hemis == hemi) & (row_ids >= 0))
+        row_of_id[hemi] = np.full(len(acronyms), -1, dtype=np.int64)
+        row_of_id[hemi][row_ids[hemi_rows]] = hemi_rows
+    
+    values = df.to_numpy(dtype=float)
+    keep = np.ones(len(df), dtype=bool)
+    for label, hemi, region_id in zip(plan['labels'], plan['hemis'], plan['region_ids']):
+        rows = row_of_id[hemi]
+        
+        # The regions whose counts are subtracted
+        if rows[region_id] >= 0:
+            subtracted_ids = [region_id]
+        elif skip_missing:
+            # Outermost subregions in the data: sweep over the subtree in preorder
+            subtracted_ids = []
+            for subregion_id in region_id + np.flatnonzero(rows[region_id:end[region_id]] >= 0):
+                if len(subtracted_ids) == 0 or subregion_id >= end[subtracted_ids[-1]]:
+                    subtracted_ids.append(subregion_id)
+        else:
+            raise KeyError(label)
+        
+        # Step 1: subtract the counting results from all parent regions.
+        for subtracted_id in subtracted_ids:
+            parent_rows = rows[ontology_index['ancestor_matrix'][subtracted_id].indices]
+            if np.any(parent_rows < 0):
+                if not skip_missing:
+                    missing = ontology_index['ancestor_matrix'][subtracted_id].indices[parent_rows < 0]
+                    raise KeyError(hemi + ': ' + acronyms[missing.max()])
+                parent_rows = parent_rows[parent_rows >= 0]
+            excluded = values[rows[subtracted_id]]
+            parents = values[parent_rows]
+            values[parent_rows] = np.where(np.isnan(parents) & np.isnan(excluded), np.nan, 
+                                           np.nan_to_num(parents) - np.nan_to_num(excluded))
+        
+        # Step 2: remove the region together with its daughter regions.
+        subtree_rows = rows[region_id:end[region_id]]
+        keep[subtree_rows[subtree_rows >= 0]] = False
+        rows[region_id:end[region_id]] = -1
+    
+    return pd.DataFrame(values[keep], index=df.index[keep], columns=df.columns)
 
-    # Take care of regions to exclude
-    for reg_hemi in regs_to_exclude:
-        hemi = reg_hemi.split(': ')[0]
-        reg = reg_hemi.split(': ')[1]
-
-        # Step 1: subtract counting results of the regions to be excluded
-        # from their parent regions.
-        child = reg
-        while True:
-            parent = edges[child]
-            row = hemi+': '+parent
-            # Subtract the counting results from the parent region.
-            # Use fill_value=0 to prevent "3-NaN=NaN".
-            df.loc[row] = df.loc[row].subtract( df.loc[reg_hemi], fill_value=0 )
-            if (parent == 'root'):
-                break
-            child = parent # go one step further in the tree
-
-        # Step 2: Remove the regions that should be excluded
-        # together with their daughter regions.
-        subregions = list_all_subregions(reg, tree)
-        for subreg in subregions:
-            row = hemi+': '+subreg
-            if row in df.index:
-                df = df.drop(row)
-            
-    return df
+#%%
+def load_slice(root, f, file_names, exclude_dict, edges, tree, ontology_index, cache_dir=None, marker_panel=None):
+    '''
+    Load the cell counts of one slice (image name f, e.g. "Image_01.vsi - 10x_01").
+    The slice can be stored as one file for both hemispheres, or as
+    seperate files for the left and right hemisphere.
+    If cache_dir is given, the files are cached there (see import_summed_cell_counts).
+    See sum_cell_counts for the marker_panel.
+    The row names of every file are parsed once (see parse_region_labels), 
+    and reused until the excluded regions are removed.
+    
+    Output
+    ------
+        region_dict (dict)
+        Region abbreviations in the slice as keys, and full region names as values.
+        
+        df (pandas dataframe)
+        Cell counts in the slice, with the excluded regions removed.
+    '''
+
+    # The following variables will be used to find out whether we have seperate files
+    # for seperate hemispheres, or just one file containing both hemispheres.
+    fname = f + '_regions.txt'
+    fname_left = f + '_LEFT' + '_regions.txt'
+    fname_right = f + '_RIGHT' + '_regions.txt'
+    both_hemi = False
+    right_hemi = False
+    left_hemi = False
+    to_exclude = [] # regions to exclude of every file (lists, or plans of compile_exclusion_plans)
+
+    # Read text file into a Pandas dataframe, 
+    # find the regions in it and combine the cell counts.
+    if fname_left in file_names: # if we have img_name LEFT_regions.txt in folder
+        left_hemi = True
+        path = os.path.join(root, fname_left)
+        regions_left,df_left,labels_left = import_summed_cell_counts(path, 'Left', cache_dir, marker_panel, ontology_index,
+                                                                     return_labels=True)
+        to_exclude.append(exclude_dict[fname_left])
+    if fname_right in file_names: # if we have img_name RIGHT_regions.txt in folder
+        right_hemi = True
+        path = os.path.join(root, fname_right)
+        regions_right,df_right,labels_right = import_summed_cell_counts(path, 'Right', cache_dir, marker_panel, ontology_index,
+                                                                        return_labels=True)
+        to_exclude.append(exclude_dict[fname_right])
+    if fname in file_names:       # if we have img_name_regions.txt (no hemisphere specification)
+        both_hemi = True
+        path = os.path.join(root, fname)
+        region_dict,df,labels = import_summed_cell_counts(path, 'Both', cache_dir, marker_panel, ontology_index,
+                                                          return_labels=True)
+        to_exclude.append(exclude_dict[fname])
+
+    # Check for safety: we either have ONE file for both hemispheres,
+    # or (max 2) file(s) for seperate hemispheres. Else, raise and error.
+    if (left_hemi and both_hemi) or (right_hemi and both_hemi):
+        raise ValueError('Either LEFT and/or RIGHT, or no hemisphere specification. But not both!')
+    if not(left_hemi) and not(right_hemi) and not(both_hemi):
+        raise ValueError('Filename not found!')
+
+    # Combine left and right, if they were both present
+    if left_hemi and right_hemi:        # if we have both left and right, combine dataframes
+        region_dict = {**regions_left, **regions_right}
+        df = pd.concat([df_left, df_right])
+        labels = concat_region_labels([labels_left, labels_right])
+    elif left_hemi and not(right_hemi): # if we have only left, data = data_left
+        region_dict,df,labels = regions_left,df_left,labels_left
+    elif not(left_hemi) and right_hemi: # if we have only right, data = data_right
+        region_dict,df,labels = regions_right,df_right,labels_right
+    
+    # Take care of regions to be excluded
+    if len(to_exclude) == 1:
+        regs_to_exclude = to_exclude[0]
+    else:
+        regs_to_exclude = [label for regs in to_exclude for label in (regs['labels'] if isinstance(regs, dict) else regs)]
+    with stage('exclude_regions'):
+        df = exclude_regions(df, regs_to_exclude, edges, tree, ontology_index, labels)
+    count('slices')
+    
+    return region_dict,df
 
 #%%
-def load_cell_counts(root, exclude_dict, edges, tree):
+# State shared with the worker processes of load_cell_counts and
+# collect_and_analyze_cell_counts. It is set once per worker (by _init_worker), 
+# such that the ontology is not pickled again for every task.
+_worker_state = {}
+
+def _init_worker(*args):
+    _worker_state['args'] = args
+
+def _init_plotting_worker(*args):
+    plt.switch_backend('Agg')
+    _init_worker(*args)
+
+def _init_analysis_worker(settings, *args):
+    enable_profiling(**settings)
+    _init_plotting_worker(*args)
+
+def _load_slice_in_worker(f):
+    return load_slice(_worker_state['args'][0], f, *_worker_state['args'][1:])
+
+#%%
+def load_cell_counts(root, exclude_dict, edges, tree, ontology_index=None, workers=None, use_threads=False, use_cache=False,
+                     marker_panel=None):
     '''
     Function to load cell counts, stored in .csv files in the 'root' directory,
     as Pandas dataframes.
+    The ontology_index is compiled from edges if it is not given.
+    
+    The slices are loaded one after another, unless workers is set to the
+    number of slices to load in parallel. By default a pool of processes is used;
+    set use_threads=True to use a pool of threads instead. Note that with processes
+    the calling script should be protected by "if __name__ == '__main__':" 
+    on systems that start new processes by spawning (Windows, macOS).
+    The slices are returned in the same order, whether they are loaded in parallel or not.
+    
+    With use_cache=True, the parsed files are cached in a '.cache' folder inside root.
+    Files that did not change since the previous run are loaded from the cache.
+    See sum_cell_counts for the marker_panel.
     '''
     
+    if ontology_index is None:
+        ontology_index = compile_ontology_index(edges)
+    cache_dir = os.path.join(root, '.cache') if use_cache else None
+    
     # Get the image names present in root (e.g. "Image_01.vsi - 10x_01")
     # and the names of all files present in root (e.g. "Image_01.vsi - 10x_01 LEFT_regions.txt")
     img_names = get_image_names_in_folder(root)
@@ -273,103 +736,380 @@ def load_cell_counts(root, exclude_dict, edges, tree):
     slice_data = {}      # what are the cell counts per slice?
     df_list = []         # list of all slice dataframes
     
-    # Loop through the image names
-    for f in img_names:
-
-        # The following variables will be used to find out whether we have seperate files
-        # for seperate hemispheres, or just one file containing both hemispheres.
-        fname = f + '_regions.txt'
-        fname_left = f + '_LEFT' + '_regions.txt'
-        fname_right = f + '_RIGHT' + '_regions.txt'
-        both_hemi = False
-        right_hemi = False
-        left_hemi = False
-        regs_to_exclude = []
-
-        # Read text file into a Pandas dataframe
-        if fname_left in file_names: # if we have img_name LEFT_regions.txt in folder
-            left_hemi = True
-            path = os.path.join(root, fname_left)
-            data_left,img_name_left = import_txt_file_as_dataframe(path, 'Left')
-            regs_to_exclude = regs_to_exclude + exclude_dict[fname_left]
-        if fname_right in file_names: # if we have img_name RIGHT_regions.txt in folder
-            right_hemi = True
-            path = os.path.join(root, fname_right)
-            data_right,img_name_right = import_txt_file_as_dataframe(path, 'Right')
-            regs_to_exclude = regs_to_exclude + exclude_dict[fname_right]
-        if fname in file_names:       # if we have img_name_regions.txt (no hemisphere specification)
-            both_hemi = True
-            path = os.path.join(root, fname)
-            data,img_name = import_txt_file_as_dataframe(path, 'Both')
-            regs_to_exclude = regs_to_exclude + exclude_dict[fname]
-
-        # Check for safety: we either have ONE file for both hemispheres,
-        # or (max 2) file(s) for seperate hemispheres. Else, raise and error.
-        if (left_hemi and both_hemi) or (right_hemi and both_hemi):
-            raise ValueError('Either LEFT and/or RIGHT, or no hemisphere specification. But not both!')
-        if not(left_hemi) and not(right_hemi) and not(both_hemi):
-            raise ValueError('Filename not found!')
-
-        # Combine left and right, if they were both present
-        if left_hemi and right_hemi:        # if we have both left and right, combine dataframes
-            data = pd.concat([data_left, data_right])
-        elif left_hemi and not(right_hemi): # if we have only left, data = data_left
-            data = data_left
-        elif not(left_hemi) and right_hemi: # if we have only right, data = data_right
-            data = data_right
-
-        # Find regions in current slice
-        region_dict = find_regions_and_classes_in_slice(data)
-
-        # Combine cell counts
-        df = sum_cell_counts(data)
-        
-        # Take care of regions to be excluded
-        df = exclude_regions(df, regs_to_exclude, edges, tree)
-        
-        # Store results in dictionaries / lists
+    # Load the slices
+    if workers is None or workers <= 1:
+        results = [load_slice(root, f, file_names, exclude_dict, edges, tree, ontology_index, cache_dir, marker_panel) 
+                   for f in img_names]
+    elif use_threads:
+        # Threads share memory, so they can use the ontology directly.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda f: load_slice(root, f, file_names, exclude_dict, edges, tree, ontology_index, cache_dir, marker_panel),
+                img_names))
+    else:
+        init_args = (root, file_names, exclude_dict, edges, tree, ontology_index, cache_dir, marker_panel)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, 
+                                 initargs=init_args) as executor:
+            results = list(executor.map(_load_slice_in_worker, img_names))
+    
+    # Store results in dictionaries / lists.
+    for f, (region_dict, df) in zip(img_names, results):
         slice_regions[f] = region_dict
         slice_data[f] = df
         df_list.append(df)
     
     return df_list,slice_regions,slice_data
+
+#%%
+def iter_cell_counts(root, exclude_dict, edges, tree, ontology_index=None, use_cache=False, marker_panel=None):
+    '''
+    Generator version of load_cell_counts, for a low memory footprint.
+    The slices are loaded one after another, and (img_name, region_dict, df) 
+    is yielded for every slice. Nothing is kept after a slice is yielded.
+    See load_cell_counts for the other inputs.
+    '''
+    
+    if ontology_index is None:
+        ontology_index = compile_ontology_index(edges)
+    cache_dir = os.path.join(root, '.cache') if use_cache else None
+    
+    img_names = get_image_names_in_folder(root)
+    file_names = os.listdir(root)
+    for f in img_names:
+        region_dict,df = load_slice(root, f, file_names, exclude_dict, edges, tree, ontology_index, cache_dir, marker_panel)
+        yield f,region_dict,df
     
 #%%
-def sum_cell_counts(data):
+# Order of the hemispheres in a running sum of cell counts (see add_to_running_sum)
+HEMISPHERES = ['Left', 'Right']
+
+def add_to_running_sum(running, df, ontology_index):
+    '''
+    Add the cell counts of a slice (e.g. from load_slice) to a running sum per region,
+    with a fixed row for every region in every hemisphere. 
+    Region 'Left: ACA' gets row id ontology_index['ids']['ACA'], and 'Right: ACA'
+    gets row id num_regions + ontology_index['ids']['ACA'] (see HEMISPHERES).
+    Start a new sum with running = None.
+    
+    Output
+    ------
+        running (dict or None)
+        Dictionary with the following keys:
+        'counts'  (np array) summed cell counts with shape (2*num_regions, measurements).
+                             Missing regions and NaN values are 0.
+        'present' (np array) True for the regions present in any slice.
+        'labels'  (pandas index) region label ('Left: ACA') of each row.
+        'columns' (list)     measurement names ('area', 'CTB', ...).
+        'dtypes'  (list)     data type of each measurement.
+        'index_name' (str)   name of the row index of the slice dataframes.
+        None is returned if the slice contains a region that is not in the ontology,
+        or other measurements than the running sum.
+    '''
+    if running is None:
+        labels = pd.Index([hemi + ': ' + acronym for hemi in HEMISPHERES for acronym in ontology_index['acronyms']])
+        running = {'counts': np.zeros((len(labels), len(df.columns))),
+                   'present': np.zeros(len(labels), dtype=bool),
+                   'labels': labels,
+                   'columns': df.columns.tolist(),
+                   'dtypes': df.dtypes.tolist(),
+                   'index_name': df.index.name}
+    elif df.columns.tolist() != running['columns']:
+        return None
+    
+    # Look up the row of every region label in one hash lookup (no parsing needed)
+    rows = running['labels'].get_indexer(df.index)
+    if np.any(rows < 0):
+        return None
+    values = df.to_numpy(dtype=float, na_value=0.0)
+    if df.index.is_unique:
+        running['counts'][rows] += values
+    else:
+        np.add.at(running['counts'], rows, values)
+    running['present'][rows] = True
+    dtypes = df.dtypes.tolist()
+    if dtypes != running['dtypes']:
+        running['dtypes'] = [np.result_type(a, b) for a, b in zip(running['dtypes'], dtypes)]
+    
+    return running
+
+def running_sum_to_dataframe(running):
+    '''
+    Convert a running sum of cell counts (see add_to_running_sum) into a dataframe.
+    The output is the same dataframe as pd.concat(df_list).groupby(...).sum():
+    it contains the regions present in any slice, sorted by name.
+    '''
+    rows = np.flatnonzero(running['present'])
+    labels = running['labels'][rows]
+    order = np.argsort(labels.to_numpy(dtype=object), kind='stable')
+    brain_df = pd.DataFrame(running['counts'][rows[order]], index=pd.Index(labels[order], name=running['index_name']),
+                            columns=running['columns'])
+    for column, dtype in zip(running['columns'], running['dtypes']):
+        if dtype != brain_df[column].dtype:
+            brain_df[column] = brain_df[column].astype(dtype)
+    
+    return brain_df
+
+#%%
+def sum_slices(df_list, ontology_index):
+    '''
+    Sum the cell counts (area, CTB, ...) per region across all slices.
+    When all slices are in memory, pandas is as fast as a running sum 
+    (see sum_slices_streaming), which has to track the data types of every slice.
+    '''
+    # Concatenate the dataframes of all slices into one big dataframe (brain_df).
+    # Then, combine the rows with the same index (=region name), and sum them.
+    brain_df = pd.concat(df_list)
+    brain_df = brain_df.groupby(brain_df.index, axis=0).sum()
+    
+    return brain_df
+
+def sum_slices_streaming(slices, ontology_index):
+    '''
+    Sum the cell counts per region across slices, like sum_slices, 
+    but one slice at a time: slices can be a generator of dataframes 
+    (e.g. from iter_cell_counts). Only the running sum is kept in memory
+    (see add_to_running_sum), or a running sum with pandas if a region is 
+    not in the ontology.
+    '''
+    running = None    # running sum per region (see add_to_running_sum)
+    brain_df = None   # running sum with pandas, if a region is not in the ontology
+    for df in slices:
+        if brain_df is None:
+            added = add_to_running_sum(running, df, ontology_index)
+            if added is not None:
+                running = added
+                continue
+            brain_df = running_sum_to_dataframe(running) if running is not None else df.iloc[:0]
+        
+        # Concatenate the dataframes, combine the rows with the same index (=region name), and sum them.
+        brain_df = pd.concat([brain_df, df])
+        brain_df = brain_df.groupby(brain_df.index, axis=0).sum()
+    
+    if brain_df is None and running is None:
+        raise ValueError('No slices to sum.')
+    if brain_df is None:
+        brain_df = running_sum_to_dataframe(running)
+    
+    return brain_df
+
+#%%
+# Marker panel: the QuPath class of each marker, and its abbreviation in the tracer names.
+# Cells positive for multiple markers have a combined class, e.g. 'CTB: Rabies'.
+MARKERS = {'CTB': 'CTB', 'Rabies': 'RAB', 'TVA': 'TVA'}
+
+def make_marker_panel(markers, detection_classifier=None):
+    '''
+    Generate the class columns and tracers for a panel of N markers.
+    Every combination of markers is represented by a bitmask, in which bit i
+    is set if the cells are positive for marker i (markers sorted by class name,
+    like QuPath does when it combines classes).
+    
+    Inputs
+    ------
+        markers (dict)
+        QuPath class names of the markers as keys, and their abbreviations as values.
+        Example: {'CTB': 'CTB', 'Rabies': 'RAB', 'TVA': 'TVA'}
+        
+        detection_classifier (function)
+        If given, the cells are recounted from the per-detection exports 
+        instead of taken from the region exports (see count_detections).
+        detection_classifier(detections, marker_panel) returns the class bitmask 
+        of every detection (see detection_class_masks, which keeps the QuPath classes).
+        It should be a module-level function, to be sent to worker processes.
+        
+    Output
+    ------
+        marker_panel (dict)
+        Dictionary with the following keys:
+        'markers'       (list)     class names of the markers, sorted.
+        'class_columns' (list)     QuPath column with the number of cells of each class. 
+                                   Column k-1 holds the cells with class bitmask k ('Num CTB: Rabies' is 3).
+        'tracers'       (list)     name of each tracer, from single positives 
+                                   to cells positive for all markers ('CTB', ..., 'CTB_RAB_TVA').
+        'tracer_masks'  (np array) bitmask of each tracer.
+        A tracer counts all cells positive for at least its markers. 
+        Example: 'CTB_RAB' counts the classes 'CTB: Rabies' and 'CTB: Rabies: TVA'.
+        'detection_classifier' (function or None)
+    '''
+    class_names = sorted(markers)
+    num_markers = len(class_names)
+    
+    class_columns = []
+    for mask in range(1, 2**num_markers):
+        in_class = [name for i, name in enumerate(class_names) if mask & (1 << i)]
+        class_columns.append('Num ' + ': '.join(in_class))
+    
+    tracers = []
+    tracer_masks = []
+    for num_positive in range(1, num_markers+1):
+        for combination in itertools.combinations(range(num_markers), num_positive):
+            tracers.append('_'.join(markers[class_names[i]] for i in combination))
+            tracer_masks.append(sum(1 << i for i in combination))
+    
+    marker_panel = {'markers': class_names,
+                    'class_columns': class_columns,
+                    'tracers': tracers,
+                    'tracer_masks': np.array(tracer_masks),
+                    'detection_classifier': detection_classifier}
+    
+    return marker_panel
+
+MARKER_PANEL = make_marker_panel(MARKERS)
+
+#%%
+def sum_cell_counts(data, marker_panel=None):
     '''
     This function takes as input raw data from a csv file (data = a dataframe created with pd.read_csv).
     It converts counts (Num CTB (only), Num CTB: Rabies (only), etc) to number of detected cells ('CTB, RAB', etc).
-    To do this it sums the relevant counts.
+    To do this it sums the relevant counts: for every tracer, the counts of all classes
+    that are positive for (at least) the markers of the tracer.
+    The marker_panel (see make_marker_panel) defaults to MARKER_PANEL.
     '''
     
-    # The parameters we are interested in
-    param_list = ['area',                             # DAPI area
-                  'CTB', 'RAB', 'TVA',                # single positives + double positives + triple positives
-                  'CTB_RAB', 'CTB_TVA', 'RAB_TVA',    # double positives + triple positives
-                  'CTB_RAB_TVA']                      # triple positives
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
     
-    # Make an empty table with rows = all regions in current slice, columns = param_list
-    df = pd.DataFrame(np.nan, index=data.index, columns=param_list)
+    # The parameters we are interested in: DAPI area and the tracers.
+    # The columns are collected first, and the table (rows = all regions in 
+    # current slice) is made at once.
+    params = {'area': data['DAPI: DAPI area um^2']}
     
     # Warning: below, you'll notice that columns are summed a bit weirdly.
-    # I used df['c'] = df[['a','b']].sum(axis=1, min_count=1) to sum up columns 'a' and 'b'.
+    # I used data[['a','b']].sum(axis=1, min_count=1) to sum up columns 'a' and 'b'.
     # min_count=1 ensures that the sum of NaN values is NaN (and not 0).
-
-    df['area'] = data['DAPI: DAPI area um^2']
-    # single positives + double positives + triple positives
-    df['CTB'] = data[['Num CTB', 'Num CTB: Rabies', 'Num CTB: TVA', 'Num CTB: Rabies: TVA']].sum(axis=1, min_count=1)
-    df['RAB'] = data[['Num Rabies', 'Num CTB: Rabies', 'Num Rabies: TVA', 'Num CTB: Rabies: TVA']].sum(axis=1, min_count=1)
-    df['TVA'] = data[['Num TVA', 'Num CTB: TVA', 'Num Rabies: TVA', 'Num CTB: Rabies: TVA']].sum(axis=1, min_count=1)
-    # double positives + triple positives
-    df['CTB_RAB'] = data[['Num CTB: Rabies', 'Num CTB: Rabies: TVA']].sum(axis=1, min_count=1)
-    df['CTB_TVA'] = data[['Num CTB: TVA', 'Num CTB: Rabies: TVA']].sum(axis=1, min_count=1)
-    df['RAB_TVA'] = data[['Num Rabies: TVA', 'Num CTB: Rabies: TVA']].sum(axis=1, min_count=1)
-    # triple positives
-    df['CTB_RAB_TVA'] = data['Num CTB: Rabies: TVA']  
+    # Example: 'CTB_RAB' sums 'Num CTB: Rabies' and 'Num CTB: Rabies: TVA'.
+    for tracer, tracer_mask in zip(marker_panel['tracers'], marker_panel['tracer_masks']):
+        columns = [column for mask, column in enumerate(marker_panel['class_columns'], start=1) 
+                   if mask & tracer_mask == tracer_mask]
+        if len(columns) == 1: # e.g. triple positives
+            params[tracer] = data[columns[0]]
+        else:
+            params[tracer] = data[columns].sum(axis=1, min_count=1)
+    df = pd.DataFrame(params)
 
     # Return only those regions where DAPI was found
     return df[df['area'] > 0]
 
+#%%
+def list_detection_files(path_to_txt):
+    '''
+    Returns the per-detection exports (chunks) that belong to a _regions.txt file,
+    e.g. 'Image_01_detections_000.tsv', 'Image_01_detections_001.tsv', ... 
+    for 'Image_01_regions.txt' (see 2. ExportABBACellCountResults.groovy).
+    '''
+    folder,fname = os.path.split(path_to_txt)
+    prefix = fname.replace('_regions.txt', '') + '_detections_'
+    files = sorted(f for f in os.listdir(folder) if f.startswith(prefix) and f.endswith('.tsv'))
+    return [os.path.join(folder, f) for f in files]
+
+def iter_detections(paths, columns=None, chunksize=None):
+    '''
+    Read per-detection exports chunk by chunk, and yield every chunk as a dataframe.
+    Every file is one chunk, unless chunksize (number of rows) is given.
+    Only the given columns are read (all columns if None).
+    '''
+    for path in paths:
+        if chunksize is None:
+            yield pd.read_table(path, usecols=columns, engine='c')
+        else:
+            with pd.read_table(path, usecols=columns, engine='c', chunksize=chunksize) as reader:
+                yield from reader
+
+def detection_class_masks(detections, marker_panel):
+    '''
+    Default detection classifier: the class bitmask (see make_marker_panel) of every 
+    detection, from the marker columns of the export (1 if the cell was positive for the marker).
+    Write a function with the same inputs and output to count the cells with other rules,
+    e.g. a threshold on a measurement, and pass it to make_marker_panel.
+    '''
+    masks = np.zeros(len(detections), dtype=np.int64)
+    for i, marker in enumerate(marker_panel['markers']):
+        masks |= (detections[marker].to_numpy() > 0).astype(np.int64) << i
+    return masks
+
+def count_detections(detection_chunks, ontology_index, marker_panel=None):
+    '''
+    Count the detections per region and class, while streaming over the chunks.
+    Every chunk is counted with one np.bincount over (hemisphere, region id, class bitmask).
+    Like in the QuPath exports, the count of a region includes its subregions.
+    
+    Inputs
+    ------
+        detection_chunks (iterable)
+        Dataframes with a 'Region' column (e.g. 'Left: ACA', see iter_detections),
+        and the columns used by the detection classifier.
+        
+        ontology_index (dict)
+        Compiled ontology (see ontology_helpers.compile_ontology_index).
+        
+        marker_panel (dict)
+        See make_marker_panel. The classes are found by its 'detection_classifier'
+        (detection_class_masks by default).
+        
+    Output
+    ------
+        counts (np array)
+        Counts with shape (2 * number of regions, 2**number of markers). 
+        Row hemisphere*num_regions + region id (see HEMISPHERES), column class bitmask.
+        Detections outside the atlas regions are not counted.
+    '''
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    classifier = marker_panel.get('detection_classifier') or detection_class_masks
+    num_regions = len(ontology_index['acronyms'])
+    num_classes = 2**len(marker_panel['markers'])
+    counts = np.zeros(len(HEMISPHERES) * num_regions * num_classes, dtype=np.int64)
+    
+    for detections in detection_chunks:
+        hemis,acronyms = parse_region_labels(detections['Region'].fillna(''))
+        hemi_ids = pd.Index(HEMISPHERES).get_indexer(hemis)
+        region_ids = ontology_index['acronym_index'].get_indexer(acronyms)
+        masks = np.asarray(classifier(detections, marker_panel), dtype=np.int64)
+        
+        known = (hemi_ids >= 0) & (region_ids >= 0)
+        rows = hemi_ids[known] * num_regions + region_ids[known]
+        counts += np.bincount(rows * num_classes + masks[known], minlength=len(counts))
+        count('detections', len(detections))
+    
+    # Add the counts of all subregions: they are a contiguous slice in preorder,
+    # so the sum over a subtree is a difference of cumulative sums.
+    counts = counts.reshape(len(HEMISPHERES), num_regions, num_classes)
+    cumulative = np.zeros((len(HEMISPHERES), num_regions+1, num_classes), dtype=np.int64)
+    np.cumsum(counts, axis=1, out=cumulative[:, 1:])
+    subtree_counts = cumulative[:, ontology_index['end']] - cumulative[:, :-1]
+    
+    return subtree_counts.reshape(len(HEMISPHERES) * num_regions, num_classes)
+
+def recount_from_detections(data, path_to_txt, ontology_index, marker_panel=None, labels=None):
+    '''
+    Replace the class counts ('Num CTB', 'Num CTB: Rabies', ...) of a region export 
+    (see import_txt_file_as_dataframe) by the counts of its per-detection exports
+    (see count_detections). Rows of regions that are not in the ontology keep their exported counts.
+    labels are the parsed row names of data (see parse_region_labels), if they are known.
+    '''
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    paths = list_detection_files(path_to_txt)
+    if len(paths) == 0:
+        raise ValueError('Cannot find the detection exports of ' + path_to_txt + '!')
+    counts = count_detections(iter_detections(paths), ontology_index, marker_panel)
+    
+    if labels is None:
+        labels = parse_region_labels(data.index)
+    hemis,acronyms = labels
+    hemi_ids = pd.Index(HEMISPHERES).get_indexer(hemis)
+    region_ids = ontology_index['acronym_index'].get_indexer(acronyms)
+    known = (hemi_ids >= 0) & (region_ids >= 0)
+    rows = hemi_ids[known] * len(ontology_index['acronyms']) + region_ids[known]
+    
+    data = data.copy()
+    for k, column in enumerate(marker_panel['class_columns'], start=1):
+        values = data[column].to_numpy(dtype=float) if column in data else np.full(len(data), np.nan)
+        values[known] = counts[rows, k]
+        data[column] = values if np.isnan(values).any() else values.astype(np.int64)
+    
+    return data
+
 #%%
 def init_dict(key_list, init_value):
     '''
@@ -385,6 +1125,53 @@ def init_dict(key_list, init_value):
     
     return output_dict
 
+#%%
+def split_hemispheres(data):
+    '''
+    Vectorized version of sort_hemispheres, for all columns of data at once.
+    The region labels ('Left: ACA') are split once into their hemisphere and region,
+    and the values are scattered into an array with one row per region.
+    
+    Inputs
+    ------
+        data (pandas dataframe or series)
+        Rows are regions, with left and right seperated (e.g. brain_df).
+        
+    Output
+    ------
+        data_sorted (pandas dataframe)
+        One row per region, in order of appearance in data. The columns are
+        (column, hemisphere) pairs, with hemispheres 'Left', 'Right' and 'Sum'.
+        If data is a series, the columns are only the hemispheres.
+    '''
+    is_series = isinstance(data, pd.Series)
+    columns = [data.name] if is_series else data.columns.tolist()
+    values = data.to_numpy(dtype=float).reshape(len(data), len(columns))
+    
+    # Split the labels into hemisphere and region. Labels without hemisphere are kept as region.
+    hemis,regions = parse_region_labels(data.index)
+    region_codes,present_regions = pd.factorize(regions)
+    
+    # Put the values of each hemisphere in its own layer
+    sorted_values = np.full((len(present_regions), len(HEMISPHERES)+1, len(columns)), np.nan)
+    for code, hemi in enumerate(HEMISPHERES):
+        in_hemi = hemis == hemi
+        sorted_values[region_codes[in_hemi], code] = values[in_hemi]
+    
+    # Sum of left and right (NaN if both are NaN)
+    hemi_values = sorted_values[:, :len(HEMISPHERES)]
+    sorted_values[:, -1] = np.where(np.all(np.isnan(hemi_values), axis=1), np.nan, 
+                                    np.nansum(hemi_values, axis=1))
+    
+    hemispheres = HEMISPHERES + ['Sum']
+    if is_series:
+        return pd.DataFrame(sorted_values[:, :, 0], index=list(present_regions), columns=hemispheres)
+    data_sorted = pd.DataFrame(sorted_values.transpose(0, 2, 1).reshape(len(present_regions), -1),
+                               index=list(present_regions), 
+                               columns=pd.MultiIndex.from_product([columns, hemispheres]))
+    
+    return data_sorted
+
 #%%
 def sort_hemispheres(data):
     '''
@@ -393,28 +1180,17 @@ def sort_hemispheres(data):
     
     The output is a dataframe with three columns:
     'Left' for each region, 'Right' for each region and the sum of the two.
+    See split_hemispheres to sort several columns at once.
     '''
     
-    all_regions = data.index.to_list()
-    present_regions = [find_region_abbreviation(r) for r in all_regions]
-    present_regions = list(dict.fromkeys(present_regions)) # remove doubles
+    if isinstance(data, pd.DataFrame):
+        data = data.iloc[:, 0]
     
-    # Put normalized counts of seperate hemispheres in seperate columns
-    data_sorted = pd.DataFrame(np.nan, index=present_regions, columns=['Left', 'Right', 'Sum'])
-    for region in present_regions:
-        if 'Left: ' + region in all_regions:
-            data_sorted['Left'][region] = data['Left: ' + region]
-        if 'Right: ' + region in all_regions:
-            data_sorted['Right'][region] = data['Right: ' + region]
-
-    # Sum of left and right
-    data_sorted['Sum'] = data_sorted[['Left','Right']].sum(axis=1, min_count=1)
-    
-    return data_sorted
+    return split_hemispheres(data)
 
 #%%
-def plot_starter_cells(brain_df, brain_region_dict, output_path):
-    # Starter cell analysis
+def plot_starter_cells(brain_df, brain_region_dict, output_path, animal=None):
+    # Starter cell analysis. The plot is saved as <animal>_starter_cells.pdf in output_path.
     starter_cells = brain_df['RAB_TVA']
     starter_cells = starter_cells[starter_cells > 0]
     starter_cells_sorted = sort_hemispheres(starter_cells)
@@ -428,9 +1204,46 @@ def plot_starter_cells(brain_df, brain_region_dict, output_path):
     t = plt.title('Starter cells')
     lbl = plt.ylabel('Starter cells (Rabies+ TVA+)')
     if not(output_path==None):
-        output_file = os.path.join(output_path, 'starter_cells.pdf')
+        output_file = os.path.join(output_path, (animal + '_' if animal else '') + 'starter_cells.pdf')
         plt.savefig(output_file, bbox_inches='tight')
 
+#%%
+def normalize_all_cell_counts(brain_df, tracers):
+    '''
+    Do normalization of the cell counts for all tracers at once 
+    (see normalize_cell_counts). The hemispheres of all tracers are sorted
+    in one call, and the normalization is done on one array.
+    
+    Output
+    ------
+        norm_cell_counts (pandas dataframe)
+        Dataframe with columns (tracer, hemisphere), for the hemispheres
+        'Left', 'Right' and 'Sum'.
+    '''
+    
+    tracers = list(tracers)
+    data_sorted = split_hemispheres(brain_df[['area'] + tracers])
+    hemispheres = HEMISPHERES + ['Sum']
+    
+    # Regions x tracers x hemispheres
+    area = data_sorted['area'][hemispheres].to_numpy()[:, np.newaxis, :]
+    cell_counts = data_sorted[pd.MultiIndex.from_product([tracers, hemispheres])].to_numpy()
+    cell_counts = cell_counts.reshape(len(data_sorted), len(tracers), len(hemispheres))
+
+    # Get the the brainwide area and cell counts (corresponding to the root)
+    root = data_sorted.index.get_loc('root')
+    brainwide_area = area[root]
+    brainwide_cell_counts = cell_counts[root]
+
+    # Do the normalization for each tracer and hemisphere seperately.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_cell_counts = (cell_counts / area) / (brainwide_cell_counts / brainwide_area)
+    
+    norm_cell_counts = pd.DataFrame(norm_cell_counts.reshape(len(data_sorted), -1), index=data_sorted.index,
+                                    columns=pd.MultiIndex.from_product([tracers, hemispheres]))
+    
+    return norm_cell_counts
+
 #%%
 def normalize_cell_counts(brain_df, tracer):
     '''
@@ -441,31 +1254,382 @@ def normalize_cell_counts(brain_df, tracer):
     The 'Sum' column is normalized w.r.t the whole brain.
     '''
     
-    # Sort the hemispheres (Get 'Left', 'Right' and 'sum' as seperate columns)
-    area = sort_hemispheres(brain_df['area'])
-    cell_counts = sort_hemispheres(brain_df[tracer])
+    return normalize_all_cell_counts(brain_df, [tracer])[tracer]
 
-    # Get the the brainwide area and cell counts (corresponding to the root)
-    brainwide_area = area.loc['root']
-    brainwide_cell_counts = cell_counts.loc['root']
+#%%
+def analyze_animal(root, animal, tracers, edges, tree, brain_region_dict, ontology_index, use_cache=False,
+                   marker_panel=None, low_memory=False, plot_starters=True):
+    '''
+    Load the cell counts of one animal, plot its starter cells,
+    save its raw cell counts and normalize them.
+    See load_cell_counts for use_cache and marker_panel.
+    With plot_starters=False, the starter cells are not plotted (e.g. to plot them
+    in a render queue, see collect_and_analyze_cell_counts).
+    With low_memory=True, the slices are summed while they are loaded 
+    (see sum_slices_streaming), and are not kept in memory.
+    If profiling is enabled (see profiling_helpers), the time spent in every stage
+    is saved as <animal>_profile.csv in the results_python folder of the animal.
+    
+    Output
+    ------
+        brain_df (pandas dataframe)
+        Cell counts summed over all slices of the animal.
+        
+        normalized (dict)
+        Tracers as keys, and the normalized cell counts (see normalize_cell_counts)
+        as values.
+    '''
+
+    print('Importing slices in '+animal+'...')
+    input_path = os.path.join(root, animal, 'results')
+    output_path = os.path.join(root, animal, 'results_python')
+    os.makedirs(output_path, exist_ok=True)
+
+    # Load regions to exclude for this animal
+    path_to_exclusion_file = os.path.join(root, animal, 'RegionsToExclude.csv')
+    if not(os.path.exists(path_to_exclusion_file)):
+        raise ValueError('Cannot find exclusion file for animal ' + animal + '!')
+    exclude_dict = compile_exclusion_plans(list_regions_to_exclude(path_to_exclusion_file), ontology_index)
+
+    with profile_animal(animal, output_path):
+        # Load cell counts, excluding the regions we want to exclude.
+        # Now comes the tricky part. We sum the results (area, cell counts) 
+        # per region across slices, into one dataframe (brain_df).
+        if low_memory:
+            imported = []
+            def iter_slices():
+                for f,region_dict,df in iter_cell_counts(input_path, exclude_dict, edges, tree, ontology_index,
+                                                         use_cache=use_cache, marker_panel=marker_panel):
+                    imported.append(f)
+                    yield df
+            with stage('load_and_sum_slices'):
+                brain_df = sum_slices_streaming(iter_slices(), ontology_index)
+            print('Imported ' + str(len(imported)) + ' slices.\n')
+        else:
+            with stage('load_cell_counts'):
+                df_list,slice_regions,slice_data = load_cell_counts(input_path, exclude_dict, edges, tree, ontology_index,
+                                                                    use_cache=use_cache, marker_panel=marker_panel)
+            print('Imported ' + str(len(df_list)) + ' slices.\n')
+            with stage('sum_slices'):
+                brain_df = sum_slices(df_list, ontology_index)
+        
+        # Plot starter cells
+        if plot_starters:
+            with stage('plot_starter_cells'):
+                plot_starter_cells(brain_df, brain_region_dict, output_path, animal)
+
+        # Save brain_df
+        with stage('save_cell_counts'):
+            brain_df.to_csv( os.path.join(output_path, animal+'_cell_counts.csv') )
+        print('Raw cell counts are saved to ' + output_path)
 
-    # Do the normalization for each column seperately.
-    norm_cell_counts = (cell_counts / area) / (brainwide_cell_counts / brainwide_area)
+        # Normalize the results of all tracers ('RAB', 'CTB', ...)
+        with stage('normalization'):
+            norm_cell_counts = normalize_all_cell_counts(brain_df, tracers)
+            normalized = {t: norm_cell_counts[t] for t in tracers}
     
-    return norm_cell_counts
+    if profiling_enabled():
+        save_profiling_report(os.path.join(output_path, animal+'_profile.csv'), animal)
+    
+    return brain_df,normalized
+
+def _analyze_animal_timed(animal, args):
+    start = time.perf_counter()
+    brain_df,normalized = analyze_animal(args[0], animal, *args[1:])
+    return animal,brain_df,normalized,time.perf_counter()-start
+
+def _analyze_animal_in_worker(animal):
+    result = _analyze_animal_timed(animal, _worker_state['args'])
+    plt.close('all') # figures are saved already, free their memory
+    return result,take_profiling_records()
+
+def _merge_worker_result(worker_result):
+    result,records = worker_result
+    merge_profiling_records(records)
+    return result
 
 #%%
-def collect_and_analyze_cell_counts(root, animal_list, tracers, path_to_onotlogy_pickle):
+def fingerprint_animal_inputs(root, animal, path_to_onotlogy_pickle, previous=None, marker_panel=None):
+    '''
+    Fingerprint (see fingerprint_file) all inputs of an animal: the _regions.txt files 
+    in its results folder, its RegionsToExclude.csv, the ontology (the checksum of the 
+    ontology that get_ontology loads, from the json file or the pickle)
+    and the marker panel (see sum_cell_counts). If the marker panel has a detection
+    classifier, the per-detection exports and the classifier are fingerprinted too.
+    If the previous fingerprints are given, files with the same size and 
+    modification time are not hashed again.
+    '''
+    input_path = os.path.join(root, animal, 'results')
+    paths = {}
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    classifier = marker_panel.get('detection_classifier')
+    for fname in sorted(os.listdir(input_path)):
+        if '_regions.txt' in fname or (classifier is not None and '_detections_' in fname):
+            paths['results/' + fname] = os.path.join(input_path, fname)
+    paths['RegionsToExclude.csv'] = os.path.join(root, animal, 'RegionsToExclude.csv')
+    
+    if previous is None:
+        previous = {}
+    fingerprints = {}
+    for key, path in paths.items():
+        fingerprint = fingerprint_file(path, hash_content=False)
+        old = previous.get(key)
+        if old is not None and old['size'] == fingerprint['size'] and old['mtime_ns'] == fingerprint['mtime_ns']:
+            fingerprints[key] = old
+        else:
+            fingerprints[key] = fingerprint_file(path)
+    fingerprints['ontology'] = {'sha1': get_ontology(path_to_onotlogy_pickle).checksum()}
+    
+    panel = json.dumps([marker_panel['class_columns'], marker_panel['tracers']]).encode()
+    if classifier is not None:
+        # The animal is analyzed again if the rules change
+        panel += _fingerprint_function(classifier)
+    fingerprints['marker_panel'] = {'sha1': hashlib.sha1(panel).hexdigest()}
+    
+    return fingerprints
+
+def _fingerprint_function(function, seen=None):
+    '''
+    Bytes that identify a function (e.g. a detection classifier), such that the fingerprint 
+    changes if its code, its constants (e.g. a threshold), its default arguments or the 
+    values in its closure change. Global variables that the function uses are included 
+    if they are plain data (numbers, strings, arrays, ...), but other functions it calls are not.
+    For a functools.partial (e.g. classifier_helpers.make_detection_filter) its arguments
+    are fingerprinted too, and for a callable object its class and attributes.
+    '''
+    if seen is None:
+        seen = set()
+    if id(function) in seen: # e.g. a recursive function in its own closure
+        return b'recursion'
+    seen = seen | {id(function)}
+    
+    sha1 = hashlib.sha1()
+    if isinstance(function, functools.partial):
+        sha1.update(_fingerprint_function(function.func, seen))
+        sha1.update(_fingerprint_value((function.args, function.keywords), seen))
+        return sha1.digest()
+    if hasattr(function, '__func__'): # bound method
+        sha1.update(_fingerprint_function(function.__func__, seen))
+        sha1.update(_fingerprint_value(getattr(function.__self__, '__dict__', None), seen))
+        return sha1.digest()
+    
+    name = getattr(function, '__module__', None) or ''
+    name += '.' + getattr(function, '__qualname__', type(function).__qualname__)
+    sha1.update(name.encode())
+    code = getattr(function, '__code__', None)
+    if code is None:
+        # A callable object: its class and attributes (builtin functions only have their name)
+        call = getattr(type(function), '__call__', None)
+        if hasattr(call, '__code__'):
+            sha1.update(_fingerprint_function(call, seen))
+        sha1.update(_fingerprint_value(getattr(function, '__dict__', None), seen))
+        return sha1.digest()
+    
+    sha1.update(_fingerprint_code(code))
+    sha1.update(_fingerprint_value((function.__defaults__, function.__kwdefaults__), seen))
+    for cell in function.__closure__ or ():
+        try:
+            sha1.update(_fingerprint_value(cell.cell_contents, seen))
+        except ValueError: # empty cell
+            sha1.update(b'empty')
+    for global_name in sorted(_list_code_names(code)):
+        value = function.__globals__.get(global_name)
+        if _is_plain_data(value):
+            sha1.update(global_name.encode() + _fingerprint_value(value, seen))
+    
+    return sha1.digest()
+
+def _fingerprint_code(code):
+    '''
+    Bytes that identify a code object: its bytecode, constants and names,
+    including those of the functions defined in it.
+    '''
+    sha1 = hashlib.sha1(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            sha1.update(_fingerprint_code(const))
+        elif isinstance(const, frozenset): # the order of a set depends on the hash seed
+            sha1.update(repr(sorted(repr(c) for c in const)).encode())
+        else:
+            sha1.update(repr(const).encode())
+    sha1.update(repr((code.co_names, code.co_varnames, code.co_freevars)).encode())
+    return sha1.digest()
+
+def _list_code_names(code):
+    '''
+    The global names (and attributes) used by a code object and the functions defined in it.
+    '''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            names |= _list_code_names(const)
+    return names
+
+def _is_plain_data(value):
+    '''
+    True for numbers, strings, arrays, and lists, tuples and dictionaries of them.
+    '''
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.ndarray, np.generic)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain_data(v) for v in value)
+    if isinstance(value, dict):
+        return all(_is_plain_data(k) and _is_plain_data(v) for k, v in value.items())
+    return False
+
+def _fingerprint_value(value, seen):
+    '''
+    Bytes that identify a value: an argument, default argument or closure
+    variable of a function (see _fingerprint_function).
+    '''
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(repr((value.dtype.str, value.shape)).encode() + 
+                            np.ascontiguousarray(value).tobytes()).digest()
+    if isinstance(value, (list, tuple)):
+        return hashlib.sha1(type(value).__name__.encode() + 
+                            b''.join(_fingerprint_value(v, seen) for v in value)).digest()
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda item: repr(item[0]))
+        return hashlib.sha1(b'dict' + b''.join(repr(k).encode() + _fingerprint_value(v, seen) 
+                                               for k, v in items)).digest()
+    if isinstance(value, (set, frozenset)):
+        return hashlib.sha1(b'set' + b''.join(sorted(_fingerprint_value(v, seen) for v in value))).digest()
+    if callable(value) and not isinstance(value, type):
+        return _fingerprint_function(value, seen)
+    try:
+        return hashlib.sha1(pickle.dumps(value)).digest()
+    except Exception:
+        return repr(type(value)).encode()
+
+#%%
+def load_animal_analysis(root, animal, tracers, path_to_onotlogy_pickle, marker_panel=None):
+    '''
+    Load the analysis of an animal that was saved by save_animal_analysis,
+    if none of its inputs changed since.
+    
+    Output
+    ------
+        normalized (dict or None)
+        Normalized cell counts per tracer (see analyze_animal), or None if
+        the inputs changed or the animal was not analyzed before.
+        Tracers that were not normalized before are normalized 
+        from the saved raw cell counts.
+        
+        fingerprints (dict)
+        Current fingerprints of the inputs (see fingerprint_animal_inputs).
+    '''
+    output_path = os.path.join(root, animal, 'results_python')
+    manifest_file = os.path.join(output_path, animal + '_manifest.json')
+    analysis_file = os.path.join(output_path, animal + '_analysis.pk')
+    
+    previous = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            previous = json.load(f)['fingerprints']
+    fingerprints = fingerprint_animal_inputs(root, animal, path_to_onotlogy_pickle, previous, marker_panel)
+    
+    # Compare the contents of the files (their modification time may have changed)
+    hashes = {key: fingerprint['sha1'] for key, fingerprint in fingerprints.items()}
+    if previous is None or not(os.path.exists(analysis_file)) or \
+        hashes != {key: fingerprint['sha1'] for key, fingerprint in previous.items()}:
+        return None,fingerprints
+    if fingerprints != previous: # remember the new modification times
+        _write_json_atomic(manifest_file, {'fingerprints': fingerprints})
+    
+    with open(analysis_file, 'rb') as f:
+        analysis = pickle.load(f)
+    normalized = {t: analysis['normalized'][t] for t in tracers if t in analysis['normalized']}
+    missing_tracers = [t for t in tracers if t not in normalized]
+    if len(missing_tracers) > 0:
+        norm_cell_counts = normalize_all_cell_counts(analysis['brain_df'], missing_tracers)
+        normalized.update({t: norm_cell_counts[t] for t in missing_tracers})
+    
+    return normalized,fingerprints
+
+#%%
+def save_animal_analysis(root, animal, brain_df, normalized, fingerprints):
+    '''
+    Save the raw and normalized cell counts of an animal, together with a manifest
+    of the fingerprints of its inputs (see fingerprint_animal_inputs).
+    The analysis is saved in the results_python folder of the animal.
+    '''
+    output_path = os.path.join(root, animal, 'results_python')
+    with open(os.path.join(output_path, animal + '_analysis.pk'), 'wb') as f:
+        pickle.dump({'brain_df': brain_df, 'normalized': normalized}, f)
+    # The manifest is written last: it marks the analysis as complete.
+    _write_json_atomic(os.path.join(output_path, animal + '_manifest.json'), 
+                       {'fingerprints': fingerprints})
+
+#%%
+def load_ontology(path_to_onotlogy_pickle):
+    '''
+    Load the brain ontology (brain hierarchy), once per process (see ontology_helpers.get_ontology),
+    with its compiled index (see ontology_helpers.compile_ontology_index).
+    Returns edges, tree, brain_region_dict and ontology_index.
+    '''
+    ontology = get_ontology(path_to_onotlogy_pickle)
+    
+    return ontology.edges,ontology.tree,ontology.regions,ontology.index
+
+#%%
+def store_animal_results(results, animal, normalized, tracers, hemispheres):
+    '''
+    Write the normalized cell counts of one animal (see analyze_animal) into 
+    the results dataframe (columns tracer -> animal -> hemisphere), 
+    aligned on the regions, in one block.
+    Like DataFrame.update, NaN values do not overwrite the results.
+    '''
+    block = pd.concat([normalized[t][hemispheres] for t in tracers], axis=1)
+    if not block.index.isin(results.index).all():
+        raise KeyError('Regions of ' + animal + ' are not in the ontology: ' + 
+                       str(block.index[~block.index.isin(results.index)].tolist()))
+    block = block.reindex(results.index)
+    
+    columns = results.columns.get_indexer(pd.MultiIndex.from_product([tracers, [animal], hemispheres]))
+    old_values = results.iloc[:, columns].to_numpy()
+    new_values = block.to_numpy(dtype=float)
+    results.iloc[:, columns] = np.where(np.isnan(new_values), old_values, new_values)
+
+#%%
+def collect_and_analyze_cell_counts(root, animal_list, tracers, path_to_onotlogy_pickle, workers=None, use_cache=False,
+                                    incremental=False, marker_panel=None, render_queue='inline'):
+    '''
+    Load and normalize the cell counts of all animals in animal_list.
+    
+    By default the animals are analyzed one after another. Set workers to
+    the number of animals to analyze in parallel (in a pool of processes).
+    The normalized counts of each animal are stored in the results as soon 
+    as the animal is finished. Note that the calling script should be protected 
+    by "if __name__ == '__main__':" on systems that start new processes by 
+    spawning (Windows, macOS).
+    The time it took to analyze each animal is printed at the end.
+    With use_cache=True, the parsed slices of each animal are cached in 
+    its results folder (see load_cell_counts).
+    
+    With incremental=True, the analysis of each animal is saved in its 
+    results_python folder. Animals whose inputs (slices, exclusion file and 
+    ontology) did not change since the previous run are not loaded again.
+    
+    The marker_panel (see make_marker_panel) defaults to MARKER_PANEL.
+    If tracers is None, all tracers of the marker panel are analyzed.
+    
+    By default, the starter cells of every animal are plotted while it is analyzed.
+    Pass a render queue (see render_helpers.start_render_queue) to plot them in 
+    the background instead, or None to skip the plots.
+    '''
+    
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    if tracers is None:
+        tracers = marker_panel['tracers']
+    plot_inline = isinstance(render_queue, str) and render_queue == 'inline'
     
     # Store the seperate hemispheres, and the sum of the hemispheres:
     hemispheres = ['Left', 'Right', 'Sum']
 
     # Load brain ontology (brain hierarchy) --------------------------------------
-    with open(path_to_onotlogy_pickle,"rb") as f:
-        ontology_dict = pickle.load(f)
-    edges = ontology_dict['BrainOntologyEdges']
-    tree = ontology_dict['BrainOntologyTree']
-    brain_region_dict = ontology_dict['BrainOntologyRegions']
+    edges,tree,brain_region_dict,ontology_index = load_ontology(path_to_onotlogy_pickle)
 
     # Initialize a results dataframe. --------------------------------------------
     # This is a dataframe with hierarchical columns. 
@@ -474,69 +1638,317 @@ def collect_and_analyze_cell_counts(root, animal_list, tracers, path_to_onotlogy
     multi_index = pd.MultiIndex.from_product(iterables)
     results = pd.DataFrame(np.nan, index=brain_region_dict.keys(), columns=multi_index)
 
+    # Reuse the previous analysis of animals whose inputs did not change ---------
+    timings = {}
+    fingerprints = {}
+    previous_analyses = {}
+    animals_to_analyze = []
+    for animal in animal_list:
+        if incremental:
+            normalized,fingerprints[animal] = load_animal_analysis(root, animal, tracers, path_to_onotlogy_pickle,
+                                                                   marker_panel)
+            if normalized is not None:
+                print('Inputs of '+animal+' did not change, using previous results.')
+                previous_analyses[animal] = normalized
+                continue
+        animals_to_analyze.append(animal)
+    
     # Loop over animals, load the data and normalize counts --------------------
+    init_args = (root, tracers, edges, tree, brain_region_dict, ontology_index, use_cache, marker_panel, False, plot_inline)
+    if workers is None or workers <= 1:
+        finished_animals = (_analyze_animal_timed(animal, init_args) for animal in animals_to_analyze)
+        executor = None
+    else:
+        # Matplotlib should not open windows in the worker processes
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_analysis_worker, 
+                                       initargs=(profiling_settings(),) + init_args)
+        futures = [executor.submit(_analyze_animal_in_worker, animal) for animal in animals_to_analyze]
+        finished_animals = (_merge_worker_result(future.result()) for future in as_completed(futures))
+    
+    try:
+        previous = ((animal,None,normalized,None) for animal,normalized in previous_analyses.items())
+        for animal,brain_df,normalized,seconds in itertools.chain(previous, finished_animals):
+            timings[animal] = seconds
+            if incremental and brain_df is not None:
+                save_animal_analysis(root, animal, brain_df, normalized, fingerprints[animal])
+            if brain_df is not None and not(plot_inline):
+                submit_plot(render_queue, plot_starter_cells, None, brain_df, brain_region_dict,
+                            os.path.join(root, animal, 'results_python'), animal)
+            
+            # Save results per animal, for all tracers at once
+            with profile_animal(animal), stage('store_animal_results'):
+                store_animal_results(results, animal, normalized, tracers, hemispheres)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    print('\nTime per animal:')
     for animal in animal_list:
+        if timings[animal] is None:
+            print('  %s: unchanged' % animal)
+        else:
+            print('  %s: %.1f s' % (animal, timings[animal]))
+    if profiling_enabled():
+        print('\nTime per stage:')
+        print(profiling_report().to_string())
 
-        print('Importing slices in '+animal+'...')
-        input_path = os.path.join(root, animal, 'results')
-        output_path = os.path.join(root, animal, 'results_python')
-
-        # Load regions to exclude for this animal
-        path_to_exclusion_file = os.path.join(root, animal, 'RegionsToExclude.csv')
-        if not(os.path.exists(path_to_exclusion_file)):
-            raise ValueError('Cannot find exclusion file for animal ' + animal + '!')
-        exclude_dict = list_regions_to_exclude(path_to_exclusion_file)
-
-        # Load cell counts, excluding the regions we want to exclude
-        df_list,slice_regions,slice_data = load_cell_counts(input_path, exclude_dict, edges, tree)
-        print('Imported ' + str(len(df_list)) + ' slices.\n')
-
-        # Now comes the tricky part. We'll first concatenate the dataframes
-        # of all slices into one big dataframe (brain_df).
-        # Then, we combine the rows with the same index (=region name), and sum them.
-        # That is, we sum the results (area, cell counts) per region across slices.
-        brain_df = pd.concat(df_list)
-        brain_df = brain_df.groupby(brain_df.index, axis=0).sum()
-        
-        # Plot starter cells
-        plot_starter_cells(brain_df, brain_region_dict, output_path)
+    # Swap hierarchy of columns, to make averaging over animals easier.
+    # The new hierarchy will be Tracer -> Hemisphere -> Animal
+    results = results.swaplevel(axis=1)
+    
+    return results
 
-        # Save brain_df
-        brain_df.to_csv( os.path.join(output_path, animal+'_cell_counts.csv') )
-        print('Raw cell counts are saved to ' + output_path)
+#%%
+def aggregate_cell_counts(brain_df, target_regions, ontology_index, counts_include_subregions=True):
+    '''
+    Roll the cell counts of an animal (brain_df, rows 'Left: ACA', ...) up or down 
+    to the target regions (acronyms), per hemisphere and for all columns at once
+    (see ontology_helpers.roll_up_counts). 
+    The output has the same rows as brain_df ('Left: X', 'Right: X') for the 
+    target regions with counts, in ontology order.
+    '''
+    hemis,region_ids = split_region_labels(brain_df.index, ontology_index)
+    if np.any(region_ids < 0) or not np.all(np.isin(hemis, HEMISPHERES)):
+        raise ValueError('Cannot aggregate regions that are not in the ontology: ' + 
+                         str(brain_df.index[(region_ids < 0) | ~np.isin(hemis, HEMISPHERES)].tolist()))
+    target_ids = np.array([ontology_index['ids'][region] for region in target_regions], dtype=np.int64)
+    num_regions = len(ontology_index['acronyms'])
+    values = brain_df.to_numpy(dtype=float)
+    
+    labels = []
+    rolled_up = []
+    for hemi in HEMISPHERES:
+        in_hemi = hemis == hemi
+        counts = np.zeros((num_regions, values.shape[1]))
+        present = np.zeros(num_regions, dtype=bool)
+        counts[region_ids[in_hemi]] = np.nan_to_num(values[in_hemi], nan=0.0)
+        present[region_ids[in_hemi]] = True
+        hemi_counts = roll_up_counts(counts, present, target_ids, ontology_index, counts_include_subregions)
+        has_counts = ~np.all(np.isnan(hemi_counts), axis=1)
+        labels += [hemi + ': ' + ontology_index['acronyms'][i] for i in target_ids[has_counts]]
+        rolled_up.append(hemi_counts[has_counts])
+    
+    return pd.DataFrame(np.concatenate(rolled_up), index=pd.Index(labels, name=brain_df.index.name), 
+                        columns=brain_df.columns)
 
-        # Normalize the results
-        for t in tracers: # loop over tracers ('RAB', 'CTB', ...)
+#%%
+# Cell counts rolled up to a level of the ontology, per (cohort, level). See collect_cell_counts_at_level.
+_aggregation_cache = {}
 
-            # Normalize
-            normalized_cell_counts = normalize_cell_counts(brain_df, t)
+def collect_cell_counts_at_level(root, animal_list, tracers, path_to_onotlogy_pickle, level, 
+                                 counts_include_subregions=True):
+    '''
+    Normalize the cell counts of all animals after rolling them up to a depth
+    of the ontology (see ontology_helpers.regions_at_level), e.g. to compare 
+    major divisions instead of the regions exported by QuPath.
+    The raw cell counts are read from the results_python folder of each animal
+    (saved by analyze_animal), so the slices are not loaded again.
+    The output has the same layout as the output of collect_and_analyze_cell_counts.
+    Results are cached per cohort and level, as long as the raw cell counts and the ontology do not change.
+    '''
+    edges,tree,brain_region_dict,ontology_index = load_ontology(path_to_onotlogy_pickle)
+    paths = [os.path.join(root, animal, 'results_python', animal+'_cell_counts.csv') for animal in animal_list]
+    fingerprints = tuple((fp['size'], fp['mtime_ns']) for fp in (fingerprint_file(p, hash_content=False) for p in paths))
+    key = (os.path.abspath(root), tuple(animal_list), tuple(tracers), level, counts_include_subregions, fingerprints,
+           get_ontology(path_to_onotlogy_pickle).checksum())
+    if key in _aggregation_cache:
+        return _aggregation_cache[key].copy()
+    
+    # Always keep the root: it is needed for the normalization.
+    target_ids = regions_at_level(level, ontology_index)
+    target_regions = ['root'] + [ontology_index['acronyms'][i] for i in target_ids if i != 0]
+    
+    hemispheres = HEMISPHERES + ['Sum']
+    multi_index = pd.MultiIndex.from_product([tracers, animal_list, hemispheres])
+    results = pd.DataFrame(np.nan, index=target_regions, columns=multi_index)
+    for animal, path in zip(animal_list, paths):
+        brain_df = pd.read_csv(path, index_col=0)
+        brain_df = aggregate_cell_counts(brain_df[['area'] + list(tracers)], target_regions, ontology_index, 
+                                         counts_include_subregions)
+        norm_cell_counts = normalize_all_cell_counts(brain_df, tracers)
+        store_animal_results(results, animal, {t: norm_cell_counts[t] for t in tracers}, tracers, hemispheres)
+    
+    # Same hierarchy as collect_and_analyze_cell_counts: Tracer -> Hemisphere -> Animal
+    results = results.swaplevel(axis=1)
+    _aggregation_cache[key] = results
+    
+    return results.copy()
 
-            # Save results per animal
-            present_regions = normalized_cell_counts.index.to_list()
-            for region in present_regions: # loop over all regions present
-                results.loc[region, (t,animal)].update( normalized_cell_counts.loc[region] )
+#%%
+def iter_animal_results(root, animal_list, tracers, path_to_onotlogy_pickle, use_cache=False, incremental=False,
+                        marker_panel=None, render_queue='inline'):
+    '''
+    Generator version of collect_and_analyze_cell_counts, for very large cohorts.
+    The animals are analyzed one after another with a low memory footprint 
+    (see analyze_animal), and (animal, norm_cell_counts) is yielded for every animal.
+    norm_cell_counts has columns (tracer, hemisphere), and only contains
+    the regions present in the animal. The slices and raw cell counts of
+    an animal are discarded as soon as it is normalized.
+    See collect_and_analyze_cell_counts for the other inputs.
+    '''
+    
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    if tracers is None:
+        tracers = marker_panel['tracers']
+    edges,tree,brain_region_dict,ontology_index = load_ontology(path_to_onotlogy_pickle)
+    
+    for animal in animal_list:
+        if incremental:
+            normalized,fingerprints = load_animal_analysis(root, animal, tracers, path_to_onotlogy_pickle, marker_panel)
+            if normalized is not None:
+                print('Inputs of '+animal+' did not change, using previous results.')
+                yield animal,pd.concat([normalized[t] for t in tracers], axis=1, keys=tracers)
+                continue
+        
+        plot_inline = isinstance(render_queue, str) and render_queue == 'inline'
+        brain_df,normalized = analyze_animal(root, animal, tracers, edges, tree, brain_region_dict, ontology_index,
+                                             use_cache, marker_panel, low_memory=True, plot_starters=plot_inline)
+        plt.close('all') # figures are saved already, free their memory
+        if incremental:
+            save_animal_analysis(root, animal, brain_df, normalized, fingerprints)
+        if not(plot_inline):
+            submit_plot(render_queue, plot_starter_cells, None, brain_df, brain_region_dict,
+                        os.path.join(root, animal, 'results_python'), animal)
+        del brain_df
+        yield animal,pd.concat([normalized[t] for t in tracers], axis=1, keys=tracers)
 
-    # Swap hierarchy of columns, to make averaging over animals easier.
-    # The new hierarchy will be Tracer -> Hemisphere -> Animal
-    results = results.swaplevel(axis=1)
+#%%
+def init_welford(shape):
+    '''
+    Initialize a streaming accumulator for the mean and variance (Welford's algorithm)
+    of arrays with the given shape. NaN values are skipped, so every element
+    has its own number of samples.
+    '''
+    return {'n': np.zeros(shape), 'mean': np.zeros(shape), 'm2': np.zeros(shape)}
+
+def update_welford(accumulator, values):
+    '''
+    Add one sample (an array with the shape of the accumulator) to a Welford accumulator.
+    '''
+    valid = ~np.isnan(values)
+    accumulator['n'] += valid
+    delta = np.where(valid, values - accumulator['mean'], 0)
+    accumulator['mean'] += np.divide(delta, accumulator['n'], out=np.zeros_like(delta), where=valid)
+    accumulator['m2'] += np.where(valid, delta * (values - accumulator['mean']), 0)
+
+def finish_welford(accumulator):
+    '''
+    Return the mean and standard error of the mean of a Welford accumulator.
+    Like pandas, the mean is NaN without samples, and the SEM is NaN with less than two samples.
+    '''
+    n = accumulator['n']
+    mean = np.where(n > 0, accumulator['mean'], np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sem = np.where(n > 1, np.sqrt(accumulator['m2'] / (n - 1) / n), np.nan)
     
-    return results
+    return mean,sem
 
 #%%
-def average_cell_counts_over_animals(results, tracers):
-    # Calculate means and sems -------------------------------------------------
+def average_cell_counts_streaming(animal_results, tracers, regions):
+    '''
+    Calculate means and sems over animals with streaming (Welford) accumulators,
+    so memory does not grow with the number of animals.
+    animal_results is an iterable of (animal, norm_cell_counts), see iter_animal_results.
+    The output is the same as average_cell_counts_over_animals, with the given regions as rows.
+    '''
+    tracers = list(tracers)
+    regions = pd.Index(regions)
+    hemispheres = HEMISPHERES + ['Sum']
+    per_hemi = init_welford((len(regions), len(tracers)))
+    summed_hemi = init_welford((len(regions), len(tracers)))
+    
+    for animal, norm_cell_counts in animal_results:
+        values = norm_cell_counts.reindex(index=regions, columns=pd.MultiIndex.from_product([tracers, hemispheres]))
+        values = values.to_numpy(dtype=float).reshape(len(regions), len(tracers), len(hemispheres))
+        
+        # Normalization per hemisphere: Treat 'Left' and 'Right' as seperate animals to calculate average
+        for h in range(len(HEMISPHERES)):
+            update_welford(per_hemi, values[:, :, h])
+        # Normalization with summed hemispheres: Sum left and right, and average over animals.
+        update_welford(summed_hemi, values[:, :, -1])
+    
     iterables = [tracers, ['PerHemi', 'SummedHemi'], ['Mean', 'Sem']]
     multi_index = pd.MultiIndex.from_product(iterables)
-    mean_results = pd.DataFrame(np.nan, index=results.index, columns=multi_index)
+    per_hemi_mean,per_hemi_sem = finish_welford(per_hemi)
+    summed_mean,summed_sem = finish_welford(summed_hemi)
+    mean_results = np.stack([per_hemi_mean, per_hemi_sem, summed_mean, summed_sem], axis=2)
+    mean_results = pd.DataFrame(mean_results.reshape(len(regions), -1), index=regions, columns=multi_index)
+    
+    return mean_results
 
-    for t in tracers:
+#%%
+def average_cell_counts_over_animals(results, tracers):
+    '''
+    Calculate means and sems over the animals in results
+    (see collect_and_analyze_cell_counts), per hemisphere and with summed hemispheres.
+    '''
+    animals = results.columns.get_level_values(2).unique()
+    animal_results = ((animal, results.xs(animal, axis=1, level=2)) for animal in animals)
+    
+    with stage('average_cell_counts_over_animals'):
+        return average_cell_counts_streaming(animal_results, tracers, results.index)
 
-        # Normalization per hemisphere: Treat 'Left' and 'Right' as seperate animals to calculate average
-        mean_results.loc[:, (t,'PerHemi','Mean')] = results[t][['Left','Right']].mean(axis=1)
-        mean_results.loc[:, (t,'PerHemi','Sem')] = results[t][['Left','Right']].sem(axis=1)
+#%%
+def collect_and_average_cell_counts(root, animal_list, tracers, path_to_onotlogy_pickle, use_cache=False, 
+                                    incremental=False, marker_panel=None, render_queue='inline'):
+    '''
+    Low-memory pipeline for very large cohorts: analyze the animals one after 
+    another (see iter_animal_results) and average them on the fly 
+    (see average_cell_counts_streaming). Only the mean results are returned;
+    the normalized cell counts of the animals are not kept.
+    '''
+    if marker_panel is None:
+        marker_panel = MARKER_PANEL
+    if tracers is None:
+        tracers = marker_panel['tracers']
+    edges,tree,brain_region_dict,ontology_index = load_ontology(path_to_onotlogy_pickle)
+    
+    animal_results = iter_animal_results(root, animal_list, tracers, path_to_onotlogy_pickle, use_cache=use_cache,
+                                         incremental=incremental, marker_panel=marker_panel, render_queue=render_queue)
+    
+    return average_cell_counts_streaming(animal_results, tracers, brain_region_dict.keys())
 
-        # Normalization with summed hemispheres: Sum left and right, and average over animals.
-        mean_results.loc[:, (t,'SummedHemi','Mean')] = results[t]['Sum'].mean(axis=1)
-        mean_results.loc[:, (t,'SummedHemi','Sem')] = results[t]['Sum'].sem(axis=1)
-        
-    return mean_results
+#%%
+# Version of the binary results format (see save_results)
+RESULTS_FORMAT_VERSION = 1
+
+def save_results(df, output_path, name, save_csv=False):
+    '''
+    Save a results dataframe (e.g. results or mean_results) in a compact binary format:
+    name.npy with the values (float64), and name.json with the regions and 
+    the hierarchy of the columns. Load it with load_results.
+    With save_csv=True, the dataframe is also exported as name.csv.
+    '''
+    schema = {'version': RESULTS_FORMAT_VERSION,
+              'index': [str(region) for region in df.index],
+              'column_names': list(df.columns.names),
+              'columns': [list(column) if isinstance(column, tuple) else [column] for column in df.columns]}
+    
+    # The schema is written last: it marks the results as complete.
+    np.save(os.path.join(output_path, name + '.npy'), np.ascontiguousarray(df.to_numpy(dtype=float)))
+    _write_json_atomic(os.path.join(output_path, name + '.json'), schema)
+    if save_csv:
+        df.to_csv( os.path.join(output_path, name + '.csv') )
+
+#%%
+def load_results(output_path, name, mmap=True):
+    '''
+    Load a results dataframe saved by save_results. 
+    With mmap=True, the values are memory-mapped (read-only) instead of read,
+    so opening the results of a cohort takes no time.
+    '''
+    with open(os.path.join(output_path, name + '.json'), 'r') as f:
+        schema = json.load(f)
+    if schema['version'] != RESULTS_FORMAT_VERSION:
+        raise ValueError('Results ' + name + ' have format version ' + str(schema['version']) + 
+                         ', expected version ' + str(RESULTS_FORMAT_VERSION) + '.')
+    
+    values = np.load(os.path.join(output_path, name + '.npy'), mmap_mode='r' if mmap else None)
+    if len(schema['column_names']) > 1:
+        columns = pd.MultiIndex.from_tuples([tuple(column) for column in schema['columns']], 
+                                            names=schema['column_names'])
+    else:
+        columns = pd.Index([column[0] for column in schema['columns']], name=schema['column_names'][0])
+    
+    return pd.DataFrame(values, index=schema['index'], columns=columns, copy=False)
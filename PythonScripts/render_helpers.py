@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 16:05:48 2026
+
+Render queue for figures. Drawing and saving the large bar charts takes longer than
+the analysis itself, so figures are submitted to a queue that renders them
+in a pool of worker processes (with the non-interactive Agg backend),
+while the analysis goes on. Plots can also be skipped altogether for headless batch runs.
+
+Usage:
+    render_queue = start_render_queue(workers=2)   # or None to skip all plots
+    submit_plot(render_queue, plot_horizontal_bar_chart, 'figure.pdf', data, brain_region_dict, title='...')
+    wait_for_plots(render_queue)
+
+@author: lukasvandenheuvel
+"""
+
+import traceback
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+
+#%%
+def _init_render_worker():
+    plt.switch_backend('Agg')
+
+def render_plot(plot_function, args, kwargs, output_file=None, title=None, title_fontsize=35, show=False):
+    '''
+    Make a figure with plot_function(*args, **kwargs), add the title and save it
+    to output_file. If show is True, the figure is also shown (with the current backend).
+    The figure is closed afterwards, to free its memory.
+    Plot functions that save their own figure (like plot_starter_cells) are called with output_file=None.
+    '''
+    try:
+        plot_function(*args, **kwargs)
+        if title is not None:
+            plt.title(title, fontsize=title_fontsize)
+        if output_file is not None:
+            plt.savefig(output_file, bbox_inches='tight')
+        if show:
+            plt.show()
+    finally:
+        plt.close('all')
+    return output_file
+
+#%%
+def start_render_queue(workers=2):
+    '''
+    Start a render queue with a pool of worker processes.
+    With workers=0, the figures are rendered immediately in this process
+    and shown with the current backend, like before. Note that the calling script should be protected
+    by "if __name__ == '__main__':" on systems that start new processes by
+    spawning (Windows, macOS).
+    '''
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker)
+    return {'executor': executor, 'futures': []}
+
+def submit_plot(render_queue, plot_function, output_file, *args, title=None, **kwargs):
+    '''
+    Submit a figure to the render queue: plot_function(*args, **kwargs) is drawn,
+    titled and saved to output_file (see render_plot). The call returns immediately
+    if the queue has worker processes. If render_queue is None, plots are skipped.
+    '''
+    if render_queue is None:
+        return None
+    if render_queue['executor'] is None:
+        return render_plot(plot_function, args, kwargs, output_file, title, show=True)
+    future = render_queue['executor'].submit(render_plot, plot_function, args, kwargs, output_file, title)
+    render_queue['futures'].append((plot_function.__name__, output_file, future))
+    return future
+
+def wait_for_plots(render_queue):
+    '''
+    Wait until all submitted figures are saved, and stop the worker processes.
+    Figures that failed are reported, without stopping the others.
+    Returns the number of failed figures.
+    '''
+    if render_queue is None:
+        return 0
+    failed = 0
+    for name, output_file, future in render_queue['futures']:
+        try:
+            future.result()
+        except Exception:
+            failed += 1
+            print('! Could not render ' + name + ' (' + str(output_file) + '):')
+            traceback.print_exc()
+    render_queue['futures'] = []
+    if render_queue['executor'] is not None:
+        render_queue['executor'].shutdown(wait=True)
+    return failed
@@ -0,0 +1,5 @@
+# The analysis scripts import the helper modules from PythonScripts directly
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
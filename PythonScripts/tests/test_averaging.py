@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check the streaming (Welford) average over animals against the original
+pandas mean and sem.
+
+@author: lukasvandenheuvel
+"""
+
+import numpy as np
+import pandas as pd
+
+from readCSV_helpers import average_cell_counts_over_animals, init_welford, update_welford, finish_welford
+
+TRACERS = ['CTB', 'RAB']
+
+#%%
+def original_average(results, tracers):
+    '''
+    average_cell_counts_over_animals before the streaming rewrite.
+    '''
+    iterables = [tracers, ['PerHemi', 'SummedHemi'], ['Mean', 'Sem']]
+    multi_index = pd.MultiIndex.from_product(iterables)
+    mean_results = pd.DataFrame(np.nan, index=results.index, columns=multi_index)
+    for t in tracers:
+        mean_results.loc[:, (t,'PerHemi','Mean')] = results[t][['Left','Right']].mean(axis=1)
+        mean_results.loc[:, (t,'PerHemi','Sem')] = results[t][['Left','Right']].sem(axis=1)
+        mean_results.loc[:, (t,'SummedHemi','Mean')] = results[t]['Sum'].mean(axis=1)
+        mean_results.loc[:, (t,'SummedHemi','Sem')] = results[t]['Sum'].sem(axis=1)
+    return mean_results
+
+def make_results(num_regions, num_animals, rng):
+    '''
+    Results like collect_and_analyze_cell_counts (columns tracer -> hemisphere -> animal),
+    with values of very different magnitudes and missing values. The last regions have
+    no animal, or a single animal.
+    '''
+    animals = ['Animal_' + str(i) for i in range(num_animals)]
+    columns = pd.MultiIndex.from_product([TRACERS, ['Left', 'Right', 'Sum'], animals])
+    values = rng.lognormal(mean=0, sigma=3, size=(num_regions, len(columns))) + 1e4
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[-2, :] = np.nan
+    values[-1, :] = np.nan
+    values[-1, ::num_animals] = 1.0
+    return pd.DataFrame(values, index=['Region_' + str(i) for i in range(num_regions)], columns=columns)
+
+#%%
+def test_average_matches_original_mean_and_sem():
+    rng = np.random.default_rng(0)
+    results = make_results(50, 7, rng)
+    
+    expected = original_average(results, TRACERS)
+    mean_results = average_cell_counts_over_animals(results, TRACERS)
+    pd.testing.assert_frame_equal(mean_results, expected, check_exact=False, rtol=1e-10)
+
+def test_welford_matches_numpy_for_large_offsets():
+    rng = np.random.default_rng(1)
+    samples = 1e8 + rng.normal(size=(1000, 3))
+    accumulator = init_welford(3)
+    for sample in samples:
+        update_welford(accumulator, sample)
+    mean,sem = finish_welford(accumulator)
+    
+    np.testing.assert_allclose(mean, samples.mean(axis=0), rtol=1e-14)
+    np.testing.assert_allclose(sem, samples.std(axis=0, ddof=1) / np.sqrt(len(samples)), rtol=1e-6)
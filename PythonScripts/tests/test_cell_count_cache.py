@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the cached cell counts of import_summed_cell_counts are reused
+when a txt file is unchanged, and invalidated when its contents change.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import json
+import pytest
+import pandas as pd
+
+import readCSV_helpers
+from readCSV_helpers import import_summed_cell_counts
+from test_load_slice import write_synthetic_slice
+
+#%%
+@pytest.fixture
+def cached_slice(tmp_path):
+    '''
+    A synthetic slice that was imported once with a cache.
+    '''
+    write_synthetic_slice(str(tmp_path))
+    path_to_txt = str(tmp_path / 'Image_01_regions.txt')
+    cache_dir = str(tmp_path / 'cache')
+    region_dict,df = import_summed_cell_counts(path_to_txt, 'Both', cache_dir=cache_dir)
+    return path_to_txt,cache_dir,region_dict,df
+
+def forbid_import(monkeypatch):
+    '''
+    Make sure the txt file is not read again.
+    '''
+    def fail(*args, **kwargs):
+        raise AssertionError('The txt file was imported instead of the cache.')
+    monkeypatch.setattr(readCSV_helpers, 'import_txt_file_as_dataframe', fail)
+
+def test_cache_is_used_for_unchanged_file(cached_slice, monkeypatch):
+    path_to_txt,cache_dir,region_dict,df = cached_slice
+    forbid_import(monkeypatch)
+
+    cached_regions,cached_df = import_summed_cell_counts(path_to_txt, 'Both', cache_dir=cache_dir)
+    assert cached_regions == region_dict
+    pd.testing.assert_frame_equal(cached_df, df)
+
+def test_cache_is_used_if_only_the_modification_time_changed(cached_slice, monkeypatch):
+    path_to_txt,cache_dir,region_dict,df = cached_slice
+    stat = os.stat(path_to_txt)
+    os.utime(path_to_txt, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    forbid_import(monkeypatch)
+
+    _,cached_df = import_summed_cell_counts(path_to_txt, 'Both', cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(cached_df, df)
+    # The new modification time is remembered, such that the file is not hashed again
+    with open(os.path.join(cache_dir, 'Image_01_regions.txt.Both.json'), 'r') as f:
+        assert json.load(f)['fingerprint']['mtime_ns'] == stat.st_mtime_ns + 10**9
+
+@pytest.mark.parametrize('old, new', [('\t100.0\t', '\t900.0\t'),     # same size
+                                      ('\t100.0\t', '\t1000.0\t')])   # other size
+def test_cache_is_invalidated_if_the_contents_changed(cached_slice, old, new):
+    path_to_txt,cache_dir,region_dict,df = cached_slice
+    with open(path_to_txt, 'r') as f:
+        text = f.read()
+    assert old in text
+    stat = os.stat(path_to_txt)
+    with open(path_to_txt, 'w') as f:
+        f.write(text.replace(old, new))
+    # On file systems with a coarse clock, the edit may not change the modification time
+    os.utime(path_to_txt, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    _,new_df = import_summed_cell_counts(path_to_txt, 'Both', cache_dir=cache_dir)
+    _,expected = import_summed_cell_counts(path_to_txt, 'Both')
+    pd.testing.assert_frame_equal(new_df, expected)
+    assert not(new_df['area'].equals(df['area']))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check predict_rtrees on a tiny hand-built RTrees classifier, 
+whose votes can be worked out by hand.
+
+@author: lukasvandenheuvel
+"""
+
+import json
+import numpy as np
+
+from classifier_helpers import load_rtrees_classifier, predict_rtrees_votes, predict_rtrees
+
+# The leaves store norm_class_idx, which class_labels maps to the index in pathClasses: 
+# 0 is 'Remove' and 1 is 'Keep'.
+TREES = [
+    # A <= 1: Remove, else Keep
+    {'nodes': [{'depth': 0, 'norm_class_idx': 0, 'splits': [{'var': 0, 'le': 1.0}]},
+               {'depth': 1, 'norm_class_idx': 0},
+               {'depth': 1, 'norm_class_idx': 1}]},
+    # B > 5: Remove, else (A <= 3: Keep, else Remove)
+    {'nodes': [{'depth': 0, 'norm_class_idx': 0, 'splits': [{'var': 1, 'ge': 5.0}]},
+               {'depth': 1, 'norm_class_idx': 0},
+               {'depth': 1, 'norm_class_idx': 1, 'splits': [{'var': 0, 'le': 3.0}]},
+               {'depth': 2, 'norm_class_idx': 1},
+               {'depth': 2, 'norm_class_idx': 0}]},
+    # Always Keep
+    {'nodes': [{'depth': 0, 'norm_class_idx': 1}]}]
+
+# Measurements (A, B) and the votes (Keep, Remove) of the trees
+FEATURES = np.array([[0.5, 0.0], [2.0, 6.0], [0.5, 6.0], [4.0, 0.0], [np.nan, 6.0], [1.0, 5.0]])
+VOTES = np.array([[2, 1], [2, 1], [1, 2], [2, 1], [1, 2], [2, 1]])
+
+#%%
+def write_classifier(path):
+    classifier_json = {'object_classifier_type': 'OpenCVMLClassifier',
+                       'featureExtractor': {'feature_extractor_type': 'DefaultFeatureExtractor', 
+                                            'measurements': ['A', 'B']},
+                       'classifier': {'class': 'RTrees',
+                                      'statmodel': {'var_count': 2, 'var_idx': [0, 1], 'class_labels': [1, 0],
+                                                    'missing_subst': [0.0, 0.0, 0.0], 'trees': TREES}},
+                       'pathClasses': [{'name': 'Keep'}, {'name': 'Remove'}]}
+    with open(path, 'w') as f:
+        json.dump(classifier_json, f)
+
+def test_votes_of_hand_built_classifier(tmp_path):
+    write_classifier(str(tmp_path / 'classifier.json'))
+    classifier = load_rtrees_classifier(str(tmp_path / 'classifier.json'))
+    assert classifier['class_names'] == ['Keep', 'Remove']
+    assert classifier['max_depth'] == 2
+
+    np.testing.assert_array_equal(predict_rtrees_votes(classifier, FEATURES), VOTES)
+    np.testing.assert_array_equal(predict_rtrees_votes(classifier, FEATURES, chunk_size=4), VOTES)
+
+def test_predict_with_and_without_threshold(tmp_path):
+    write_classifier(str(tmp_path / 'classifier.json'))
+    classifier = load_rtrees_classifier(str(tmp_path / 'classifier.json'))
+
+    np.testing.assert_array_equal(predict_rtrees(classifier, FEATURES), [0, 0, 1, 0, 1, 0])
+    # A third of the trees votes Remove for the other cells
+    np.testing.assert_array_equal(predict_rtrees(classifier, FEATURES, threshold=0.3, positive_class='Remove'),
+                                  [1, 1, 1, 1, 1, 1])
+    np.testing.assert_array_equal(predict_rtrees(classifier, FEATURES, threshold=0.7, positive_class='Remove'),
+                                  [0, 0, 0, 0, 0, 0])
+    np.testing.assert_array_equal(predict_rtrees(classifier, FEATURES, threshold=0.5, positive_class='Keep'),
+                                  [0, 0, 1, 0, 1, 0])
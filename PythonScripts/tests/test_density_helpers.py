@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check the voxel counts of density_helpers against np.histogramdd.
+
+@author: lukasvandenheuvel
+"""
+
+import numpy as np
+import pandas as pd
+
+from density_helpers import ATLAS_COLUMNS, make_atlas_grid, count_cells_in_volumes
+from readCSV_helpers import MARKER_PANEL
+
+#%%
+def make_detections(grid, num_cells, rng):
+    '''
+    Detections at random voxel centers (some of them outside the grid), with random markers.
+    '''
+    voxels = rng.integers(-2, np.array(grid['shape']) + 2, size=(num_cells, 3))
+    detections = pd.DataFrame((voxels + 0.5) * grid['voxel_size_um'] / 1000, columns=ATLAS_COLUMNS)
+    for marker in MARKER_PANEL['markers']:
+        detections[marker] = rng.integers(0, 2, size=num_cells)
+    return detections
+
+def test_count_cells_in_volumes_matches_histogramdd(tmp_path):
+    rng = np.random.default_rng(0)
+    grid = make_atlas_grid(voxel_size_um=500)
+    chunks = [make_detections(grid, 5000, rng) for _ in range(3)]
+    volumes = {tracer: np.lib.format.open_memmap(str(tmp_path / (tracer + '.npy')), mode='w+', 
+                                                 dtype=np.uint32, shape=grid['shape'])
+               for tracer in MARKER_PANEL['tracers']}
+
+    totals,outside = count_cells_in_volumes(chunks, grid, volumes)
+
+    detections = pd.concat(chunks)
+    edges = [np.arange(size + 1) * grid['voxel_size_um'] / 1000 for size in grid['shape']]
+    for tracer, markers in zip(MARKER_PANEL['tracers'], MARKER_PANEL['tracer_masks']):
+        is_tracer = np.all([detections[marker] > 0 for i, marker in enumerate(MARKER_PANEL['markers']) 
+                            if markers & (1 << i)], axis=0)
+        expected,_ = np.histogramdd(detections.loc[is_tracer, ATLAS_COLUMNS].to_numpy(), bins=edges)
+        np.testing.assert_array_equal(volumes[tracer], expected)
+        assert totals[tracer] == is_tracer.sum()
+        assert outside[tracer] == is_tracer.sum() - expected.sum()
+
+def test_atlas_grid_axes_follow_abba():
+    # ABBA exports Atlas_X (ML), Atlas_Y (DV) and Atlas_Z (AP)
+    grid = make_atlas_grid()
+    assert grid['shape'] == (456, 320, 528)
+
+    # A cell 12 mm from the anterior end of the atlas is inside it, 12 mm to the side it is not
+    detections = pd.DataFrame([[5.7, 4.0, 12.0], [12.0, 4.0, 5.0]], columns=ATLAS_COLUMNS)
+    for marker in MARKER_PANEL['markers']:
+        detections[marker] = 1
+    volumes = {tracer: np.zeros(grid['shape'], dtype=np.uint32) for tracer in MARKER_PANEL['tracers']}
+    totals,outside = count_cells_in_volumes([detections], grid, volumes)
+
+    for tracer in MARKER_PANEL['tracers']:
+        assert totals[tracer] == 2
+        assert outside[tracer] == 1
+        assert volumes[tracer][228, 160, 480] == 1
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check the exclusion plans (overlapping and unknown regions) and how 
+exclude_regions handles regions that are missing from a slice.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import pytest
+import pandas as pd
+
+from ontology_helpers import get_ontology
+from readCSV_helpers import import_summed_cell_counts, compile_exclusions, compile_exclusion_plans, exclude_regions
+from test_load_slice import PATH_TO_ONTOLOGY, write_synthetic_slice
+
+#%%
+@pytest.fixture
+def slice_df(tmp_path):
+    '''
+    Cell counts of the synthetic slice with both hemispheres (see test_load_slice).
+    '''
+    write_synthetic_slice(str(tmp_path))
+    _,df = import_summed_cell_counts(os.path.join(str(tmp_path), 'Image_03_regions.txt'), 'Both')
+    return df
+
+def exclude(df, regs_to_exclude, **kwargs):
+    ontology = get_ontology(PATH_TO_ONTOLOGY)
+    return exclude_regions(df, regs_to_exclude, ontology.edges, ontology.tree, ontology.index, **kwargs)
+
+#%%
+def test_overlapping_exclusions_are_reported(capsys):
+    ontology = get_ontology(PATH_TO_ONTOLOGY)
+    plan = compile_exclusions(['Left: MO', 'Right: MOp', 'Left: MOp', 'Left: SSp', 'Left: Isocortex'], ontology.index)
+    assert sorted(plan['overlaps']) == [('Left: MO', 'Left: Isocortex'), ('Left: MOp', 'Left: MO'),
+                                        ('Left: SSp', 'Left: Isocortex')]
+
+    compile_exclusion_plans({'Image_01_regions.txt': ['Left: MO', 'Left: MOp']}, ontology.index)
+    assert 'Image_01_regions.txt: Left: MOp lies within Left: MO' in capsys.readouterr().out
+
+@pytest.mark.parametrize('regs_to_exclude', [['Left: MO', 'Left: NotARegion'], ['MOp']])
+def test_unknown_exclusions_are_rejected(regs_to_exclude):
+    ontology = get_ontology(PATH_TO_ONTOLOGY)
+    with pytest.raises(ValueError, match='Image_01_regions.txt'):
+        compile_exclusion_plans({'Image_01_regions.txt': regs_to_exclude}, ontology.index)
+
+def test_region_within_an_excluded_region(slice_df):
+    # Listed before the enclosing region, it is excluded together with it
+    pd.testing.assert_frame_equal(exclude(slice_df, ['Left: MOp', 'Left: MO']), exclude(slice_df, ['Left: MO']))
+    # Listed after the enclosing region, it was removed already
+    with pytest.raises(KeyError, match='Left: MOp'):
+        exclude(slice_df, ['Left: MO', 'Left: MOp'])
+
+def test_missing_region_to_exclude(slice_df):
+    df = slice_df.drop('Left: MO')
+    with pytest.raises(KeyError, match='Left: MO'):
+        exclude(df, ['Left: MO'])
+
+    # With skip_missing, the subregions of MO in the slice are excluded instead
+    expected = exclude(slice_df, ['Left: MO']).drop('Left: MO', errors='ignore')
+    pd.testing.assert_frame_equal(exclude(df, ['Left: MO'], skip_missing=True), expected)
+
+def test_missing_parent_region(slice_df):
+    df = slice_df.drop('Left: Isocortex')
+    with pytest.raises(KeyError, match='Left: Isocortex'):
+        exclude(df, ['Left: MOp'])
+
+    # With skip_missing, the other parent regions are still corrected
+    expected = exclude(slice_df, ['Left: MOp']).drop('Left: Isocortex')
+    pd.testing.assert_frame_equal(exclude(df, ['Left: MOp'], skip_missing=True), expected)
+    assert expected.loc['Left: root', 'area'] == slice_df.loc['Left: root', 'area'] - slice_df.loc['Left: MOp', 'area']
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that collect_and_analyze_cell_counts(incremental=True) reuses the analysis
+of an animal whose inputs did not change, and analyzes it again if the slices,
+the exclusion file or the ontology json file changed.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import shutil
+import pytest
+import pandas as pd
+
+import readCSV_helpers
+from readCSV_helpers import collect_and_analyze_cell_counts
+from test_load_slice import EXCLUSIONS, write_synthetic_slice
+
+PATH_TO_ONTOLOGY = os.path.join(os.path.dirname(__file__), '..', '..', 'AllenMouseBrainOntology')
+ANIMAL = 'Animal_1'
+
+#%%
+@pytest.fixture
+def animal_root(tmp_path, monkeypatch):
+    '''
+    An animal with the synthetic slices, and a copy of the ontology that can be edited.
+    Returns the root, the path to the ontology pickle and the list of analyzed animals.
+    '''
+    # The compact ontology is saved in the user cache folder
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setenv('LOCALAPPDATA', str(tmp_path / 'cache'))
+    for ext in ['.json', '.pk']:
+        shutil.copyfile(PATH_TO_ONTOLOGY + ext, str(tmp_path / ('AllenMouseBrainOntology' + ext)))
+
+    root = tmp_path / 'animals'
+    os.makedirs(str(root / ANIMAL / 'results'))
+    write_synthetic_slice(str(root / ANIMAL / 'results'))
+    exclusions = pd.DataFrame({'Image Name': list(EXCLUSIONS),
+                               'Regions to Exclude (Regions may not overlap!)': ['/ '.join(regions) or None
+                                                                                 for regions in EXCLUSIONS.values()]})
+    exclusions.to_csv(str(root / ANIMAL / 'RegionsToExclude.csv'), index=False)
+
+    analyzed = []
+    analyze_animal = readCSV_helpers.analyze_animal
+    def analyze_and_remember(root, animal, *args, **kwargs):
+        analyzed.append(animal)
+        return analyze_animal(root, animal, *args, **kwargs)
+    monkeypatch.setattr(readCSV_helpers, 'analyze_animal', analyze_and_remember)
+
+    return str(root),str(tmp_path / 'AllenMouseBrainOntology.pk'),analyzed
+
+def run_incremental(root, path_to_ontology):
+    return collect_and_analyze_cell_counts(root, [ANIMAL], None, path_to_ontology, incremental=True, render_queue=None)
+
+def edit_file(path, old, new):
+    stat = os.stat(path)
+    with open(path, 'r') as f:
+        text = f.read()
+    assert old in text
+    with open(path, 'w') as f:
+        f.write(text.replace(old, new, 1))
+    # On file systems with a coarse clock, the edit may not change the modification time
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+#%%
+def test_unchanged_animal_is_reused(animal_root):
+    root,path_to_ontology,analyzed = animal_root
+    results = run_incremental(root, path_to_ontology)
+    assert analyzed == [ANIMAL]
+
+    # Touching a file does not change its contents
+    path = os.path.join(root, ANIMAL, 'results', 'Image_01_regions.txt')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    pd.testing.assert_frame_equal(run_incremental(root, path_to_ontology), results)
+    assert analyzed == [ANIMAL]
+
+@pytest.mark.parametrize('input_file, old, new', [
+    (os.path.join(ANIMAL, 'results', 'Image_02_LEFT_regions.txt'), '\t100.0\t', '\t900.0\t'),
+    (os.path.join(ANIMAL, 'RegionsToExclude.csv'), 'Left: MOs', 'Left: MOp'),
+    (os.path.join('..', 'AllenMouseBrainOntology.json'), '"Primary motor area"', '"Primary motor cortex"')])
+def test_animal_is_analyzed_again_if_an_input_changed(animal_root, input_file, old, new):
+    root,path_to_ontology,analyzed = animal_root
+    results = run_incremental(root, path_to_ontology)
+
+    edit_file(os.path.join(root, input_file), old, new)
+    new_results = run_incremental(root, path_to_ontology)
+    assert analyzed == [ANIMAL, ANIMAL]
+    if 'Ontology' not in input_file:
+        assert not(new_results.equals(results))
+
+    # The new analysis is reused in turn
+    run_incremental(root, path_to_ontology)
+    assert analyzed == [ANIMAL, ANIMAL]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check load_slice on a small synthetic slice against the output of the original,
+row-by-row implementation (load_cell_counts before the vectorized rewrite).
+
+@author: lukasvandenheuvel
+"""
+
+import io
+import os
+import numpy as np
+import pandas as pd
+
+from ontology_helpers import get_ontology
+from readCSV_helpers import load_slice, MARKER_PANEL
+
+PATH_TO_ONTOLOGY = os.path.join(os.path.dirname(__file__), '..', '..', 'AllenMouseBrainOntology.pk')
+
+# Leaf regions with their counts ('Num CTB', 'Num Rabies', 'Num CTB: Rabies') and DAPI area.
+# The parents of the leaves ('MO', 'Isocortex', ..., 'root') get the sum of their subregions.
+LEAVES = {'Left':  {'MOp': (3, 1, 2, 100.0), 'MOs': (0, 4, 1, 50.0), 'SSp': (5, 0, 0, 200.0)},
+          'Right': {'MOp': (1, 0, 0, 80.0), 'MOs': (2, 2, 2, 60.0), 'SSp': (0, 3, 1, 150.0)}}
+PARENTS = {'MOp': ['MO'], 'MOs': ['MO'], 'SSp': ['SS']}
+ANCESTORS = ['Isocortex', 'CTXpl', 'CTX', 'CH', 'grey', 'root']
+
+# Image_01 and Image_03 have one file for both hemispheres, Image_02 a file per hemisphere
+EXCLUSIONS = {'Image_01_regions.txt': ['Right: SSp', 'Left: SSp', 'Left: MOs'],
+              'Image_02_LEFT_regions.txt': ['Left: MOp'],
+              'Image_02_RIGHT_regions.txt': [],
+              'Image_03_regions.txt': []}
+
+# Output of the original implementation. With the pandas version of environment.yml,
+# all columns of a slice become floats if regions are excluded from it (Image_01 and Image_02).
+EXPECTED = {'Image_01': '''
+Class,area,CTB,RAB,TVA,CTB_RAB,CTB_TVA,RAB_TVA,CTB_RAB_TVA
+Left: MOp,100.0,5,3,0,2,0,0,0
+Left: MO,100.0,5,3,0,2,0,0,0
+Left: Isocortex,100.0,5,3,0,2,0,0,0
+Left: CTXpl,100.0,5,3,0,2,0,0,0
+Left: CTX,100.0,5,3,0,2,0,0,0
+Left: CH,100.0,5,3,0,2,0,0,0
+Left: grey,100.0,5,3,0,2,0,0,0
+Left: root,100.0,5,3,0,2,0,0,0
+Left: SS,0.0,0,0,0,0,0,0,0
+Right: MOp,80.0,1,0,0,0,0,0,0
+Right: MO,140.0,5,4,0,2,0,0,0
+Right: Isocortex,140.0,5,4,0,2,0,0,0
+Right: CTXpl,140.0,5,4,0,2,0,0,0
+Right: CTX,140.0,5,4,0,2,0,0,0
+Right: CH,140.0,5,4,0,2,0,0,0
+Right: grey,140.0,5,4,0,2,0,0,0
+Right: root,140.0,5,4,0,2,0,0,0
+Right: MOs,60.0,4,4,0,2,0,0,0
+Right: SS,0.0,0,0,0,0,0,0,0
+''',
+            'Image_02': '''
+Class,area,CTB,RAB,TVA,CTB_RAB,CTB_TVA,RAB_TVA,CTB_RAB_TVA
+Left: MO,50.0,1,5,0,1,0,0,0
+Left: Isocortex,250.0,6,5,0,1,0,0,0
+Left: CTXpl,250.0,6,5,0,1,0,0,0
+Left: CTX,250.0,6,5,0,1,0,0,0
+Left: CH,250.0,6,5,0,1,0,0,0
+Left: grey,250.0,6,5,0,1,0,0,0
+Left: root,250.0,6,5,0,1,0,0,0
+Left: MOs,50.0,1,5,0,1,0,0,0
+Left: SSp,200.0,5,0,0,0,0,0,0
+Left: SS,200.0,5,0,0,0,0,0,0
+Right: MOp,80.0,1,0,0,0,0,0,0
+Right: MO,140.0,5,4,0,2,0,0,0
+Right: Isocortex,290.0,6,8,0,3,0,0,0
+Right: CTXpl,290.0,6,8,0,3,0,0,0
+Right: CTX,290.0,6,8,0,3,0,0,0
+Right: CH,290.0,6,8,0,3,0,0,0
+Right: grey,290.0,6,8,0,3,0,0,0
+Right: root,290.0,6,8,0,3,0,0,0
+Right: MOs,60.0,4,4,0,2,0,0,0
+Right: SSp,150.0,1,4,0,1,0,0,0
+Right: SS,150.0,1,4,0,1,0,0,0
+''',
+            'Image_03': '''
+Class,area,CTB,RAB,TVA,CTB_RAB,CTB_TVA,RAB_TVA,CTB_RAB_TVA
+Left: MOp,100.0,5,3,0,2,0,0,0
+Left: MO,150.0,6,8,0,3,0,0,0
+Left: Isocortex,350.0,11,8,0,3,0,0,0
+Left: CTXpl,350.0,11,8,0,3,0,0,0
+Left: CTX,350.0,11,8,0,3,0,0,0
+Left: CH,350.0,11,8,0,3,0,0,0
+Left: grey,350.0,11,8,0,3,0,0,0
+Left: root,350.0,11,8,0,3,0,0,0
+Left: MOs,50.0,1,5,0,1,0,0,0
+Left: SSp,200.0,5,0,0,0,0,0,0
+Left: SS,200.0,5,0,0,0,0,0,0
+Right: MOp,80.0,1,0,0,0,0,0,0
+Right: MO,140.0,5,4,0,2,0,0,0
+Right: Isocortex,290.0,6,8,0,3,0,0,0
+Right: CTXpl,290.0,6,8,0,3,0,0,0
+Right: CTX,290.0,6,8,0,3,0,0,0
+Right: CH,290.0,6,8,0,3,0,0,0
+Right: grey,290.0,6,8,0,3,0,0,0
+Right: root,290.0,6,8,0,3,0,0,0
+Right: MOs,60.0,4,4,0,2,0,0,0
+Right: SSp,150.0,1,4,0,1,0,0,0
+Right: SS,150.0,1,4,0,1,0,0,0
+'''}
+
+#%%
+def make_region_table(hemispheres):
+    '''
+    Table of a synthetic slice with the columns exported by QuPath.
+    '''
+    rows = []
+    for hemi in hemispheres:
+        counts = {}
+        for leaf, leaf_counts in LEAVES[hemi].items():
+            for region in [leaf] + PARENTS[leaf] + ANCESTORS:
+                counts[region] = np.add(counts.get(region, 0), leaf_counts)
+        for region, region_counts in counts.items():
+            num_ctb, num_rabies, num_ctb_rabies, area = region_counts
+            rows.append({'Name': region, 'Class': hemi + ': ' + region,
+                         'Num CTB': int(num_ctb), 'Num Rabies': int(num_rabies), 'Num CTB: Rabies': int(num_ctb_rabies),
+                         'DAPI: DAPI area um^2': area})
+    table = pd.DataFrame(rows)
+
+    # The full slice is one region called 'Root', without class
+    whole_slice = table[table['Class'].str.endswith(': root')].sum(numeric_only=True)
+    table = pd.concat([pd.DataFrame([{'Name': 'Root', 'Class': np.nan, **whole_slice}]), table], ignore_index=True)
+    for column in MARKER_PANEL['class_columns']:
+        table[column] = table[column].astype(np.int64) if column in table else 0
+
+    return table
+
+def write_synthetic_slice(root):
+    '''
+    Write the _regions.txt files of the synthetic slices in root, and return their file names.
+    '''
+    files = {'Image_01_regions.txt': ['Left', 'Right'],
+             'Image_02_LEFT_regions.txt': ['Left'],
+             'Image_02_RIGHT_regions.txt': ['Right'],
+             'Image_03_regions.txt': ['Left', 'Right']}
+    for fname, hemispheres in files.items():
+        table = make_region_table(hemispheres)
+        table.insert(0, 'Image Name', fname.replace('_LEFT', '').replace('_RIGHT', '').replace('_regions.txt', ''))
+        table.to_csv(os.path.join(root, fname), sep='\t', index=False)
+    return list(files)
+
+#%%
+def test_load_slice_matches_original_output(tmp_path):
+    ontology = get_ontology(PATH_TO_ONTOLOGY)
+    file_names = write_synthetic_slice(str(tmp_path))
+
+    for f, expected in EXPECTED.items():
+        expected = pd.read_csv(io.StringIO(expected), index_col='Class')
+        if f != 'Image_03':
+            expected = expected.astype(float)
+
+        region_dict,df = load_slice(str(tmp_path), f, file_names, EXCLUSIONS,
+                                    ontology.edges, ontology.tree, ontology.index)
+        pd.testing.assert_frame_equal(df, expected)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Smoke test of the cohort heatmap on a small frame.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from ontology_helpers import get_ontology
+from plot_helpers import plot_heatmap
+
+PATH_TO_ONTOLOGY = os.path.join(os.path.dirname(__file__), '..', '..', 'AllenMouseBrainOntology.pk')
+
+#%%
+def test_plot_heatmap_on_small_frame(tmp_path):
+    ontology = get_ontology(PATH_TO_ONTOLOGY)
+    data = pd.DataFrame({'Animal_1': [1.5, 0.0, 2.0, np.nan], 'Animal_2': [0.5, 1.0, 3.0, 4.0]},
+                        index=['MOs', 'MO', 'MOp', 'SSp'])
+
+    fig = plot_heatmap(data, ontology.regions, ontology.index, x_label='Normalized cell count')
+    fig.savefig(str(tmp_path / 'heatmap.pdf'))
+    plt.close(fig)
+
+    assert os.path.getsize(str(tmp_path / 'heatmap.pdf')) > 0
+    # Rows are in ontology preorder: MO is above its subregions
+    labels = [label.get_text().strip() for label in fig.axes[0].get_yticklabels()]
+    assert labels[0].endswith('(MO)')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that save_results and load_results round-trip the results dataframes.
+
+@author: lukasvandenheuvel
+"""
+
+import os
+import json
+import pytest
+import numpy as np
+import pandas as pd
+
+from readCSV_helpers import save_results, load_results
+
+#%%
+def make_results():
+    '''
+    Results like collect_and_analyze_cell_counts (columns tracer -> hemisphere -> animal), with missing values.
+    '''
+    columns = pd.MultiIndex.from_product([['CTB', 'RAB'], ['Left', 'Right', 'Sum'], ['Animal_1', 'Animal_2']])
+    values = np.arange(4 * len(columns), dtype=float).reshape(4, -1) / 7
+    values[1, 3] = np.nan
+    return pd.DataFrame(values, index=['root', 'grey', 'MO', 'MOp'], columns=columns)
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_round_trip_of_multiindex_results(tmp_path, mmap):
+    results = make_results()
+    save_results(results, str(tmp_path), 'results', save_csv=True)
+
+    loaded = load_results(str(tmp_path), 'results', mmap=mmap)
+    pd.testing.assert_frame_equal(loaded, results)
+    # Memory-mapped values are read-only
+    assert loaded.to_numpy().flags.writeable != mmap
+    assert os.path.exists(str(tmp_path / 'results.csv'))
+
+def test_round_trip_of_named_columns(tmp_path):
+    results = make_results().swaplevel(0, 1, axis=1).sort_index(axis=1).rename_axis(['hemisphere', 'tracer', 'animal'], axis=1)
+    save_results(results, str(tmp_path), 'swapped')
+    pd.testing.assert_frame_equal(load_results(str(tmp_path), 'swapped'), results)
+
+    single = results[('Sum', 'CTB')].rename_axis('animal', axis=1)
+    save_results(single, str(tmp_path), 'single')
+    pd.testing.assert_frame_equal(load_results(str(tmp_path), 'single'), single)
+
+def test_other_format_version_is_rejected(tmp_path):
+    save_results(make_results(), str(tmp_path), 'results')
+    with open(str(tmp_path / 'results.json'), 'r') as f:
+        schema = json.load(f)
+    schema['version'] += 1
+    with open(str(tmp_path / 'results.json'), 'w') as f:
+        json.dump(schema, f)
+
+    with pytest.raises(ValueError):
+        load_results(str(tmp_path), 'results')